@@ -1,24 +1,37 @@
-from flask import Flask, render_template, redirect, url_for, flash, session
+from flask import Flask, render_template, redirect, url_for, flash, session, request, abort
+import os
+from dotenv import load_dotenv
+
+# Load the .env settings before importing the blueprints, some modules read their settings at import time
+load_dotenv()
+
 from modules.plant import plant_blueprint
 from modules.weather import weather_blueprint
 from modules.soil import soil_blueprint
 from modules.results import results_blueprint
 from modules.irrigation import irrigation_blueprint
+from modules.api import api_blueprint
 from main.utils import delete_old_files
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
+from main.scheduler import registry
+from main import metrics
+from main.profiling import init_profiling
+from main.http_cache import init_http_cache
 
 app = Flask(__name__)
 app.secret_key = os.getenv('flask_key')
 if not app.secret_key:
     raise ValueError('ERROR: No secret key set for Flask. Check your .env file.')
 
+# Opt-in profiling of single requests (only active when `profile_token` is set). Registered first so it covers the other hooks.
+init_profiling(app)
+
+# Compressed responses, ETags and long-lived caching of the static files (see main/http_cache.py)
+init_http_cache(app)
+
 @app.before_request
 def cleanup_old_data():
     """ Automatically remove old weather data if it is older than 6 hours """
-    delete_old_files()  # Call the cleanup function before each request
+    delete_old_files(keep=registry.weather_files())  # Call the cleanup function before each request (registered fields are refreshed nightly)
 
 @app.route('/')
 def start():
@@ -30,9 +43,13 @@ app.register_blueprint(weather_blueprint, url_prefix='/weather')
 app.register_blueprint(soil_blueprint, url_prefix='/soil')
 app.register_blueprint(irrigation_blueprint, url_prefix='/irrigation')
 app.register_blueprint(results_blueprint, url_prefix='/results')
+app.register_blueprint(api_blueprint, url_prefix='/api')
 
 @app.before_request
 def initialize_session():
+    # The JSON API is stateless, its requests never create a session cookie
+    if request.blueprint == 'api':
+        return
     # Clear session only if not already initialized
     if 'initialized' not in session:
         session.clear()
@@ -48,6 +65,13 @@ def clear_session():
 def home():
     return render_template('base.html')
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """ Per-stage latency, bytes and cache metrics in Prometheus text format (metrics token required) """
+    if not metrics.authorized(request.headers.get('Authorization'), request.headers.get('X-Admin-Token')):
+        abort(404)
+    return metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 # @app.teardown_request
 # def remove_weather_data(exception=None):
 #     """ Automatically remove weather data when the user session ends """
@@ -0,0 +1,87 @@
+import time
+import numpy as np
+import pandas as pd
+from main.grhs import dr_plot
+
+'''Note: Benchmark and equality check for the vectorized `dr_plot` in main/grhs.py. The original row-by-row implementation is kept
+here as the reference so that both the points and their ordering can be compared on synthetic pyfao56-like output of several
+season lengths. Run from the repository root with: python -m benchmarks.bench_dr_plot'''
+
+
+def dr_plot_reference(df):
+    '''Original `iterrows` implementation of `dr_plot`, kept as the reference for the equality check.'''
+    df1 = df[['Dr','Rain','Irrig', "IrrLoss"]].copy().reset_index()
+
+    plot_data = []
+    previous_row = None
+
+    for _, row in df1.iterrows():
+        day = row["index"]
+        try:
+            depletion = previous_row['Dr']
+        except:
+            depletion = 0.
+
+        plot_data.append({"day": day, "value": depletion, "type": "depletion"})
+
+        if row["Rain"] > 0:
+            depletion_after_rain = max(depletion - row["Rain"], 0)
+            plot_data.append({"day": day, "value": depletion_after_rain, "type": "hrain"})
+            depletion = depletion_after_rain
+
+        if row["Irrig"] > 0:
+            depletion_after_irrigation = max(depletion - row["Irrig"] + row['IrrLoss'], 0)
+            plot_data.append({"day": day, "value": depletion_after_irrigation, "type": "irrigation"})
+            depletion = depletion_after_irrigation
+
+        previous_row = row
+
+    plot_df = pd.DataFrame(plot_data)
+    return plot_df.sort_values(by=["day", "type"])
+
+
+def synthetic_results(n_days, seed=0):
+    '''Builds a pyfao56-like output frame (indexed by '%Y-%j') with random depletion, rain and irrigation events.'''
+    rng = np.random.default_rng(seed)
+    days = pd.date_range('2022-01-01', periods=n_days, freq='D').strftime('%Y-%j')
+    irrig = np.where(rng.random(n_days) < 0.1, rng.uniform(10, 40, n_days), 0.)
+    return pd.DataFrame({
+        'Dr': rng.uniform(0, 120, n_days),
+        'Rain': np.where(rng.random(n_days) < 0.2, rng.uniform(0.1, 30, n_days), 0.),
+        'Irrig': irrig,
+        'IrrLoss': irrig * rng.uniform(0, 0.2, n_days),
+    }, index=days)
+
+
+def assert_same(df):
+    '''Raises an AssertionError if the vectorized and reference traces differ in points or ordering.'''
+    expected = dr_plot_reference(df).reset_index(drop=True)
+    result = dr_plot(df).reset_index(drop=True)
+    assert result['day'].tolist() == expected['day'].tolist()
+    assert result['type'].tolist() == expected['type'].tolist()
+    np.testing.assert_allclose(result['value'].to_numpy(dtype=float), expected['value'].to_numpy(dtype=float))
+
+
+def best_time(func, *args, repeat=5):
+    '''Best wall time of `repeat` calls in seconds.'''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    print(f"{'days':>8} {'reference (ms)':>15} {'vectorized (ms)':>16} {'speedup':>8}")
+    for n_days in (120, 365, 3650, 36500):
+        df = synthetic_results(n_days)
+        assert_same(df)
+        t_ref = best_time(dr_plot_reference, df, repeat=1 if n_days > 5000 else 5)
+        t_vec = best_time(dr_plot, df)
+        print(f'{n_days:>8} {t_ref*1e3:>15.2f} {t_vec*1e3:>16.2f} {t_ref/t_vec:>7.1f}x')
+
+    # Edge cases: unsorted days and a season without any rain or irrigation
+    assert_same(synthetic_results(200, seed=1).sample(frac=1, random_state=1))
+    assert_same(synthetic_results(50, seed=2).assign(Rain=0., Irrig=0., IrrLoss=0.))
+    print('Vectorized dr_plot matches the reference implementation.')
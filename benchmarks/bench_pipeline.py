@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from benchmarks.standins import REPO_DIR, WEATHER_FILE, fixture_weather, start_agrimet_server, write_gridmet_files
+
+'''Note: Benchmark suite for the fetch -> simulate -> plot pipeline. Every stage is driven through the app's own functions
+(`WeatherDataFetcher`, `fetch_daily_data_df`, `load_weather_data`, `simulate_model`, `dr_plot`, `wb_plot_payload`,
+`wb_plot_interactive` and `render_wb_plot`) against local stand-ins for THREDDS and AgriMet (see benchmarks/standins.py),
+the bundled `test.csv` season and the cached `weather_storage` file, so no network access is needed.
+
+Season length, number of fields and number of soil layers are varied one at a time around a default case. Results are written
+to benchmarks/results/<commit>.json so that two commits can be compared:
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --compare benchmarks/results/<older commit>.json'''
+
+LAT, LON, ELEVATION = 43.60889, -116.19407, 824
+PLANTING_DATE = '2022-04-20'
+
+DEFAULT_CASE = {'season_days': 120, 'fields': 1, 'layers': 2}
+SEASON_DAYS = [60, 120, 240, 365]
+FIELDS = [1, 5, 20]
+LAYERS = [1, 3, 6]
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+MEASURES = ('seconds', 'bytes_read', 'peak_memory')  # Fields of a record that are not part of its case
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def best_time(func, repeat):
+    '''Best wall time of `repeat` calls in seconds and the result of the last call.'''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def field_inputs(season_days, layers, field=0):
+    '''Session-like inputs of one potato field with automatic irrigation and `layers` equal soil layers down to 150 cm.'''
+    from main.crop_data import CROP_COEFFICIENTS, CROP_PROPERTIES, CROP_STAGE_LENGTHS
+
+    maturity_date = (pd.to_datetime(PLANTING_DATE) + pd.Timedelta(days=season_days - 1)).strftime('%Y-%m-%d')
+    plant_properties = {**CROP_COEFFICIENTS['potato'], **CROP_PROPERTIES['potato'], **CROP_STAGE_LENGTHS['potato'],
+                        'CN2': 76, 'kcb_adjust': 'on', 'stage_length_adjust': 'on', 'roff_adjust': 'on'}
+    plant_data = {'planting_date': PLANTING_DATE, 'maturity_date': maturity_date, 'crop': 'potato',
+                  'plant_properties': plant_properties}
+    weather_data = {'latitude': str(LAT), 'longitude': str(LON), 'elevation': str(ELEVATION), 'data_source': 'fetch'}
+    soil_data = {
+        'soil_type': 'benchmark',
+        'layers': [{'bottom_depth': round(150 * (i + 1) / layers), 'field_capacity': 30 + field % 5,
+                    'wilting_point': 12, 'initial_moisture': 25} for i in range(layers)],
+        'tew_depth': 0.1,
+        'rew': 8,
+    }
+    irri_data = {'Irrigation_type': 'auto', 'Irri_data': {
+        'start_date': PLANTING_DATE, 'end_date': maturity_date, 'trigger': 'root_depletion',
+        'auto_fraction': 0.6, 'depletion_threshold': 0.4, 'depletion_upper': 95}}
+    return plant_data, weather_data, soil_data, irri_data
+
+
+def store_weather(season_days):
+    '''Stores stand-in weather covering the season (in the layout written by the weather page) for `simulate_model`.'''
+    from main.schema import compact_weather
+    from main.utils import save_weather_data
+
+    weather = fixture_weather(PLANTING_DATE, pd.to_datetime(PLANTING_DATE) + pd.Timedelta(days=season_days + 10))
+    save_weather_data(str(LAT), str(LON), compact_weather(weather))
+
+
+def run(quick=False):
+    from main.agrimet_fetch import fetch_daily_data_df
+    from main.gridMET_fetch import WeatherDataFetcher
+    from main.grhs import dr_plot, wb_plot_interactive, wb_plot_payload
+    from main.utils import load_weather_data, render_wb_plot
+    from modules.results import simulate_model
+
+    repeat = 1 if quick else 3
+    records = []
+
+    def record(stage, params, func, n=repeat):
+        seconds, result = best_time(func, n)
+        records.append({'stage': stage, **params, 'seconds': seconds})
+        print(f'{stage:<22} {json.dumps(params):<55} {seconds*1000:>10.1f} ms')
+        return result
+
+    # Fetching: gridMET from local NetCDF files and AgriMet from the local HTTP server
+    gridmet_root = write_gridmet_files(os.path.join(os.getcwd(), 'gridmet'), [2021, 2022], LAT, LON)
+    variables = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+    for season_days in SEASON_DAYS:
+        start = pd.to_datetime('2021-04-20')
+        end = (start + pd.Timedelta(days=season_days - 1)).strftime('%Y-%m-%d')
+        for lazy in (False, True):
+            fetcher = WeatherDataFetcher(LAT, LON, variables, base_url=gridmet_root, lazy=lazy)
+            record('fetch_gridmet', {'season_days': season_days, 'lazy': lazy},
+                   lambda: fetcher.fetch_data_for_date_range(start.strftime('%Y-%m-%d'), end))
+            # Bytes read and peak memory of one field, measured in a separate run (tracemalloc slows it down)
+            sized = WeatherDataFetcher(LAT, LON, variables, base_url=gridmet_root, lazy=lazy, measure_memory=True)
+            sized.fetch_data_for_date_range(start.strftime('%Y-%m-%d'), end)
+            records[-1].update(bytes_read=sized.stats['bytes_read'], peak_memory=sized.stats['peak_memory'])
+            print(f"{'':<22} bytes read {sized.stats['bytes_read']}, peak memory {sized.stats['peak_memory']} B")
+        record('fetch_agrimet', {'season_days': season_days},
+               lambda: fetch_daily_data_df(start.strftime('%Y-%m-%d'), end, ['boii'], ['SR', 'MX', 'MN', 'YM', 'UA', 'PP']))
+
+    # Loading the bundled weather_storage file
+    shutil.copy(WEATHER_FILE, os.path.join('weather_storage', os.path.basename(WEATHER_FILE)))
+    record('load_weather_data', {'file': 'bundled'}, lambda: load_weather_data('43.60889', '-116.19407'))
+
+    # Simulation and plots, varying one dimension at a time around the default case
+    cases = ([{**DEFAULT_CASE, 'season_days': d} for d in SEASON_DAYS]
+             + [{**DEFAULT_CASE, 'fields': f} for f in FIELDS if f != DEFAULT_CASE['fields']]
+             + [{**DEFAULT_CASE, 'layers': n} for n in LAYERS if n != DEFAULT_CASE['layers']])
+    for case in cases:
+        store_weather(case['season_days'])
+        record('load_weather_data', {'season_days': case['season_days']}, lambda: load_weather_data(str(LAT), str(LON)))
+        fields = [field_inputs(case['season_days'], case['layers'], field) for field in range(case['fields'])]
+        results = record('simulate_model', case, lambda: [simulate_model(*inputs) for inputs in fields])
+        odata = results[0][0]
+
+        if case['fields'] == 1 and case['layers'] == DEFAULT_CASE['layers']:
+            season = {'season_days': case['season_days']}
+            record('dr_plot', season, lambda: dr_plot(odata))
+            record('wb_plot_payload', season, lambda: wb_plot_payload(odata))
+            record('wb_plot_interactive', season, lambda: wb_plot_interactive(odata))
+            record('wb_plot', season, lambda: render_wb_plot(odata), n=1)
+
+    return records
+
+
+def compare(records, baseline_path):
+    '''Prints the time ratio of every stage and case against a previous results file.'''
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def key(r):
+        return json.dumps({k: v for k, v in r.items() if k not in MEASURES}, sort_keys=True)
+
+    previous = {key(r): r['seconds'] for r in baseline['results']}
+    print(f"\nComparison with {baseline['commit']} (ratio > 1 is slower):")
+    for r in records:
+        if key(r) in previous:
+            ratio = r['seconds'] / previous[key(r)]
+            flag = '  <-- regression' if ratio > 1.2 else ''
+            print(f"{r['stage']:<22} {key(r):<90} {ratio:>6.2f}x{flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fetch -> simulate -> plot pipeline with local stand-ins.')
+    parser.add_argument('--quick', action='store_true', help='Run every case once instead of best of three.')
+    parser.add_argument('--compare', help='Results file of another commit to compare with.')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    server, agrimet_url = start_agrimet_server()
+    os.environ['agrimet_url'] = agrimet_url
+
+    # Run in a scratch directory so the stand-in data never touches the repository's weather_storage
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_DIR)
+        records = run(quick=args.quick)
+    server.shutdown()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = os.path.join(RESULTS_DIR, f'{commit}.json')
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'timestamp': time.time(), 'python': platform.python_version(),
+                   'machine': platform.machine(), 'results': records}, f, indent=4)
+    print(f'\nResults written to {output}')
+
+    if args.compare:
+        compare(records, args.compare)
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import pandas as pd
+from benchmarks.standins import REPO_DIR, fixture_weather
+
+'''Note: Memory of the weather and output frames of a field-season in the legacy layout (float64 values, empty-string placeholder
+columns, text dates) and in the compact schema of main/schema.py (float32, NaN masks, categorical MorP; float32 output with
+int16/categorical date columns), for one field-season and for a batch of fields. The model output comes from `simulate_model` on
+the stand-in season of the pipeline benchmark, in a temporary working directory.
+
+    python -m benchmarks.bench_schema
+    python -m benchmarks.bench_schema --fields 1000 --season-days 120 365'''
+
+SEASON_DAYS = [120, 365]
+
+
+def run(season_days, fields):
+    from benchmarks.bench_pipeline import PLANTING_DATE, field_inputs, store_weather
+    from main.schema import memory_report
+    from modules.results import simulate_model
+
+    reports = []
+    for days in season_days:
+        weather = fixture_weather(PLANTING_DATE, pd.to_datetime(PLANTING_DATE) + pd.Timedelta(days=days - 1))
+        store_weather(days)
+        odata, _ = simulate_model(*field_inputs(days, layers=2))
+        report = memory_report(weather, odata, fields=fields)
+        reports.append({'season_days': days, **report})
+        for name in ('weather', 'odata'):
+            r = report[name]
+            print(f"{name:<8} {days:>4} days  {r['legacy_bytes'] / 1024:>8.1f} KiB -> {r['compact_bytes'] / 1024:>7.1f} KiB "
+                  f"per field-season   {r['legacy_batch_mb']:>8.1f} MB -> {r['compact_batch_mb']:>7.1f} MB per {fields} fields "
+                  f"({r['saved']:.0%} saved)")
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory of the legacy and compact weather and output frames.')
+    parser.add_argument('--fields', type=int, default=1000, help='Number of field-seasons of the batch.')
+    parser.add_argument('--season-days', type=int, nargs='*', default=SEASON_DAYS)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_DIR)
+        reports = run(args.season_days, args.fields)
+    if args.json:
+        print(json.dumps(reports, indent=4))
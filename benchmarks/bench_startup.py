@@ -0,0 +1,79 @@
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+'''Note: Cold-start measurement of a fresh worker. Each run starts a new Python process that imports `app` and serves its first
+request ("time to first response"), and `python -X importtime` gives the import profile of the app. The heavy libraries
+(pyfao56, matplotlib, seaborn, plotly, xarray) are expected to stay unloaded until a route needs them.
+
+The processes run in a temporary working directory so `delete_old_files` never touches the repository's weather_storage.
+Run from the repository root with: python -m benchmarks.bench_startup'''
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Target for the cold start of a fresh worker (import + first response), in seconds
+COLD_START_TARGET_S = 1.0
+
+# Libraries that must not be imported at boot
+LAZY_MODULES = ['pyfao56', 'matplotlib', 'seaborn', 'plotly', 'xarray']
+
+FIRST_RESPONSE_SCRIPT = f'''
+import time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+response = app.app.test_client().get('/')
+t2 = time.perf_counter()
+import sys
+loaded = [m for m in {LAZY_MODULES!r} if m in sys.modules]
+print(t1 - t0, t2 - t0, response.status_code, ','.join(loaded) or '-')
+'''
+
+
+def run_python(args, cwd):
+    env = {**os.environ, 'PYTHONPATH': REPO_DIR, 'flask_key': os.environ.get('flask_key', 'startup-benchmark')}
+    return subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+
+
+def time_to_first_response(runs=5):
+    '''Median import time and time to first response of fresh worker processes, and the heavy modules they loaded.'''
+    imports, firsts, loaded = [], [], set()
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(runs):
+            output = run_python(['-c', FIRST_RESPONSE_SCRIPT], cwd).stdout.strip().splitlines()[-1]
+            t_import, t_first, status, modules = output.split(' ')
+            imports.append(float(t_import))
+            firsts.append(float(t_first))
+            loaded.update(m for m in modules.split(',') if m != '-')
+    return statistics.median(imports), statistics.median(firsts), sorted(loaded)
+
+
+def import_profile(top=15):
+    '''Top-level packages imported by `app`, sorted by cumulative import time (from `python -X importtime`).'''
+    with tempfile.TemporaryDirectory() as cwd:
+        stderr = run_python(['-X', 'importtime', '-c', 'import app'], cwd).stderr
+
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        if not name.startswith(' ') and '.' not in name:  # Top-level imports only
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    print('Import profile of `import app` (top-level packages, cumulative):')
+    for name, us in import_profile():
+        print(f'  {name:<30} {us/1000:>8.1f} ms')
+
+    t_import, t_first, loaded = time_to_first_response()
+    print(f'\nimport app:             {t_import*1000:8.1f} ms (median)')
+    print(f'time to first response: {t_first*1000:8.1f} ms (median, target {COLD_START_TARGET_S*1000:.0f} ms)')
+    print(f'heavy modules loaded at boot: {", ".join(loaded) or "none"}')
+
+    if t_first > COLD_START_TARGET_S or loaded:
+        sys.exit('Cold start target not met.')
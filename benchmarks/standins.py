@@ -0,0 +1,112 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+
+'''Note: Local stand-ins for the external services used by the benchmarks. The bundled season in `test.csv` (gridMET, already in
+pyfao56 units) is repeated to cover any number of years, then written back in the native layout and units of each service:
+- gridMET/THREDDS: one NetCDF file per variable and year (<root>/<var>/<var>_<year>.nc) on a small lat/lon grid, which
+  `WeatherDataFetcher(base_url=<root>)` opens exactly like the OPeNDAP URLs, and the elevation grid
+  (<root>/elev/metdata_elevationdata.nc) used by the regional mode.
+- AgriMet: a local HTTP server answering `daily.pl` queries with the CSV layout read by `fetch_daily_data_df`.'''
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(REPO_DIR, 'test.csv')
+WEATHER_FILE = os.path.join(REPO_DIR, 'weather_storage', 'weather_43.60889_-116.19407.json')
+
+# gridMET variables in the units of the gridMET files
+GRIDMET_VARS = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+
+
+def fixture_weather(start, end):
+    '''
+    Daily weather (pyfao56 units) between `start` and `end`, built by cycling the bundled season of `test.csv`.
+
+    Returns:
+    --------
+    pd.DataFrame
+        Columns 'Date' and `GRIDMET_VARS`.
+    '''
+    season = pd.read_csv(FIXTURE)[['Date'] + GRIDMET_VARS]
+    dates = pd.date_range(start, end, freq='D')
+    data = season[GRIDMET_VARS].to_numpy()[np.arange(len(dates)) % len(season)]
+    weather = pd.DataFrame(data, columns=GRIDMET_VARS)
+    weather.insert(0, 'Date', dates)
+    return weather
+
+
+def write_gridmet_files(root, years, lat, lon, cells=5):
+    '''
+    Writes gridMET-like NetCDF files for `years` around (lat, lon) under `root`.
+
+    Returns:
+    --------
+    str
+        `root`, to be used as `base_url` of `WeatherDataFetcher`.
+    '''
+    import xarray as xr
+
+    lats = lat + (np.arange(cells) - cells // 2) / 24  # gridMET resolution is 1/24 degree
+    lons = lon + (np.arange(cells) - cells // 2) / 24
+    for year in years:
+        weather = fixture_weather(f'{year}-01-01', f'{year}-12-31')
+        # Back to the gridMET units (W/m2 and K)
+        weather['srad'] /= 0.0864
+        weather['tmmx'] += 273.15
+        weather['tmmn'] += 273.15
+        for var in GRIDMET_VARS:
+            values = np.broadcast_to(weather[var].to_numpy(dtype='float32')[:, None, None],
+                                     (len(weather), cells, cells))
+            dataset = xr.Dataset({var: (('day', 'lat', 'lon'), values)},
+                                 coords={'day': weather['Date'].to_numpy(), 'lat': lats, 'lon': lons})
+            os.makedirs(os.path.join(root, var), exist_ok=True)
+            dataset.to_netcdf(os.path.join(root, var, f'{var}_{year}.nc'))
+    # Elevation grid (m), rising to the east like a valley side
+    elevation = np.broadcast_to(800.0 + 100.0 * np.arange(cells, dtype='float32')[None, :], (cells, cells))
+    os.makedirs(os.path.join(root, 'elev'), exist_ok=True)
+    xr.Dataset({'elevation': (('lat', 'lon'), elevation)}, coords={'lat': lats, 'lon': lons}).to_netcdf(
+        os.path.join(root, 'elev', 'metdata_elevationdata.nc'))
+    return root
+
+
+class _AgriMetHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        weather = fixture_weather(query['start'][0], query['end'][0])
+        station = query['list'][0].split(' ')[0]
+
+        # Back to the AgriMet units (langleys, F, mph and inches); dew point estimated from tmmn
+        csv = pd.DataFrame({
+            'DateTime': weather['Date'].dt.strftime('%Y-%m-%d'),
+            f'{station}_sr': weather['srad'] / 0.041868,
+            f'{station}_mx': weather['tmmx'] * 9 / 5 + 32,
+            f'{station}_mn': weather['tmmn'] * 9 / 5 + 32,
+            f'{station}_ym': (weather['tmmn'] - 2) * 9 / 5 + 32,
+            f'{station}_ua': weather['vs'] / 0.44704,
+            f'{station}_pp': weather['pr'] / 25.4,
+        }).round(2).to_csv(index=False).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(csv)))
+        self.end_headers()
+        self.wfile.write(csv)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_agrimet_server():
+    '''
+    Starts the AgriMet stand-in on a free local port in a daemon thread.
+
+    Returns:
+    --------
+    tuple
+        (server, url of `daily.pl`). Call `server.shutdown()` when done.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _AgriMetHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/pn-bin/daily.pl'
@@ -1,7 +1,18 @@
+import os
 import pandas as pd
 from geopy.distance import geodesic
 import requests
 from io import StringIO
+from main.shared_cache import cache as shared_cache
+
+# USBR Hydromet/AgriMet daily CSV service. It can point to a local mirror through the .env file.
+AGRIMET_URL = os.getenv('agrimet_url', 'https://www.usbr.gov/pn-bin/daily.pl')
+STATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agmet_stations.csv')
+AGRIMET_PARAMETERS = ['SR', 'MX', 'MN', 'YM', 'UA', 'PP']
+
+# Station years in the shared cache: the current year changes every day, past years are final
+CURRENT_YEAR_TTL = 6 * 3600
+PAST_YEAR_TTL = 30 * 24 * 3600
 
 def fetch_daily_data_df(start_date, end_date, stations, parameters):
     '''
@@ -9,7 +20,7 @@ def fetch_daily_data_df(start_date, end_date, stations, parameters):
     then read it into a pandas DataFrame.
     '''
     # Use the .pl extension in the URL
-    base_url = 'https://www.usbr.gov/pn-bin/daily.pl'
+    base_url = AGRIMET_URL
     
     def build_st_par_str(stations, parameters):
         return ','.join(f'{stn} {par}' for stn in stations for par in parameters)
@@ -34,6 +45,36 @@ def fetch_daily_data_df(start_date, end_date, stations, parameters):
     
     return df
 
+def fetch_station_year(siteid, year, parameters=AGRIMET_PARAMETERS, cache=None):
+    '''
+    Daily data of one station for a whole year, through the shared cache when one is given (one download per station and year
+    for all workers, see main/shared_cache.py).
+    '''
+    def fetch():
+        end = min(pd.Timestamp(year=year, month=12, day=31), pd.Timestamp.now().normalize())
+        return fetch_daily_data_df(f'{year}-01-01', end.strftime('%Y-%m-%d'), [siteid], parameters)
+
+    if cache is None:
+        return fetch()
+    ttl = CURRENT_YEAR_TTL if year >= pd.Timestamp.now().year else PAST_YEAR_TTL
+    return cache.get_or_compute(station_year_key(siteid, year, parameters), fetch, ttl=ttl, name='agrimet_cache')
+
+
+def station_year_key(siteid, year, parameters=AGRIMET_PARAMETERS):
+    '''Key of the data of a station and year in the shared cache.'''
+    return f"agrimet:{AGRIMET_URL}:{siteid}:{year}:{','.join(parameters)}"
+
+
+def fetch_daily_data_cached(start_date, end_date, siteid, parameters=AGRIMET_PARAMETERS, cache=None):
+    '''
+    Daily data of one station between two dates, assembled from the cached station years (see `fetch_station_year`).
+    '''
+    start, end = pd.to_datetime(start_date), pd.to_datetime(end_date)
+    years = [fetch_station_year(siteid, year, parameters, cache) for year in range(start.year, end.year + 1)]
+    data = pd.concat(years, ignore_index=True)
+    dates = pd.to_datetime(data['Date'])
+    return data[(dates >= start) & (dates <= end)].reset_index(drop=True)
+
 def data_pre_process(df):
     df.columns = ['Date', 'srad', 'tmmx', 'tmmn', 'tdew', 'vs', 'pr']
     df['srad'] *= 0.041868 #langleys to MJ/m2/days
@@ -58,7 +99,7 @@ def get_agrimet(lat, lon, buffer_km, start_date):
     - list of dicts: Nearby stations sorted by distance.
     """
     start_date = pd.to_datetime(start_date)
-    stations_df = pd.read_csv('agmet_stations.csv')
+    stations_df = pd.read_csv(STATIONS_FILE)
     
     nearby_stations = []
 
@@ -80,7 +121,7 @@ def get_agrimet(lat, lon, buffer_km, start_date):
 
     return stations
 
-def get_agrimet_data(stations, start_date, end_date, parameters):
+def get_agrimet_data(stations, start_date, end_date, parameters, cache=None):
     """
     Retrieve AgriMet data from the nearest available station.
     
@@ -88,6 +129,7 @@ def get_agrimet_data(stations, start_date, end_date, parameters):
     - stations (list): List of station dictionaries including 'distance'.
     - start_date (str): Start date in 'YYYY-MM-DD' format.
     - end_date (str): End date in 'YYYY-MM-DD' format.
+    - cache (SharedCache): Optional shared cache of the station years (see `fetch_station_year`).
     
     Returns:
     - dict: The weather data from the first successful station.
@@ -98,7 +140,10 @@ def get_agrimet_data(stations, start_date, end_date, parameters):
         siteid = station['siteid']
         print(f"Attempting to fetch data from {siteid} ({station['distance']} km away)...")
         
-        data = fetch_daily_data_df(start_date, end_date, stations=[siteid], parameters=parameters)
+        if cache is None:
+            data = fetch_daily_data_df(start_date, end_date, stations=[siteid], parameters=parameters)
+        else:
+            data = fetch_daily_data_cached(start_date, end_date, siteid, parameters, cache)
         
         if data is not None and not data.empty:
             print(f"Data successfully retrieved from station {siteid}")
@@ -114,5 +159,5 @@ def get_agrimet_data(stations, start_date, end_date, parameters):
 # Example Usage
 def fetch_agrimet(lat, lon, start_date, end_date, buffer_km):
     stns = get_agrimet(lat, lon, buffer_km, start_date)
-    data_dict = get_agrimet_data(stns, start_date, end_date, parameters=['SR', 'MX', 'MN', 'YM', 'UA', 'PP'])
+    data_dict = get_agrimet_data(stns, start_date, end_date, parameters=AGRIMET_PARAMETERS, cache=shared_cache)
     return data_dict
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from main.pyfao56_mod import refet_daily
+from main.qc import checked_weather
+from main.schema import compact_weather, widen
+from main.shared_cache import cache
+from main.utils import weather_version
+
+'''Note: pyfao56 computes the ASCE standardized reference ET day by day in `Model.run` (`Weather.compute_etref`) whenever the
+'ETref' column of `wth.wdata` is NaN, and it does so again for every crop, soil and irrigation scenario although ETo only depends
+on the weather, the elevation, the latitude and the wind measurement height. Here the daily ETo is computed for the whole
+(checked) weather series at once with the vectorized `refet_daily`, stored in its 'ET' column with the actual vapor pressure used
+in 'vpar', and cached per weather version, elevation and wind height. `simulate_model` passes these columns to pyfao56 as ETref and
+Vapr, so `Model.run` uses them instead of recomputing ETo. Values already present in the weather data (e.g. station ET) are kept.'''
+
+ETO_TTL = 6 * 3600  # As long as the weather files (see `delete_old_files`)
+
+
+def add_eto(w_data, z, lat, wndht=10, rfcrp='S'):
+    '''
+    Fills the 'ET' (reference ET, mm) and 'vpar' (actual vapor pressure, kPa) columns of a weather series where they are missing.
+
+    Parameters:
+    -----------
+    w_data : pd.DataFrame
+        Weather in the layout of the weather store, values in pyfao56 units.
+    z : float
+        Elevation of the weather site (m).
+    lat : float
+        Latitude of the weather site (decimal degrees).
+    wndht : float
+        Height of the wind measurements (m), 10 for gridMET.
+    rfcrp : str
+        Reference crop, 'S' (short) or 'T' (tall), as `fao.Weather.rfcrp`.
+
+    Returns:
+    --------
+    pd.DataFrame
+        Copy of `w_data` with 'ET' and 'vpar' filled, in the compact weather schema (see main/schema.py). Both stay in float64,
+        so pyfao56 gets the computed values unrounded.
+    '''
+    df = w_data.copy()
+    doy = pd.to_datetime(df['Date']).dt.dayofyear.to_numpy()
+
+    def column(name):
+        return widen(pd.to_numeric(df[name], errors='coerce')) if name in df else None
+
+    vapr = column('vpar')
+    eto, ea = refet_daily(doy, column('srad'), column('tmmx'), column('tmmn'), z, lat, vapr=vapr, tdew=column('tdew'),
+                          rhmax=column('rmax'), rhmin=column('rmin'), wndsp=column('vs'), wndht=wndht, rfcrp=rfcrp)
+    et = column('ET')
+    df['ET'] = np.where(np.isnan(et), eto, et) if et is not None else eto
+    df['vpar'] = np.where(np.isnan(vapr), ea, vapr) if vapr is not None else ea
+    return compact_weather(df)
+
+
+def weather_with_eto(lat, lon, z, data_source=None, w_data=None, wndht=10, rfcrp='S', ttl=ETO_TTL, start=None, end=None):
+    '''
+    Checked weather of a location (see `checked_weather`) with daily ETo, computed once per weather version, season (`start` and
+    `end`, YYYY-MM-DD) and site settings. Both are cached for `ttl` seconds.
+
+    Returns:
+    --------
+    pd.DataFrame
+        Weather in the layout of the weather store with 'ET' and 'vpar' filled.
+    '''
+    season = f'{start}:{end}'
+    if w_data is None:
+        key = f'eto:{lat}:{lon}:{weather_version(lat, lon)}:{data_source}:{season}:{z}:{wndht}:{rfcrp}'
+    else:
+        key = f'eto:{lat}:{lon}:inline:{pd.util.hash_pandas_object(w_data.astype(str), index=False).sum()}:{data_source}:{season}:{z}:{wndht}:{rfcrp}'
+
+    def compute():
+        checked, _ = checked_weather(lat, lon, data_source, w_data, ttl=ttl, start=start, end=end)
+        return add_eto(checked, z, lat, wndht, rfcrp)
+
+    return cache.get_or_compute(key, compute, ttl=ttl, name='eto_cache')
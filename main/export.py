@@ -0,0 +1,142 @@
+import importlib.util
+import zlib
+
+'''Note: Streaming export of simulation results. The CSV download used to write the whole `mdl.odata` into a StringIO and copy
+it into a BytesIO before sending it, so every download held several copies of the table. Here results are written in chunks of
+rows that are sent as soon as they are ready, optionally gzip-compressed on the fly, and can also be exported as Parquet or Arrow
+IPC (both need the optional pyarrow package). Several fields (API batches) are written one after the other into one file with a
+`field` column, so only one field's results are in memory at a time.
+
+The date index ('Year-DOY') is written as the first column. pyfao56 repeats the Year, DOY, DOW and Date columns in `odata`;
+only their first occurrence is exported (Parquet and Arrow require unique column names).'''
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', 'arrow'),
+}
+ARROW_FORMATS = ('parquet', 'arrow')
+
+CHUNK_ROWS = 1000  # Rows per CSV chunk or Arrow record batch
+INDEX_NAME = 'Year-DOY'
+
+
+def available_formats():
+    '''Export formats usable in this installation (Parquet and Arrow only when pyarrow is installed).'''
+    has_arrow = importlib.util.find_spec('pyarrow') is not None
+    return [fmt for fmt in EXPORT_FORMATS if has_arrow or fmt not in ARROW_FORMATS]
+
+
+def export_frame(odata, field_id=None):
+    '''
+    Model output prepared for export: unique columns, the date index as first column and the field id when given.
+    '''
+    df = odata.loc[:, ~odata.columns.duplicated()]
+    df = df.rename_axis(INDEX_NAME).reset_index()
+    if field_id is not None:
+        df.insert(0, 'field', str(field_id))
+    return df
+
+
+def iter_export(frames, fmt='csv', chunk_rows=CHUNK_ROWS):
+    '''
+    Streams results in the requested format.
+
+    Parameters:
+    -----------
+    frames : iterable
+        Iterable of (field_id, odata) pairs, field_id being None for a single field. It is consumed lazily, so a generator
+        simulating one field at a time keeps only that field in memory.
+    fmt : str
+        One of `EXPORT_FORMATS`.
+    chunk_rows : int
+        Rows per chunk.
+
+    Returns:
+    --------
+    generator
+        Chunks of bytes of the file.
+    '''
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unsupported export format: {fmt}')
+    frames = (export_frame(odata, field_id) for field_id, odata in frames)
+    if fmt in ARROW_FORMATS:
+        return _iter_arrow(frames, fmt, chunk_rows)
+    return _iter_csv(frames, chunk_rows, compress=fmt == 'csv.gz')
+
+
+def _iter_csv(frames, chunk_rows, compress=False):
+    # wbits=31 writes the gzip header and trailer around the deflate stream
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    header = True
+    for df in frames:
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows].to_csv(index=False, header=header).encode()
+            header = False
+            chunk = gzip.compress(chunk) if gzip else chunk
+            if chunk:
+                yield chunk
+    if gzip:
+        yield gzip.flush()
+
+
+class _Drain:
+    '''Write-only file object whose written bytes are collected and taken out by the streaming generator.'''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _iter_arrow(frames, fmt, chunk_rows):
+    import pyarrow as pa
+
+    drain = _Drain()
+    sink = pa.PythonFile(drain, mode='w')
+    writer = schema = None
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                # The schema of the first field is used for the whole file
+                schema = table.schema.remove_metadata()
+                if fmt == 'parquet':
+                    import pyarrow.parquet as pq
+                    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+                else:
+                    writer = pa.ipc.new_file(sink, schema)
+            table = table.replace_schema_metadata().cast(schema)
+            for batch in table.to_batches(max_chunksize=chunk_rows):
+                if fmt == 'parquet':
+                    writer.write_batch(batch, row_group_size=chunk_rows)
+                else:
+                    writer.write_batch(batch)
+                data = drain.take()
+                if data:
+                    yield data
+    finally:
+        if writer is not None:
+            writer.close()
+    yield drain.take()
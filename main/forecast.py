@@ -0,0 +1,253 @@
+import copy
+import os
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from main.gridMET_fetch import WeatherDataFetcher
+from main.ingest import VALID_RANGES
+from main.schema import FLOAT_COLUMNS, compact_weather
+from main.shared_cache import cache
+
+'''Note: Forecast extension of the simulation. The observed weather ends yesterday at best, so the simulation stopped at the last
+observed day, while scheduling decisions need the projected depletion of the coming days. Forecast drops are read from local files
+in `FORECAST_DIR` (`forecast_dir` in the .env file), in the gridMET schema and units (srad W/m2, tmmx/tmmn K, rmax/rmin %, vs m/s,
+pr mm):
+- NetCDF: one file per issue with the variables srad, tmmx, tmmn, rmax, rmin, vs and pr on (day, lat, lon),
+- CSV: one file per issue with the columns Date, srad, tmmx, tmmn, rmax, rmin, vs, pr, and lat/lon when it has several points.
+The issue time is taken from the file name, e.g. `gefs_2025071500.nc` (YYYYMMDDHH, UTC). The files are indexed by issue time, each
+file is opened once per worker, and the series of a grid cell is cached in the shared cache, so all the fields of a cell share one
+forecast load.
+
+The forecast days are appended to the observed weather with MorP = 'P' (pyfao56's measured or projected flag). The observed part is
+simulated (and cached) once per weather version up to the last observed day, and the model state of that day is kept. With a new
+forecast, only the forecast days are simulated, starting from that state (`checkpoint` and `resume` hook into `Model.run` of
+pyfao56 1.4), instead of the whole season. The resumed days keep the Kcb adjustments (K_adj) of the observed run, which are based
+on the observed days of the mid and late season windows only. The observed weather usually ends one or two days before the
+forecast starts: gaps of up to `FORECAST_MAX_GAP` days are interpolated (see `forecast_tail`), after a longer gap only the observed
+days are simulated.'''
+
+FORECAST_DIR = os.getenv('forecast_dir', 'forecast_storage')
+FORECAST_DAYS = 16  # Longest forecast horizon used
+FORECAST_MAX_GAP = 3  # Days between the observed weather and the forecast filled by interpolation
+FORECAST_TTL = 24 * 3600
+FORECAST_VARS = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+
+ISSUE_PATTERN = re.compile(r'_(\d{10})\.(nc|csv)$')
+
+
+def forecast_index(forecast_dir=None):
+    '''
+    Forecast files of the forecast directory by issue time.
+
+    Returns:
+    --------
+    dict
+        Issue time (pd.Timestamp, UTC) -> file path, in issue order. Empty when the directory does not exist.
+    '''
+    forecast_dir = forecast_dir or FORECAST_DIR
+    try:
+        mtime = os.stat(forecast_dir).st_mtime_ns
+    except OSError:
+        return {}
+    return _scan(forecast_dir, mtime)
+
+
+@lru_cache(maxsize=8)
+def _scan(forecast_dir, mtime):
+    # `mtime` is part of the key: adding or removing a file changes the directory mtime
+    files = {}
+    for entry in os.scandir(forecast_dir):
+        match = ISSUE_PATTERN.search(entry.name)
+        if match and entry.is_file():
+            files[pd.to_datetime(match.group(1), format='%Y%m%d%H', utc=True)] = entry.path
+    return dict(sorted(files.items()))
+
+
+def _utc(time):
+    time = pd.Timestamp(time)
+    return time.tz_localize('UTC') if time.tz is None else time.tz_convert('UTC')
+
+
+def latest_issue(now=None, forecast_dir=None):
+    '''Issue time of the latest forecast issued at or before `now` (default: current time), or None.'''
+    now = pd.Timestamp.now(tz='UTC') if now is None else _utc(now)
+    issues = [issue for issue in forecast_index(forecast_dir) if issue <= now]
+    return issues[-1] if issues else None
+
+
+@lru_cache(maxsize=4)
+def _open_forecast(path, mtime):
+    '''Opened forecast file (lazy xarray Dataset for NetCDF, DataFrame for CSV), shared by the fields of the worker.'''
+    if path.endswith('.nc'):
+        import xarray as xr
+
+        dataset = xr.open_dataset(path)
+        return dataset.rename({'time': 'day'}) if 'time' in dataset.dims else dataset
+    return pd.read_csv(path, parse_dates=['Date'])
+
+
+def _point_series(path, lat, lon):
+    '''Forecast series of the point nearest to (lat, lon), in gridMET units with the columns Date and `FORECAST_VARS`.'''
+    data = _open_forecast(path, os.path.getmtime(path))
+    if isinstance(data, pd.DataFrame):
+        if {'lat', 'lon'} <= set(data.columns):
+            distance = (data['lat'] - lat) ** 2 + (data['lon'] - lon) ** 2
+            point = data.loc[distance.idxmin(), ['lat', 'lon']]
+            data = data[(data['lat'] == point['lat']) & (data['lon'] == point['lon'])]
+        return data.reindex(columns=['Date'] + FORECAST_VARS).reset_index(drop=True)
+
+    point = data.sel(lat=lat, lon=lon, method='nearest')
+    columns = {var: point[var].to_numpy().astype('float64') if var in point else np.nan for var in FORECAST_VARS}
+    return pd.DataFrame({'Date': point['day'].to_numpy(), **columns})
+
+
+def load_forecast(lat, lon, issue=None, forecast_dir=None):
+    '''
+    Forecast weather of a location, in the layout and units of the weather store.
+
+    Parameters:
+    -----------
+    lat, lon : float
+        Location of the field.
+    issue : pd.Timestamp, optional
+        Issue time of the forecast. Defaults to the latest issued forecast.
+    forecast_dir : str, optional
+        Directory of the forecast files. Defaults to `FORECAST_DIR`.
+
+    Returns:
+    --------
+    tuple
+        (issue time, DataFrame with MorP = 'P'), or (None, None) when no forecast is available. Values outside
+        `VALID_RANGES` are missing; missing precipitation is 0.
+    '''
+    index = forecast_index(forecast_dir)
+    issue = latest_issue(forecast_dir=forecast_dir) if issue is None else _utc(issue)
+    if issue is None or issue not in index:
+        return None, None
+    path = index[issue]
+    cell_lat, cell_lon = WeatherDataFetcher.snap_to_grid(lat, lon)
+    key = f'forecast:{path}:{os.path.getmtime(path)}:{cell_lat}:{cell_lon}'
+
+    def compute():
+        data = _point_series(path, float(lat), float(lon))
+        data['Date'] = pd.to_datetime(data['Date']).dt.normalize()
+        data = WeatherDataFetcher.unit_conversion_pyfao56(data.dropna(subset=['Date']).astype(
+            dict.fromkeys(FORECAST_VARS, 'float64')))
+        for col, (low, high) in VALID_RANGES.items():
+            data[col] = data[col].where(data[col].between(low, high))
+        data['pr'] = data['pr'].fillna(0.0)
+        data['MorP'] = 'P'
+        return compact_weather(data.sort_values('Date').drop_duplicates('Date').reset_index(drop=True))
+
+    return issue, cache.get_or_compute(key, compute, ttl=FORECAST_TTL, name='forecast_cache')
+
+
+def forecast_tail(observed, forecast, days=FORECAST_DAYS, max_gap=FORECAST_MAX_GAP):
+    '''
+    Forecast days continuing the observed weather, one row per day from the day after the last observed day (at most `days`
+    days). pyfao56 needs a weather row for every simulated day, but gridMET runs one or two days behind, so a forecast issued
+    today starts after a gap. Gaps of at most `max_gap` days are filled by interpolating between the days around them (no rain
+    on the filled days); the tail stops before a longer gap, so it is empty when the forecast starts too late.
+
+    Returns:
+    --------
+    pd.DataFrame
+        The forecast days (MorP = 'P') in the compact weather schema (see main/schema.py).
+    '''
+    observed = compact_weather(observed)
+    last = observed['Date'].max()
+    forecast = compact_weather(forecast)
+    forecast = forecast[(forecast['Date'] > last) & (forecast['Date'] <= last + pd.Timedelta(days=days))].set_index('Date')
+    if forecast.empty:
+        return compact_weather(forecast.reset_index())
+
+    dates = pd.date_range(last + pd.Timedelta(days=1), forecast.index.max(), freq='D')
+    present = dates.isin(forecast.index)
+    missing = 0
+    for i, has_day in enumerate(present):
+        missing = 0 if has_day else missing + 1
+        if missing > max_gap:
+            dates, present = dates[:i - missing + 1], present[:i - missing + 1]
+            break
+    if not len(dates):
+        return compact_weather(forecast.iloc[:0].reset_index())
+
+    # The last observed day anchors the interpolation of a leading gap
+    anchor = observed.set_index('Date').loc[[last], FLOAT_COLUMNS]
+    values = pd.concat([anchor, forecast[FLOAT_COLUMNS]]).astype('float64')
+    values = values[~values.index.duplicated()].reindex(dates.insert(0, last))
+    tail = values.interpolate(method='time', limit_area='inside').iloc[1:]
+    tail['pr'] = tail['pr'].where(present, 0.0)
+    tail['MorP'] = 'P'
+    return compact_weather(tail.rename_axis('Date').reset_index())
+
+
+def extend_weather(observed, forecast, days=FORECAST_DAYS):
+    '''
+    Appends the forecast days after the last observed day (at most `days` days, short gaps filled, see `forecast_tail`).
+
+    Returns:
+    --------
+    pd.DataFrame
+        Observed weather followed by the forecast days (MorP = 'P'), in the compact weather schema (see main/schema.py).
+    '''
+    observed = compact_weather(observed)
+    tail = forecast_tail(observed, forecast, days)
+    return pd.concat([observed, tail.reindex(columns=observed.columns)], ignore_index=True)
+
+
+def checkpoint(mdl, day):
+    '''
+    Keeps the model state at the end of `day` (YYYY-DOY) during `mdl.run()`.
+
+    Returns:
+    --------
+    dict
+        Filled with the state (the attributes of pyfao56's ModelState) when the run reaches `day`, to be passed to `resume`.
+    '''
+    state = {}
+    index = (pd.to_datetime(day, format='%Y-%j') - pd.Timestamp(mdl.startDate)).days
+    advance = mdl._advance
+
+    def _advance(io):
+        advance(io)
+        if io.i == index:
+            state.update(copy.deepcopy(vars(io)))
+            state['i'] += 1  # Model.run increments the day counter after appending the output row
+    mdl._advance = _advance
+    return state
+
+
+class _RestoredState:
+    '''pyfao56 ModelState holding a saved state through the initialization part of `Model.run`.'''
+
+    def __init__(self, state, on_start):
+        self.__dict__.update(copy.deepcopy(state))
+        self.__dict__['_restoring'] = on_start
+
+    def __setattr__(self, name, value):
+        on_start = self.__dict__.get('_restoring')
+        if on_start is not None:
+            # Model.run initializes the state, then sets ETref first thing in the daily loop
+            if name != 'ETref':
+                return
+            self.__dict__['_restoring'] = None
+            on_start()
+        self.__dict__[name] = value
+
+
+def resume(mdl, state, odata):
+    '''
+    Makes `mdl.run()` continue a previous run of the same season from its checkpoint (see `checkpoint`) instead of starting at
+    planting. The days up to the checkpoint are not simulated again: the output rows `odata` of the previous run are kept and the
+    saved state is used from the next day.
+    '''
+    season_start = mdl.startDate
+    mdl.startDate = season_start + pd.Timedelta(days=state['i']).to_pytimedelta()
+
+    def on_start():
+        mdl.odata = odata.copy()
+        # Days since planting (auto irrigation and the seasonal summary) count from the season start again
+        mdl.startDate = season_start
+    mdl.ModelState = lambda: _RestoredState(state, on_start)
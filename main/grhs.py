@@ -1,6 +1,6 @@
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 import pandas as pd
+import numpy as np
+from main import metrics
 
 # Note: This function to generate the water balance plot is provided as a reference for the final project and need to make adjustments as needed. 
 
@@ -8,51 +8,47 @@ def dr_plot(df):
 
     # This dr_plot function is used to calculate the soil depletion and adjust it based on rain and irrigation events. Native pyfao56 provide daily depletion values considering every influx and efflux.
     # We made adjustments to the depletion calculation to show the effect of rain and irrigation on the soil depletion and is actually at a lag of one day.
-    df1 = df[['Dr','Rain','Irrig', "IrrLoss"]].copy().reset_index()
-
-    # Create a new DataFrame for tracking multiple points on the same day
-    plot_data = []
-
-    # Initialize variables
-    previous_row = None  # This will hold the previous day's row
-
-    for _, row in df1.iterrows():
-        day = row["index"]
-        try:
-            depletion = previous_row['Dr']  # Use the previously calculated depletion
-        except:
-            depletion = 0.
-
-        # Base depletion point
-        plot_data.append({"day": day, "value": depletion, "type": "depletion"})
-
-        # Adjusted depletion for rain
-        if row["Rain"] > 0:
-            depletion_after_rain = max(depletion - row["Rain"], 0)
-            plot_data.append({"day": day, "value": depletion_after_rain, "type": "hrain"})
-            depletion = depletion_after_rain  # Update depletion after rain
-
-        # Adjusted depletion for irrigation
-        if row["Irrig"] > 0:
-            depletion_after_irrigation = max(depletion - row["Irrig"] + row['IrrLoss'], 0)
-            plot_data.append({"day": day, "value": depletion_after_irrigation, "type": "irrigation"})
-            depletion = depletion_after_irrigation  # Update depletion after irrigation
-
-        # Store the current row as the previous row for the next iteration
-        previous_row = row
-
-    # Convert to a DataFrame
-    plot_df = pd.DataFrame(plot_data)
-
-    # Sort by day and type to ensure correct plotting order
+    # Each day contributes up to three points: the previous day's depletion, the depletion after rain (if any) and the depletion
+    # after irrigation (if any). These are computed for all days at once with shifted arrays and masks instead of looping over rows.
+    days = df.index.to_numpy()
+    dr = df['Dr'].to_numpy(dtype=float)
+    rain = df['Rain'].to_numpy(dtype=float)
+    irrig = df['Irrig'].to_numpy(dtype=float)
+    irr_loss = df['IrrLoss'].to_numpy(dtype=float)
+
+    # Base depletion point is the previously calculated depletion (0 on the first day)
+    depletion = np.concatenate(([0.], dr[:-1]))
+
+    # Adjusted depletion for rain, then for irrigation
+    rain_mask = rain > 0
+    depletion_after_rain = np.where(rain_mask, np.maximum(depletion - rain, 0), depletion)
+    irrig_mask = irrig > 0
+    depletion_after_irrigation = np.maximum(depletion_after_rain - irrig + irr_loss, 0)
+
+    # Interleave the three candidate points of each day and keep the ones that occurred
+    keep = np.column_stack((np.ones(len(days), dtype=bool), rain_mask, irrig_mask)).ravel()
+    plot_df = pd.DataFrame({
+        "day": np.repeat(days, 3)[keep],
+        "value": np.column_stack((depletion, depletion_after_rain, depletion_after_irrigation)).ravel()[keep],
+        "type": np.tile(np.array(["depletion", "hrain", "irrigation"], dtype=object), len(days))[keep],
+    })
+
+    # Points are already ordered by day and type when the days are sorted and unique, as they are in pyfao56 output
     #Although could simply define single depletion variable but this is to show the process of depletion calculation
-    return plot_df.sort_values(by=["day", "type"])
+    if not (df.index.is_monotonic_increasing and df.index.is_unique):
+        plot_df = plot_df.sort_values(by=["day", "type"], kind="stable")
+    return plot_df
 
 
+@metrics.timed('wb_plot_interactive')
 def wb_plot_interactive(results, save_plot=False, plot_name="wb_plot.html"):
     """
     Creates an interactive Plotly plot for water balance components and optionally saves the plot as HTML.
     """
+    # plotly is imported on first use to keep it out of the worker boot time
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
     dr_df = dr_plot(results)
 
     # Create subplots with secondary y-axes where needed
@@ -137,3 +133,90 @@ def wb_plot_interactive(results, save_plot=False, plot_name="wb_plot.html"):
 
     # Return raw HTML string for embedding
     return fig.to_html(full_html=False)
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of at most `threshold` points that preserve the visual shape of the series (peaks, troughs and steps),
+    always keeping the first and the last point.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Buckets between the fixed first and last points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point for the final bucket)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        # Point of this bucket forming the largest triangle with the previous selected point and the next average
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.nanargmax(area)) if np.any(~np.isnan(area)) else lo
+        selected[i + 1] = a
+
+    return selected
+
+
+@metrics.timed('wb_plot_payload')
+def wb_plot_payload(results, max_points=1000):
+    """
+    Builds a compact columnar JSON payload of the water balance components for client-side rendering.
+
+    Days are sent once in `index`; every series refers to positions in it. Line series (and the depletion trace) are downsampled with
+    LTTB when they exceed `max_points`, and bar series are sent sparse (non-zero days only).
+    """
+    dr_df = dr_plot(results)
+    index = results.index.to_list()
+    positions = np.arange(len(index))
+
+    def line(y, x=positions, day_index=None):
+        y = np.asarray(y, dtype=float)
+        keep = lttb(x, y, max_points) if len(y) > max_points else None
+        day_index = positions if day_index is None else day_index
+        values = y if keep is None else y[keep]
+        series = {'y': np.round(values, 3).tolist()}
+        if keep is not None or day_index is not positions:
+            series['i'] = (day_index if keep is None else day_index[keep]).tolist()
+        return series
+
+    def bar(y):
+        y = np.asarray(y, dtype=float)
+        nonzero = np.flatnonzero(y)
+        return {'i': nonzero.tolist(), 'y': np.round(y[nonzero], 3).tolist()}
+
+    # The depletion trace has several points per day, so it is downsampled in point order
+    dr_days = pd.Index(index).get_indexer(dr_df['day'])
+
+    payload = {
+        'index': index,
+        'n': len(index),
+        'downsampled': len(dr_df) > max_points,
+        'lines': {
+            'ETc': line(results['ETc']),
+            'ETa': line(results['ETa']),
+            'Ks': line(results['Ks']),
+            'TAW': line(results['TAW']),
+            'RAW': line(results['RAW']),
+            'Dr': line(dr_df['value'], x=np.arange(len(dr_df)), day_index=dr_days),
+        },
+        'bars': {
+            'Rain': bar(results['Rain']),
+            'Irrig': bar(results['Irrig'] - results['IrrLoss']),
+            'Runoff': bar(results['Runoff']),
+            'DP': bar(results['DP']),
+        },
+    }
+    # NaN is not valid JSON
+    for series in list(payload['lines'].values()) + list(payload['bars'].values()):
+        series['y'] = [None if v != v else v for v in series['y']]
+    return payload
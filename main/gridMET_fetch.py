@@ -1,13 +1,43 @@
+import importlib.util
+import os
+import tracemalloc
+import numpy as np
 import pandas as pd
-import xarray as xr
+from main import metrics
+from main.schema import compact_weather
 
 '''Note: This class was initially made for general purpose to fetch weather data from gridMET dataset for any location and variables. There are various methods to extract data for a single year, multiple years,
 specific date range, and specific date range across multiple years. The unit conversion methods are also provided to convert the units of the fetched data. The unit conversion method for pyfao56 is also provided.
 These unit conversion methods are introduced as static methods. The unit conversion method for pyfao56 also adds additional columns to the DataFrame otherwise pyfao56 throws an error. The weather class in pyfao56 expects
-these additional columns. In general pyfao56 expects a .wth file for weather parmeters but we are custom loading the data in pyfao56.'''
+these additional columns. In general pyfao56 expects a .wth file for weather parmeters but we are custom loading the data in pyfao56.
+
+In the lazy mode (default, `gridmet_lazy=on` in the .env file) a yearly file is opened without reading any data, only the data
+variable of the cell is selected, and its values are read `gridmet_time_chunk` days at a time straight into a float32 array. The
+eager mode (`gridmet_lazy=off`) converts the selection with `to_dataframe()`, which also materializes the lat/lon coordinate columns
+that are discarded afterwards. When dask is installed, the files are opened with dask chunks of `gridmet_time_chunk` days by
+`gridmet_space_chunk` cells. The bytes read (in the dtype stored in the file) and optionally the peak Python memory of a fetch are
+kept in `stats`, to size the worker memory for large batches.'''
+
+# THREDDS OPeNDAP root of the gridMET yearly files. It can point to a local mirror (or a directory of NetCDF files) through the .env file.
+GRIDMET_URL = os.getenv('gridmet_url', 'http://thredds.northwestknowledge.net:8080/thredds/dodsC/MET')
+
+# gridMET grid (1/24 degree): center of the north-west cell
+GRIDMET_RES = 1 / 24
+GRIDMET_LAT0 = 49.4
+GRIDMET_LON0 = -124.76666666666667
+
+# Lazy chunked reads (see the note above)
+GRIDMET_LAZY = os.getenv('gridmet_lazy', 'on').lower() in ('1', 'on', 'true', 'yes')
+GRIDMET_TIME_CHUNK = int(os.getenv('gridmet_time_chunk', 366))
+GRIDMET_SPACE_CHUNK = int(os.getenv('gridmet_space_chunk', 32))
+
+# Cached yearly data of the current year is refreshed as new days are published; past years rarely change
+CURRENT_YEAR_TTL = 6 * 3600
+PAST_YEAR_TTL = 30 * 24 * 3600
 
 class WeatherDataFetcher:
-    def __init__(self, lat, lon, variables):
+    def __init__(self, lat, lon, variables, base_url=None, cache=None, lazy=None, time_chunk=None, space_chunk=None,
+                 measure_memory=False):
         """
         Initializes the WeatherDataFetcher with location and variables.
 
@@ -15,10 +45,77 @@ class WeatherDataFetcher:
         lat (float): Latitude of the location.
         lon (float): Longitude of the location.
         variables (list): List of variables to fetch.
+        base_url (str): Root of the gridMET files, laid out as <base_url>/<var>/<var>_<year>.nc. Defaults to `GRIDMET_URL`.
+        cache (SharedCache): Optional cache shared by the workers (see `main/shared_cache.py`). Yearly data is then fetched once per
+            grid cell and year, whatever the exact coordinates of the requests in that cell.
+        lazy (bool): Read the selected values in chunks into float32 arrays instead of `to_dataframe()`. Defaults to `GRIDMET_LAZY`.
+        time_chunk (int): Days per read (and per dask chunk) in the lazy mode. Defaults to `GRIDMET_TIME_CHUNK`.
+        space_chunk (int): Cells per dask chunk along lat and lon, only used when dask is installed. Defaults to `GRIDMET_SPACE_CHUNK`.
+        measure_memory (bool): Also record the peak Python memory of each fetch in `stats` (tracemalloc, slows the fetch down).
         """
         self.lat = lat
         self.lon = lon
         self.variables = variables
+        self.base_url = base_url or GRIDMET_URL
+        self.cache = cache
+        self.lazy = GRIDMET_LAZY if lazy is None else lazy
+        self.time_chunk = time_chunk or GRIDMET_TIME_CHUNK
+        self.space_chunk = space_chunk or GRIDMET_SPACE_CHUNK
+        self.measure_memory = measure_memory
+        # Bytes read from the files (0 for cached years), values read and peak Python memory (bytes) of the fetches
+        self.stats = {'bytes_read': 0, 'values_read': 0, 'peak_memory': None}
+
+    @staticmethod
+    def snap_to_grid(lat, lon):
+        """
+        Snaps a location to the center of its gridMET cell.
+
+        Args:
+        lat (float): Latitude of the location.
+        lon (float): Longitude of the location.
+
+        Returns:
+        tuple: (lat, lon) of the cell center, rounded to 5 decimals.
+        """
+        row = round((GRIDMET_LAT0 - float(lat)) / GRIDMET_RES)
+        col = round((float(lon) - GRIDMET_LON0) / GRIDMET_RES)
+        return round(GRIDMET_LAT0 - row * GRIDMET_RES, 5), round(GRIDMET_LON0 + col * GRIDMET_RES, 5)
+
+    @staticmethod
+    def data_variable(dataset):
+        """
+        The (time, lat, lon) data variable of a gridMET file, with the time dimension named 'day'.
+
+        Args:
+        dataset (xr.Dataset): Opened gridMET file.
+
+        Returns:
+        xr.DataArray: Lazy data variable (nothing is read yet).
+        """
+        name = next(name for name, da in dataset.data_vars.items() if da.ndim == 3)
+        da = dataset[name]
+        return da.rename({'time': 'day'}) if 'time' in da.dims else da
+
+    def fetch_yearly_data_cached(self, year):
+        """
+        Fetches weather data for the specified year through the shared cache (single download per grid cell and year).
+
+        Args:
+        year (int): Year of the dataset.
+
+        Returns:
+        pd.DataFrame: Consolidated dataframe for the year.
+        """
+        if self.cache is None:
+            return self.fetch_yearly_data(year)
+        ttl = CURRENT_YEAR_TTL if year >= pd.Timestamp.now().year else PAST_YEAR_TTL
+        return self.cache.get_or_compute(self.yearly_cache_key(year), lambda: self.fetch_yearly_data(year), ttl=ttl,
+                                         name='weather_cache')
+
+    def yearly_cache_key(self, year):
+        """Key of the yearly data of the grid cell in the shared cache."""
+        cell_lat, cell_lon = self.snap_to_grid(self.lat, self.lon)
+        return f"gridmet:{self.base_url}:{cell_lat}:{cell_lon}:{year}:{','.join(self.variables)}"
 
     def fetch_yearly_data(self, year):
         """
@@ -30,9 +127,14 @@ class WeatherDataFetcher:
         Returns:
         pd.DataFrame: Consolidated dataframe for the year.
         """
+        if self.lazy:
+            return self.fetch_yearly_data_lazy(year)
+
+        import xarray as xr  # Imported on first use; xarray and its backends are slow to import
+
         all_data = []
         for var in self.variables:
-            url = f'http://thredds.northwestknowledge.net:8080/thredds/dodsC/MET/{var}/{var}_{year}.nc'
+            url = f'{self.base_url}/{var}/{var}_{year}.nc'
             dataset = xr.open_dataset(url)
             data = dataset.sel(lat=self.lat, lon=self.lon, method="nearest")
             df = data.to_dataframe().reset_index()
@@ -40,10 +142,16 @@ class WeatherDataFetcher:
             if 'time' in df.columns:
                 df.rename(columns={'time': 'day'}, inplace=True)
 
-            var_column = df.columns[-1]
+            # The scalar lat/lon coordinates of the selection can come after the data variable in the columns
+            var_column = self.data_variable(dataset).name
             df = df[['day', var_column]]
             df.rename(columns={'day': 'Date', var_column: var}, inplace=True)  # Rename data column to var name
 
+            stored = np.dtype(dataset[var_column].encoding.get('dtype', dataset[var_column].dtype))
+            self.stats['bytes_read'] += len(df) * stored.itemsize
+            self.stats['values_read'] += len(df)
+            metrics.add_bytes('fetch_gridmet', len(df) * stored.itemsize, 'read')
+
             all_data.append(df)
 
         # Merge all variables into one DataFrame
@@ -53,6 +161,48 @@ class WeatherDataFetcher:
 
         return consolidated_df
 
+    def fetch_yearly_data_lazy(self, year):
+        """
+        Fetches weather data for the specified year, reading only the values of the cell in chunks of `time_chunk` days.
+
+        Args:
+        year (int): Year of the dataset.
+
+        Returns:
+        pd.DataFrame: 'Date' and one float32 column per variable.
+        """
+        import xarray as xr  # Imported on first use; xarray and its backends are slow to import
+
+        chunks = None
+        if importlib.util.find_spec('dask') is not None:
+            chunks = {'day': self.time_chunk, 'time': self.time_chunk, 'lat': self.space_chunk, 'lon': self.space_chunk}
+
+        columns = {}
+        dates = None
+        for var in self.variables:
+            url = f'{self.base_url}/{var}/{var}_{year}.nc'
+            with xr.open_dataset(url) as dataset:
+                if chunks is not None:
+                    dataset = dataset.chunk({dim: size for dim, size in chunks.items() if dim in dataset.dims})
+                point = self.data_variable(dataset).sel(lat=self.lat, lon=self.lon, method='nearest')
+                days = point.sizes['day']
+                values = np.empty(days, dtype=np.float32)
+                for start in range(0, days, self.time_chunk):
+                    values[start:start + self.time_chunk] = point.isel(day=slice(start, start + self.time_chunk)).to_numpy()
+                if dates is None:
+                    dates = point['day'].to_numpy()
+                elif len(dates) != days or (dates != point['day'].to_numpy()).any():
+                    # Files of a year should share the same days; otherwise align on the dates like the eager mode
+                    values = pd.Series(values, index=point['day'].to_numpy()).reindex(dates).to_numpy(dtype=np.float32)
+
+                stored = np.dtype(point.encoding.get('dtype', point.dtype))
+                self.stats['bytes_read'] += days * stored.itemsize
+                self.stats['values_read'] += days
+                metrics.add_bytes('fetch_gridmet', days * stored.itemsize, 'read')
+            columns[var] = values
+
+        return pd.DataFrame({'Date': dates, **columns})
+
     def fetch_data_for_years(self, years):
         """
         Fetches weather data for multiple years.
@@ -63,7 +213,16 @@ class WeatherDataFetcher:
         Returns:
         pd.DataFrame: Consolidated dataframe for all years.
         """
-        all_years_data = [self.fetch_yearly_data(year) for year in years]
+        tracing = self.measure_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            all_years_data = [self.fetch_yearly_data_cached(year) for year in years]
+        finally:
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.stats['peak_memory'] = max(self.stats['peak_memory'] or 0, peak)
         consolidated_df = pd.concat(all_years_data, ignore_index=True)
         consolidated_df.sort_values(by='Date', inplace=True)
         return consolidated_df
@@ -115,7 +274,7 @@ class WeatherDataFetcher:
         all_years_data = []
 
         for year in years:
-            data = self.fetch_yearly_data(year)
+            data = self.fetch_yearly_data_cached(year)
             data['Date'] = pd.to_datetime(data['Date'])
             start_date_year = pd.to_datetime(f'{year}-{st_month:02d}-{st_day:02d}')
             end_date_year = pd.to_datetime(f'{year}-{en_month:02d}-{en_day:02d}')
@@ -124,6 +283,12 @@ class WeatherDataFetcher:
 
         return pd.concat(all_years_data, ignore_index=True)
 
+    @staticmethod
+    def _as_float64(df):
+        # Lazy fetches return float32 columns; converting in float64 keeps the rounded values exact (25.123, not 25.12299919)
+        float32 = df.select_dtypes('float32').columns
+        return df.astype(dict.fromkeys(float32, 'float64')) if len(float32) else df
+
     @staticmethod
     def unit_conversion(df):
         """
@@ -135,6 +300,7 @@ class WeatherDataFetcher:
         Returns:
         pd.DataFrame: Converted DataFrame.
         """
+        df = WeatherDataFetcher._as_float64(df)
         df['srad'] *= 0.0864
         df['tmmx'] -= 273.15
         df['tmmn'] -= 273.15
@@ -143,19 +309,16 @@ class WeatherDataFetcher:
     @staticmethod
     def unit_conversion_pyfao56(df):
         """
-        Applies unit conversion and adds additional placeholder columns.
+        Applies unit conversion and adds the columns computed by pyfao56 (vpar, tdew, ET) as missing values.
 
         Args:
         df (pd.DataFrame): DataFrame to apply conversions to.
 
         Returns:
-        pd.DataFrame: Converted DataFrame with additional columns.
+        pd.DataFrame: Converted DataFrame in the compact weather schema (see `main/schema.py`), with the other columns kept.
         """
+        df = WeatherDataFetcher._as_float64(df)
         df['srad'] *= 0.0864
         df['tmmx'] -= 273.15
         df['tmmn'] -= 273.15
-        df.insert(4, 'vpar', '')
-        df.insert(5, 'tdew', '')
-        df.insert(10, 'ET', '')
-        df.insert(11, 'MorP', '')
-        return df.round(3)
+        return compact_weather(df.round(3))
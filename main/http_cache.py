@@ -0,0 +1,166 @@
+import gzip
+import hashlib
+import importlib.util
+import mimetypes
+import os
+import sys
+from functools import lru_cache, wraps
+from flask import Response, current_app, make_response, request
+from werkzeug.security import safe_join
+from werkzeug.exceptions import NotFound
+
+'''Note: Compression and HTTP caching of the app's responses. Pages, JSON payloads and scripts were sent uncompressed and without
+validators, so every view of the results downloaded the whole page again, which is slow on rural connections.
+- Responses are compressed with brotli (when the optional `brotli` package is installed) or gzip, depending on the Accept-Encoding
+  header of the client. Only text types larger than `MIN_COMPRESS_BYTES` are compressed; streamed downloads are sent as is (the
+  CSV download has its own csv.gz format).
+- Static files (the app's static folder and plotly.js) are compressed once per file version and kept in memory. Their URLs carry
+  the file version (`?v=`), so they are served with a one year `max-age` and browsers only download them again after a change.
+- Pages derived from a simulation get an ETag built from the hash of the simulation inputs and weather version (see `conditional`).
+  A browser revalidating a page it has already seen gets a 304 Not Modified before anything is simulated or rendered.'''
+
+MIN_COMPRESS_BYTES = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5         # Dynamic responses: fast
+BROTLI_STATIC_QUALITY = 11  # Static files are compressed once
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript',
+                      'text/javascript', 'image/svg+xml'}
+
+HAS_BROTLI = importlib.util.find_spec('brotli') is not None
+
+
+def init_http_cache(app):
+    '''Registers the compression hook on the app and serves its static folder through `send_static`.'''
+    static_folder = app.static_folder
+    app.view_functions['static'] = lambda filename: send_static(safe_join(static_folder, filename))
+    app.url_defaults(_static_version)
+    app.after_request(compress_response)
+
+
+def _static_version(endpoint, values):
+    '''Adds the file version to the URLs of static files, so they can be cached for a year.'''
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        path = safe_join(current_app.static_folder, values['filename'])
+        if path and os.path.isfile(path):
+            values['v'] = int(os.stat(path).st_mtime)
+
+
+def accepted_encoding():
+    '''Best content coding accepted by the client: 'br', 'gzip' or None.'''
+    encodings = request.accept_encodings
+    if HAS_BROTLI and encodings.quality('br') > 0:
+        return 'br'
+    if encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, static=False):
+    '''Compresses `data` (bytes) with the content coding `encoding` ('br' or 'gzip').'''
+    if encoding == 'br':
+        import brotli
+
+        return brotli.compress(data, quality=BROTLI_STATIC_QUALITY if static else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if static else GZIP_LEVEL, mtime=0)
+
+
+def compress_response(response):
+    '''after_request hook: compresses text responses for clients that accept it.'''
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@lru_cache(maxsize=32)
+def _static_body(path, mtime, encoding):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return compress(data, encoding, static=True) if encoding else data
+
+
+def send_static(path, mimetype=None, max_age=STATIC_MAX_AGE):
+    '''
+    Serves a static file, compressed once per file version and encoding, with a long-lived `max-age` and an ETag.
+
+    Parameters:
+    -----------
+    path : str
+        Path of the file. A missing file (or None, from `safe_join`) gives a 404.
+    mimetype : str, optional
+        Content type. Guessed from the file name by default.
+    max_age : int
+        Lifetime in browser caches (seconds). The URL of the file must change with its content (e.g. `?v=`).
+    '''
+    if not path or not os.path.isfile(path):
+        raise NotFound()
+    stat = os.stat(path)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encoding = accepted_encoding() if mimetype in COMPRESSIBLE_TYPES and stat.st_size >= MIN_COMPRESS_BYTES else None
+    etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}-{encoding or "identity"}'
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(_static_body(path, stat.st_mtime_ns, encoding), mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@lru_cache(maxsize=None)
+def _code_version(module, root_path):
+    '''Latest modification time of the view's module and of the app's templates.'''
+    paths = [sys.modules[module].__file__]
+    templates = os.path.join(root_path, 'templates')
+    if os.path.isdir(templates):
+        paths += [entry.path for entry in os.scandir(templates) if entry.is_file()]
+    return max(os.stat(path).st_mtime_ns for path in paths)
+
+
+def conditional(etag_of):
+    '''
+    Decorator adding ETag validation to a view whose output only depends on what `etag_of()` hashes.
+
+    `etag_of` returns the parts identifying the response (e.g. the hash of the simulation inputs), or None when the response
+    cannot be validated (missing inputs, pending flash messages). A request whose If-None-Match matches gets a 304 without
+    calling the view. Responses are private (they depend on the session) and revalidated on every view.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            parts = etag_of()
+            if parts is None:
+                return view(*args, **kwargs)
+            # The code and templates are part of the tag, so a deployment invalidates the cached pages
+            version = _code_version(view.__module__, current_app.root_path)
+            etag = hashlib.sha256(repr((request.full_path, parts, version)).encode()).hexdigest()[:32]
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            # Weak: the compressed and uncompressed bodies are equivalent
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+from main.schema import compact_weather
+from main.utils import save_weather_data
+
+'''Note: Ingestion of uploaded weather files (CSV or XLSX). The upload used to be read whole by pandas in the request, checked for
+column presence only, renamed positionally and stored as is, leaving the type conversion to `simulate_model` on every run. Large
+multi-year station files are now read in chunks (pandas chunks for CSV, openpyxl read-only streaming for XLSX), and each chunk is
+typed and checked with vectorized operations:
+- columns are matched by name (case and surrounding spaces ignored), whatever their order in the file,
+- dates are parsed once; rows with invalid or duplicate dates are dropped,
+- values that are not numbers or are outside `VALID_RANGES` are set to NaN (they are counted in the report).
+The typed result is then written to the weather store, so the JSON file only holds numbers (null for missing values).'''
+
+REQUIRED_COLUMNS = ['Date', 'srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+VALUE_COLUMNS = REQUIRED_COLUMNS[1:]
+
+# Plausible ranges of daily values in pyfao56 units (MJ/m2, C, %, m/s, mm)
+VALID_RANGES = {
+    'srad': (0, 45),
+    'tmmx': (-50, 60),
+    'tmmn': (-60, 50),
+    'rmax': (0, 100),
+    'rmin': (0, 100),
+    'vs': (0, 40),
+    'pr': (0, 500),
+}
+
+CHUNK_ROWS = 50000
+
+
+class IngestError(ValueError):
+    '''Raised when an uploaded weather file cannot be used (format, columns or no valid rows).'''
+
+
+def read_chunks(file, filename, chunk_rows=CHUNK_ROWS):
+    '''
+    Reads an uploaded weather file in chunks of rows.
+
+    Parameters:
+    -----------
+    file : file-like
+        Uploaded file (werkzeug FileStorage or any binary file object).
+    filename : str
+        Name of the file, its extension selects the reader (.csv or .xlsx).
+    chunk_rows : int
+        Rows per chunk.
+
+    Returns:
+    --------
+    generator
+        DataFrames of at most `chunk_rows` rows with the columns of the file.
+    '''
+    name = filename.lower()
+    if name.endswith('.csv'):
+        yield from pd.read_csv(file, chunksize=chunk_rows)
+    elif name.endswith('.xlsx'):
+        from openpyxl import load_workbook
+
+        # Read-only mode streams the rows instead of loading the whole workbook
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(col) if col is not None else '' for col in next(rows, [])]
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_rows:
+                    yield pd.DataFrame(chunk, columns=header)
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=header)
+        finally:
+            workbook.close()
+    else:
+        raise IngestError('Invalid file format. Please upload a CSV or Excel file.')
+
+
+def column_map(columns):
+    '''
+    Maps the columns of a file to `REQUIRED_COLUMNS` by name (case-insensitive).
+
+    Returns:
+    --------
+    dict
+        File column -> required column. Raises `IngestError` when a required column is missing.
+    '''
+    lookup = {str(col).strip().lower(): col for col in columns}
+    missing = [col for col in REQUIRED_COLUMNS if col.lower() not in lookup]
+    if missing:
+        raise IngestError(f"Missing required columns: {', '.join(missing)}")
+    return {lookup[col.lower()]: col for col in REQUIRED_COLUMNS}
+
+
+def type_chunk(chunk, mapping, report):
+    '''
+    Types and checks one chunk (vectorized). Counts of dropped rows and rejected values are added to `report`.
+
+    Returns:
+    --------
+    pd.DataFrame
+        'Date' as datetime64 and the value columns as float64, invalid values as NaN.
+    '''
+    chunk = chunk[list(mapping)].rename(columns=mapping)
+    typed = pd.DataFrame({'Date': pd.to_datetime(chunk['Date'], errors='coerce')})
+    for col in VALUE_COLUMNS:
+        values = pd.to_numeric(chunk[col], errors='coerce').to_numpy(dtype='float64')
+        low, high = VALID_RANGES[col]
+        out_of_range = (values < low) | (values > high)
+        report['non_numeric'][col] += int((np.isnan(values) & chunk[col].notna().to_numpy()).sum())
+        report['out_of_range'][col] += int(out_of_range.sum())
+        typed[col] = np.where(out_of_range, np.nan, values)
+
+    valid_dates = typed['Date'].notna()
+    report['rows_read'] += len(typed)
+    report['invalid_dates'] += int((~valid_dates).sum())
+    return typed[valid_dates]
+
+
+def ingest_weather(file, filename, lat, lon, planting_date=None, maturity_date=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Reads, types and checks an uploaded weather file and writes it to the weather store of the location.
+
+    Parameters:
+    -----------
+    file : file-like
+        Uploaded CSV or XLSX file with the columns of `REQUIRED_COLUMNS` (pyfao56 units).
+    filename : str
+        Name of the uploaded file.
+    lat, lon : str
+        Location of the weather store file.
+    planting_date, maturity_date : str or datetime, optional
+        Season of the simulation, used to report the days of the season missing in the file.
+
+    Returns:
+    --------
+    dict
+        Ingestion report: rows_read, rows_stored, invalid_dates, duplicate_dates, non_numeric and out_of_range (per
+        column), tmax_below_tmin (days) and season_missing_days.
+    '''
+    report = {
+        'rows_read': 0, 'rows_stored': 0, 'invalid_dates': 0, 'duplicate_dates': 0,
+        'non_numeric': dict.fromkeys(VALUE_COLUMNS, 0), 'out_of_range': dict.fromkeys(VALUE_COLUMNS, 0),
+        'tmax_below_tmin': 0, 'season_missing_days': None,
+    }
+
+    mapping = None
+    chunks = []
+    for chunk in read_chunks(file, filename, chunk_rows):
+        if mapping is None:
+            mapping = column_map(chunk.columns)
+        chunks.append(type_chunk(chunk, mapping, report))
+    if not chunks or not sum(len(chunk) for chunk in chunks):
+        raise IngestError('The file has no rows with a valid date.')
+
+    data = pd.concat(chunks, ignore_index=True).sort_values('Date', kind='stable')
+    duplicated = data['Date'].duplicated(keep='first')
+    report['duplicate_dates'] = int(duplicated.sum())
+    data = data[~duplicated].reset_index(drop=True)
+    report['tmax_below_tmin'] = int((data['tmmx'] < data['tmmn']).sum())
+    report['rows_stored'] = len(data)
+
+    if planting_date is not None and maturity_date is not None:
+        season = pd.date_range(pd.to_datetime(planting_date), pd.to_datetime(maturity_date), freq='D')
+        report['season_missing_days'] = int((~season.isin(data['Date'])).sum())
+
+    # Layout of the weather store (see `save_weather_data`): vpar, tdew and ET are computed by pyfao56 and stay missing
+    save_weather_data(lat, lon, compact_weather(data))
+    return report
+
+
+def report_summary(report):
+    '''
+    Short text summary of the problems found by `ingest_weather`, or an empty string when there are none.
+    '''
+    issues = []
+    for key, label in (('invalid_dates', 'rows with invalid dates dropped'),
+                       ('duplicate_dates', 'duplicate dates dropped'),
+                       ('tmax_below_tmin', 'days with tmmx below tmmn')):
+        if report[key]:
+            issues.append(f'{report[key]} {label}')
+    for key, label in (('non_numeric', 'non-numeric'), ('out_of_range', 'out of range')):
+        counts = [f'{col}: {n}' for col, n in report[key].items() if n]
+        if counts:
+            issues.append(f"{label} values removed ({', '.join(counts)})")
+    if report['season_missing_days']:
+        issues.append(f"{report['season_missing_days']} days of the season missing")
+    return '; '.join(issues)
@@ -0,0 +1,243 @@
+import atexit
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+'''Note: Lightweight per-stage instrumentation (THREDDS fetch, weather JSON load/save, simulation and plotting). It records latency
+histograms, bytes transferred and cache hits/misses per stage, and renders them in the Prometheus text format for the `/metrics`
+endpoint. It is enabled with `metrics_enabled=on` in the .env file. When it is off, `timed` returns the function unchanged and the
+other recorders return immediately, so the instrumented code runs as before. Only the standard library is used here so that
+importing it does not add to the worker boot time.
+
+The endpoint requires the `metrics_token` setting (the admin `profile_token` by default) as a bearer token
+(`Authorization: Bearer <token>`, e.g. Prometheus' `bearer_token`) or in the `X-Admin-Token` header. Behind a reverse proxy every
+request comes from 127.0.0.1, so the client address cannot be trusted.
+
+The app runs under several worker processes (plus the API and scheduler pools), and a scrape reaches only one of them. Each
+process therefore writes a snapshot of its counters to a JSON file in `metrics_dir` (at most every `FLUSH_SECONDS`, and when it
+exits), and `render_prometheus` sums the snapshots of all processes. The files of finished processes are kept so the counters
+never go backwards; clear the directory when the app is deployed, like Prometheus' multiprocess directory.'''
+
+METRICS_ENABLED = os.getenv('metrics_enabled', 'off').lower() in ('1', 'on', 'true', 'yes')
+METRICS_TOKEN = os.getenv('metrics_token') or os.getenv('profile_token')
+METRICS_DIR = os.getenv('metrics_dir', os.path.join('cache', 'metrics'))
+FLUSH_SECONDS = 1.0
+
+# Latency histogram buckets in seconds (simulation and THREDDS fetches take seconds, JSON and plots milliseconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+_bytes = {}  # (stage, direction) -> bytes
+_cache = {}  # (cache, result) -> count
+_flights = {}  # (flight group, role) -> count
+_process = {'pid': None, 'file': None, 'flushed': 0.0, 'dirty': False}
+
+
+def _reset_after_fork():
+    '''A forked child starts from empty counters: the parent's are already in the parent's snapshot.'''
+    global _lock
+    _lock = threading.Lock()
+    for counters in (_histograms, _bytes, _cache, _flights):
+        counters.clear()
+    _process.update(pid=None, file=None, flushed=0.0, dirty=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _snapshot_file():
+    '''Snapshot file of this process, named after its pid and a random suffix so a reused pid does not overwrite it.'''
+    if _process['pid'] != os.getpid():
+        _process.update(pid=os.getpid(), file=os.path.join(METRICS_DIR, f'{os.getpid()}-{os.urandom(4).hex()}.json'))
+        atexit.register(_flush)
+        # multiprocessing children leave through os._exit, which skips atexit
+        from multiprocessing import util
+        util.Finalize(None, _flush, exitpriority=0)
+    return _process['file']
+
+
+def _flush():
+    '''Writes the counters of this process to its snapshot file.'''
+    with _lock:
+        if not _process['dirty']:
+            return
+        snapshot = {
+            'histograms': _histograms,
+            'bytes': [[*key, value] for key, value in _bytes.items()],
+            'cache': [[*key, value] for key, value in _cache.items()],
+            'flights': [[*key, value] for key, value in _flights.items()],
+        }
+        text = json.dumps(snapshot)
+        _process.update(flushed=time.monotonic(), dirty=False)
+    path = _snapshot_file()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        _process['dirty'] = True  # Try again on the next event
+
+
+def _recorded():
+    '''Marks the counters as changed (the caller holds `_lock`) and tells whether the snapshot is due.'''
+    _process['dirty'] = True
+    return time.monotonic() - _process['flushed'] >= FLUSH_SECONDS
+
+
+def authorized(authorization, admin_token=None):
+    '''
+    True when a request may read the metrics: the metrics are enabled, a token is configured and the request gives it in its
+    `Authorization: Bearer` header value (`authorization`) or its `X-Admin-Token` header value (`admin_token`).
+    '''
+    if not METRICS_ENABLED or not METRICS_TOKEN:
+        return False
+    scheme, _, token = (authorization or '').partition(' ')
+    token = token.strip() if scheme.lower() == 'bearer' else admin_token or ''
+    return hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+
+def observe(stage, seconds):
+    '''Records one latency observation (in seconds) for a stage.'''
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        hist = _histograms.setdefault(stage, [0] * (len(BUCKETS) + 1) + [0.0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+        hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+        due = _recorded()
+    if due:
+        _flush()
+
+
+def add_bytes(stage, nbytes, direction='read'):
+    '''Adds bytes read or written by a stage.'''
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _bytes[(stage, direction)] = _bytes.get((stage, direction), 0) + int(nbytes)
+        due = _recorded()
+    if due:
+        _flush()
+
+
+def cache_event(cache, hit):
+    '''Counts a hit or a miss of a cache.'''
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        key = (cache, 'hit' if hit else 'miss')
+        _cache[key] = _cache.get(key, 0) + 1
+        due = _recorded()
+    if due:
+        _flush()
+
+
+def flight_event(group, role):
+    '''Counts a call of a single-flight group by role: 'leader' (ran the call), 'coalesced' (shared it) or 'error'.'''
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _flights[(group, role)] = _flights.get((group, role), 0) + 1
+        due = _recorded()
+    if due:
+        _flush()
+
+
+def timed(stage):
+    '''
+    Decorator recording the latency of every call of the decorated function under `stage`.
+
+    When metrics are disabled the function is returned unchanged, so there is no overhead at all.
+    '''
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def render_prometheus():
+    '''
+    Renders the metrics of all processes, summed from their snapshot files, in the Prometheus text exposition format
+    (version 0.0.4).
+
+    Returns:
+    --------
+    str
+        Metrics text, one sample per line.
+    '''
+    _flush()
+    histograms, nbytes, cache, flights = {}, {}, {}, {}
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue  # The file of a process being cleaned up
+        for stage, hist in snapshot['histograms'].items():
+            total = histograms.setdefault(stage, [0] * (len(BUCKETS) + 1) + [0.0])
+            for i, value in enumerate(hist):
+                total[i] += value
+        for counters, rows in ((nbytes, snapshot['bytes']), (cache, snapshot['cache']), (flights, snapshot['flights'])):
+            for *key, value in rows:
+                counters[tuple(key)] = counters.get(tuple(key), 0) + value
+
+    lines = [
+        '# HELP swb_stage_duration_seconds Latency of each pipeline stage.',
+        '# TYPE swb_stage_duration_seconds histogram',
+    ]
+    for stage, hist in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, hist):
+            lines.append(f'swb_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'swb_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist[len(BUCKETS)]}')
+        lines.append(f'swb_stage_duration_seconds_sum{{stage="{stage}"}} {hist[-1]}')
+        lines.append(f'swb_stage_duration_seconds_count{{stage="{stage}"}} {hist[len(BUCKETS)]}')
+
+    lines += [
+        '# HELP swb_stage_bytes_total Bytes read or written by each pipeline stage.',
+        '# TYPE swb_stage_bytes_total counter',
+    ]
+    for (stage, direction), value in sorted(nbytes.items()):
+        lines.append(f'swb_stage_bytes_total{{stage="{stage}",direction="{direction}"}} {value}')
+
+    lines += [
+        '# HELP swb_cache_requests_total Cache lookups by result.',
+        '# TYPE swb_cache_requests_total counter',
+    ]
+    for (name, result), value in sorted(cache.items()):
+        lines.append(f'swb_cache_requests_total{{cache="{name}",result="{result}"}} {value}')
+
+    lines += [
+        '# HELP swb_cache_hit_ratio Fraction of cache lookups that were hits.',
+        '# TYPE swb_cache_hit_ratio gauge',
+    ]
+    for name in sorted({name for name, _ in cache}):
+        hits, misses = cache.get((name, 'hit'), 0), cache.get((name, 'miss'), 0)
+        lines.append(f'swb_cache_hit_ratio{{cache="{name}"}} {hits / (hits + misses)}')
+
+    lines += [
+        '# HELP swb_singleflight_calls_total Calls of single-flight groups by role (leader, coalesced, error).',
+        '# TYPE swb_singleflight_calls_total counter',
+    ]
+    for (group, role), value in sorted(flights.items()):
+        lines.append(f'swb_singleflight_calls_total{{group="{group}",role="{role}"}} {value}')
+
+    return '\n'.join(lines) + '\n'
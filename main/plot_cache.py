@@ -0,0 +1,144 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import pandas as pd
+from main import metrics
+
+'''Note: Rendering the matplotlib download plot (16x9 at dpi=250 with seaborn styling) takes seconds, so it is moved out of the
+request. Plots are rendered by a single background thread (matplotlib is not thread-safe) and written to a bounded on-disk cache
+keyed by a hash of the simulation results plus format and resolution. The results page submits the default plot as soon as the
+simulation is done, so the download is usually served straight from the cache. Identical requests in flight share one render.'''
+
+# Define the directory to store rendered plots
+PLOT_CACHE_DIR = 'plot_cache'
+PLOT_CACHE_MAX_BYTES = int(os.getenv('plot_cache_mb', 200)) * 1024 * 1024
+
+# Supported download formats and their mimetypes
+PLOT_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+}
+DEFAULT_DPI = 250
+DPI_RANGE = (50, 400)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='plot-renderer')
+_pending = {}  # Cache path -> Future of renders in flight
+_lock = threading.Lock()
+
+
+def result_hash(results):
+    '''
+    Hash of a simulation result frame (values, index and column names), used as the plot cache key.
+
+    Parameters:
+    -----------
+    results : pandas.DataFrame
+        pyfao56 output data (`mdl.odata`).
+
+    Returns:
+    --------
+    str
+        Hex digest identifying the results.
+    '''
+    digest = hashlib.sha256(pd.util.hash_pandas_object(results, index=True).to_numpy().tobytes())
+    digest.update(','.join(map(str, results.columns)).encode())
+    return digest.hexdigest()[:32]
+
+
+def cache_path(key, fmt, dpi):
+    '''Path of a cached plot. SVG is resolution independent, so its dpi is not part of the name.'''
+    name = f'wb_plot_{key}.svg' if fmt == 'svg' else f'wb_plot_{key}_{dpi}.{fmt}'
+    return os.path.join(PLOT_CACHE_DIR, name)
+
+
+def submit_plot(results, fmt='png', dpi=DEFAULT_DPI):
+    '''
+    Schedules the water balance plot of `results` for background rendering unless it is cached or already rendering.
+
+    Parameters:
+    -----------
+    results : pandas.DataFrame
+        pyfao56 output data.
+    fmt : str
+        One of `PLOT_FORMATS`.
+    dpi : int
+        Resolution of raster formats, limited to `DPI_RANGE`.
+
+    Returns:
+    --------
+    concurrent.futures.Future
+        Future resolving to the path of the rendered plot.
+    '''
+    if fmt not in PLOT_FORMATS:
+        raise ValueError(f'Unsupported plot format: {fmt}')
+    dpi = min(max(int(dpi), DPI_RANGE[0]), DPI_RANGE[1])
+    path = cache_path(result_hash(results), fmt, dpi)
+
+    with _lock:
+        if path in _pending:
+            metrics.cache_event('plot_cache', hit=True)
+            return _pending[path]
+        if os.path.exists(path):
+            metrics.cache_event('plot_cache', hit=True)
+            os.utime(path)  # Mark as recently used for eviction
+            future = Future()
+            future.set_result(path)
+            return future
+        metrics.cache_event('plot_cache', hit=False)
+        future = _executor.submit(_render, results, path, fmt, dpi)
+        _pending[path] = future
+
+    future.add_done_callback(lambda _: _forget(path))
+    return future
+
+
+def get_plot(results, fmt='png', dpi=DEFAULT_DPI, timeout=120):
+    '''Returns the path of the rendered plot, waiting for the background renderer if needed.'''
+    return submit_plot(results, fmt, dpi).result(timeout=timeout)
+
+
+def _forget(path):
+    with _lock:
+        _pending.pop(path, None)
+
+
+def _render(results, path, fmt, dpi):
+    from main.utils import render_wb_plot
+
+    os.makedirs(PLOT_CACHE_DIR, exist_ok=True)
+    img = render_wb_plot(results, fmt=fmt, dpi=dpi)
+
+    # Write to a unique temporary file first so readers never see a partial image
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(img)
+    os.replace(temp_path, path)
+    metrics.add_bytes('render_plot', len(img), 'write')
+
+    _evict()
+    return path
+
+
+def _evict():
+    '''Deletes the least recently used plots until the cache fits in `PLOT_CACHE_MAX_BYTES`.'''
+    entries = []
+    for file in os.listdir(PLOT_CACHE_DIR):
+        if not file.startswith('wb_plot_') or file.endswith('.tmp'):
+            continue
+        try:
+            stat = os.stat(os.path.join(PLOT_CACHE_DIR, file))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, file in sorted(entries):
+        if total <= PLOT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(os.path.join(PLOT_CACHE_DIR, file))
+            total -= size
+        except FileNotFoundError:
+            pass
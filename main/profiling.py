@@ -0,0 +1,186 @@
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from flask import abort, g, request, send_file
+
+'''Note: On-demand profiling of a single slow request. An admin adds `?profile=1` (or the `X-Profile: 1` header) together with the
+admin token in the `X-Admin-Token` header (never in the URL, which ends up in access logs) to a results, CSV or plot request.
+That request is then run under cProfile (deterministic) with tracemalloc, and the profile is stored under a request id returned in
+the `X-Profile-Id` header. It can be downloaded later from `/profiles/<id>` (pstats file, or `?format=txt` for a summary), e.g. with
+snakeviz.
+
+tracemalloc is global to the process, so a worker profiles one request at a time: another profiling request gets a 409 until the
+first one is saved, instead of resetting its peak or stopping its tracing.
+
+Profiling is only available when `profile_token` is set in the .env file. Without it no hooks or routes are registered at all, so
+normal requests pay nothing.'''
+
+PROFILE_TOKEN = os.getenv('profile_token')
+PROFILE_DIR = 'profiles'
+MAX_PROFILES = 50  # Oldest profiles are deleted beyond this
+
+# Endpoints that can be profiled
+PROFILED_ENDPOINTS = {'results.index', 'results.download_csv', 'results.download_plot'}
+
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# Held from the start of a profiled request until its profile is saved
+_profile_lock = threading.Lock()
+
+
+def init_profiling(app):
+    '''
+    Registers the profiling hooks and the download route on the app when `profile_token` is configured.
+
+    It should be called right after creating the app so that the profile covers the other request hooks too.
+    '''
+    if not PROFILE_TOKEN:
+        return
+    app.before_request(_start_profile)
+    app.after_request(_stop_profile)
+    app.teardown_request(_abandon_profile)
+    app.add_url_rule('/profiles/<profile_id>', 'download_profile', download_profile)
+
+
+def _is_admin():
+    token = request.headers.get('X-Admin-Token') or ''
+    return hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def _start_profile():
+    if request.endpoint not in PROFILED_ENDPOINTS:
+        return
+    if request.args.get('profile') != '1' and request.headers.get('X-Profile') != '1':
+        return
+    if not _is_admin():
+        abort(403)
+    if not _profile_lock.acquire(blocking=False):
+        abort(409, 'Another request is being profiled, try again once it is done.')
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    profiler = cProfile.Profile()
+    g.profile = {
+        'id': uuid.uuid4().hex,
+        'profiler': profiler,
+        'started_tracemalloc': started_tracemalloc,
+        'start': time.perf_counter(),
+    }
+    profiler.enable()
+
+
+def _stop_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+
+    profile['profiler'].disable()
+    meta = {
+        'id': profile['id'],
+        'endpoint': request.endpoint,
+        'path': request.path,
+        'args': {key: value for key, value in request.args.items() if key != 'token'},  # Never store the admin token
+        'status': response.status_code,
+    }
+    response.headers['X-Profile-Id'] = profile['id']
+    if response.is_streamed:
+        # The body of a streamed response (e.g. the CSV export) is generated after this hook, while it is sent: it is profiled
+        # chunk by chunk and the profile is stored once the response is closed
+        response.response = _profiled_body(response.response, profile['profiler'])
+        response.call_on_close(lambda: _save_profile(profile, meta))
+    else:
+        _save_profile(profile, meta)
+    return response
+
+
+def _abandon_profile(exc=None):
+    '''Releases the profiling of a request that ended before `_stop_profile` (e.g. an error in another hook).'''
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile['profiler'].disable()
+        if profile['started_tracemalloc']:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+
+def _profiled_body(body, profiler):
+    '''Iterates a response body with the profiler enabled while each chunk is generated.'''
+    iterator = iter(body)
+    try:
+        while True:
+            profiler.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def _save_profile(profile, meta):
+    '''Stores the profile, its metadata and a text summary under the profile id, then lets the next request be profiled.'''
+    try:
+        duration = time.perf_counter() - profile['start']
+        _, peak = tracemalloc.get_traced_memory()
+        if profile['started_tracemalloc']:
+            tracemalloc.stop()
+    finally:
+        _profile_lock.release()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, profile['id'])
+    profile['profiler'].dump_stats(base + '.prof')
+
+    summary = io.StringIO()
+    pstats.Stats(profile['profiler'], stream=summary).sort_stats('cumulative').print_stats(40)
+    meta = {**meta, 'timestamp': time.time(), 'duration_s': duration, 'tracemalloc_peak_bytes': peak}
+    with open(base + '.json', 'w') as f:
+        json.dump(meta, f, indent=4)
+    with open(base + '.txt', 'w') as f:
+        f.write(json.dumps(meta, indent=4) + '\n\n' + summary.getvalue())
+
+    _evict()
+
+
+def _evict():
+    '''Keeps only the `MAX_PROFILES` most recent profiles.'''
+    ids = sorted({file.split('.')[0] for file in os.listdir(PROFILE_DIR) if PROFILE_ID.match(file.split('.')[0])},
+                 key=lambda i: os.path.getmtime(os.path.join(PROFILE_DIR, i + '.json'))
+                 if os.path.exists(os.path.join(PROFILE_DIR, i + '.json')) else 0)
+    for old_id in ids[:-MAX_PROFILES]:
+        for ext in ('.prof', '.json', '.txt'):
+            path = os.path.join(PROFILE_DIR, old_id + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def download_profile(profile_id):
+    ''' Downloads a stored profile: the pstats file by default, or the text summary with `?format=txt` (admin only) '''
+    if not _is_admin():
+        abort(403)
+    if not PROFILE_ID.match(profile_id):
+        abort(404)
+
+    if request.args.get('format') == 'txt':
+        path, mimetype = os.path.join(PROFILE_DIR, profile_id + '.txt'), 'text/plain'
+    else:
+        path, mimetype = os.path.join(PROFILE_DIR, profile_id + '.prof'), 'application/octet-stream'
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype=mimetype, as_attachment=mimetype != 'text/plain',
+                     download_name=os.path.basename(path))
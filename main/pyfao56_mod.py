@@ -1,5 +1,7 @@
 from datetime import datetime
 import math
+import numpy as np
+import pandas as pd
 
 
 # Note: Most of the docstrings and comments are generated using the AI-based tool and may not be accurate. 
@@ -67,12 +69,8 @@ def gdd(df=None, start=None, end=None, T_base=None, T_cutoff=None, cgdd=None, mt
     df_gdd = df.loc[start:][['tmmx','tmmn']]
     end = datetime.strptime(end,'%Y-%j')
     
-    if mthd == 'corn': #this method is recommended for corn (eq. 3.1, p-117 ,Allen and Robison 2007 Evapotranspiration for Idaho)
-        df_gdd['gdd'] = df_gdd.apply(lambda row: (max(min(row['tmmx'],T_cutoff),T_base) + (max(min(row['tmmn'],T_cutoff),T_base)))/2 - T_base, axis=1)
-        #gdd = (max(min(tmmx,T_cutoff),T_base) + (max(min(tmmn,T_cutoff),T_base)))/2 - T_base
-    elif mthd == 'other': #this method is recommended for other crops in ID (eq. 3.1, p-117 ,Allen and Robison 2007 Evapotranspiration for Idaho)
-        df_gdd['gdd'] = df_gdd.apply(lambda row: max(((row['tmmx']+row['tmmn'])/2) - T_base, 0), axis=1)
-        #gdd = max(((tmmx+tmmn)/2) - T_base, 0)
+    df_gdd['gdd'] = gdd_daily(df_gdd['tmmx'].to_numpy(dtype=float), df_gdd['tmmn'].to_numpy(dtype=float),
+                              T_base, T_cutoff, mthd)
     df_gdd['gdd'] = df_gdd['gdd'].cumsum()
     #end_gdd = df_gdd.loc[df_gdd['gdd'] <= cgdd].index[-1]
     end_gdd = df_gdd.loc[df_gdd['gdd'] >= cgdd].index[0] #this will result in one more day when gdd completed
@@ -85,6 +83,141 @@ def gdd(df=None, start=None, end=None, T_base=None, T_cutoff=None, cgdd=None, mt
 
 
 
+def gdd_daily(tmax, tmin, T_base, T_cutoff=None, mthd='corn'):
+    """
+    Calculate daily (non-cumulative) Growing Degree Days for whole temperature arrays at once.
+
+    This is the vectorized core used by `gdd` and by the planting-date sweep (`main/sweep.py`),
+    where the same daily values are reused for every candidate planting date.
+
+    Parameters
+    ----------
+    tmax : numpy.ndarray
+        Daily maximum air temperature (°C).
+    tmin : numpy.ndarray
+        Daily minimum air temperature (°C).
+    T_base : float
+        Base temperature (°C) below which crop growth is minimal.
+    T_cutoff : float, optional
+        Cutoff temperature (°C) above which crop growth is limited. Only used by the 'corn' method.
+    mthd : str, optional
+        Method for GDD calculation, either 'corn' or 'other' (see `gdd`). Default is 'corn'.
+
+    Returns
+    -------
+    numpy.ndarray
+        Daily GDD values with the same shape as `tmax`.
+
+    Example
+    -------
+    >>> gdd_daily(np.array([30., 32.]), np.array([20., 21.]), T_base=10, T_cutoff=30)
+    array([15. , 15.5])
+    """
+    tmax = np.asarray(tmax, dtype=float)
+    tmin = np.asarray(tmin, dtype=float)
+
+    if mthd == 'corn': #this method is recommended for corn (eq. 3.1, p-117 ,Allen and Robison 2007 Evapotranspiration for Idaho)
+        #gdd = (max(min(tmmx,T_cutoff),T_base) + (max(min(tmmn,T_cutoff),T_base)))/2 - T_base
+        return (np.clip(tmax, T_base, T_cutoff) + np.clip(tmin, T_base, T_cutoff))/2 - T_base
+    elif mthd == 'other': #this method is recommended for other crops in ID (eq. 3.1, p-117 ,Allen and Robison 2007 Evapotranspiration for Idaho)
+        #gdd = max(((tmmx+tmmn)/2) - T_base, 0)
+        return np.maximum((tmax + tmin)/2 - T_base, 0)
+    raise ValueError(f"Unknown GDD method: {mthd}")
+
+
+
+def refet_daily(doy, srad, tmax, tmin, z, lat, vapr=None, tdew=None, rhmax=None, rhmin=None, wndsp=None,
+                wndht=2.0, rfcrp='S'):
+    """
+    Compute daily ASCE Standardized Reference ET for whole weather arrays at once.
+
+    This follows `pyfao56.refet.ascedaily` step by step (ASCE 2005, Eqs. 1-33) but operates on numpy
+    arrays, so a full weather record is processed in a single pass instead of one call per day.
+
+    Parameters
+    ----------
+    doy : numpy.ndarray
+        Day of year (1-366).
+    srad : numpy.ndarray
+        Incoming solar radiation (MJ m^-2 d^-1).
+    tmax : numpy.ndarray
+        Daily maximum air temperature (°C).
+    tmin : numpy.ndarray
+        Daily minimum air temperature (°C).
+    z : float or numpy.ndarray
+        Weather site elevation above mean sea level (m).
+    lat : float or numpy.ndarray
+        Latitude of the weather site (decimal degrees). Arrays broadcast against the weather arrays,
+        e.g. shape (cells,) with weather arrays of shape (days, cells) for a grid.
+    vapr, tdew, rhmax, rhmin, wndsp : numpy.ndarray, optional
+        Vapor pressure (kPa), dew point (°C), max/min relative humidity (%) and wind speed (m/s).
+        Missing arrays or NaN values fall back in the same order as pyfao56.
+    wndht : float, optional
+        Height of wind measurement above the ground (m). Default is 2.0.
+    rfcrp : str, optional
+        'S' for the short reference crop, 'T' for the tall reference crop. Default is 'S'.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        `(etsz, ea)`: daily standardized reference ET (mm) and the actual vapor pressure (kPa)
+        used to compute it.
+
+    Notes
+    -----
+    - The results match `pyfao56.refet.ascedaily` to floating point precision.
+    """
+    doy = np.asarray(doy, dtype=float)
+    srad = np.asarray(srad, dtype=float)
+    tmax = np.asarray(tmax, dtype=float)
+    tmin = np.asarray(tmin, dtype=float)
+    nan = np.full(np.broadcast(doy, srad, tmax, tmin).shape, np.nan)
+    vapr, tdew, rhmax, rhmin, wndsp = [nan if x is None else np.asarray(x, dtype=float)
+                                       for x in (vapr, tdew, rhmax, rhmin, wndsp)]
+
+    tavg = (tmax + tmin)/2.0
+    patm = 101.3*((293.0 - 0.0065*z)/293.0)**5.26
+    psycon = 0.000665*patm
+    Udelta = 2503.0*np.exp(17.27*tavg/(tavg + 237.3))/((tavg + 237.3)**2.0)
+
+    emax = 0.6108*np.exp((17.27*tmax)/(tmax + 237.3))
+    emin = 0.6108*np.exp((17.27*tmin)/(tmin + 237.3))
+    es = (emax + emin)/2.0
+
+    # Actual vapor pressure, same fallback order as pyfao56 (ASCE 2005, Table 3)
+    tdew_est = tmin - 2.0
+    ea = np.select(
+        [~np.isnan(vapr), ~np.isnan(tdew), ~np.isnan(rhmax) & ~np.isnan(rhmin), ~np.isnan(rhmax), ~np.isnan(rhmin)],
+        [vapr, 0.6108*np.exp((17.27*tdew)/(tdew + 237.3)), (emin*rhmax/100. + emax*rhmin/100.)/2.0,
+         emin*rhmax/100., emax*rhmin/100.],
+        default=0.6108*np.exp((17.27*tdew_est)/(tdew_est + 237.3)),
+    )
+
+    rns = (1.0 - 0.23)*srad
+
+    latrad = np.asarray(lat, dtype=float)*math.pi/180.0
+    dr = 1.0 + 0.033*np.cos(2.0*math.pi/365.0*doy)
+    ldelta = 0.409*np.sin(2.0*math.pi/365.0*doy - 1.39)
+    ws = np.arccos(-1.0*np.tan(latrad)*np.tan(ldelta))
+    ra = 24.0/math.pi*4.92*dr*(ws*np.sin(latrad)*np.sin(ldelta) + np.cos(latrad)*np.cos(ldelta)*np.sin(ws))
+    rso = (0.75 + 2e-5*z)*ra
+
+    ratio = np.clip(srad/rso, 0.3, 1.0)
+    fcd = np.clip(1.35*ratio - 0.35, 0.05, 1.0)
+    tk4 = ((tmax + 273.16)**4.0 + (tmin + 273.16)**4.0)/2.0
+    rnl = 4.901e-9*fcd*(0.34 - 0.14*np.sqrt(ea))*tk4
+    rn = rns - rnl
+
+    u2 = np.where(np.isnan(wndsp), 2.0, wndsp)*(4.87/math.log(67.8*wndht - 5.42))
+
+    Cn, Cd = (900.0, 0.34) if rfcrp == 'S' else (1600.0, 0.38)
+    etsz = 0.408*Udelta*rn + psycon*(Cn/(tavg + 273.0))*u2*(es - ea)
+    etsz = etsz/(Udelta + psycon*(1.0 + Cd*u2))
+
+    return etsz, ea
+
+
+
 def crop_stage(start,end,Lini,Ldev,Lmid,Lend):
     """
     Calculate the adjusted crop growth stage lengths based on the total growing period.
@@ -198,37 +331,85 @@ def Kcb_adj(df, start, end, Kcbmid, Kcbend, Lini, Ldev, Lmid, Lend, wndht, hmax)
     >>> Kcb_adj(df, '2024-120', '2024-150', 1.10, 0.85, 20, 30, 40, 30, 2.0, 1.2)
     (1.12, 0.87)
     """
-    cor_df = df[start:end]
-
-    # Mid-season average RHmin and wind speed correction
-    cor_avg_RHmin_mid = cor_df[Lini+Ldev:Lini+Ldev+Lmid]['rmin'].mean()
-    cor_avg_RHmin_mid = sorted([20.0, cor_avg_RHmin_mid, 80.0])[1]  # Clamp between 20% and 80%
-
-    cor_avg_wind_mid = cor_df[Lini+Ldev:Lini+Ldev+Lmid]['vs']
-    cor_avg_wind_mid = cor_avg_wind_mid.apply(lambda x: x * (4.87 / math.log(67.8 * wndht - 5.42))).mean()
-    cor_avg_wind_mid = sorted([1.0, cor_avg_wind_mid, 6.0])[1]  # Clamp between 1.0 and 6.0 m/s
-
-    # End-season average RHmin and wind speed correction
-    cor_avg_RHmin_end = cor_df[Lini+Ldev+Lmid:]['rmin'].mean()
-    cor_avg_RHmin_end = sorted([20.0, cor_avg_RHmin_end, 80.0])[1]
-
-    cor_avg_wind_end = cor_df[Lini+Ldev+Lmid:]['vs']
-    cor_avg_wind_end = cor_avg_wind_end.apply(lambda x: x * (4.87 / math.log(67.8 * wndht - 5.42))).mean()
-    cor_avg_wind_end = sorted([1.0, cor_avg_wind_end, 6.0])[1]
-
-    # Adjust mid-season Kcb if initial Kcb is >= 0.45
-    if Kcbmid >= 0.45:
-        Kcbmid = round(
-            Kcbmid + (0.04 * (cor_avg_wind_mid - 2) - 0.004 * (cor_avg_RHmin_mid - 45)) * (hmax / 3) ** 0.3,
-            2
-        )
-
-    # Adjust end-season Kcb if initial Kcb is >= 0.45
-    if Kcbend >= 0.45:
-        Kcbend = round(
-            Kcbend + (0.04 * (cor_avg_wind_end - 2) - 0.004 * (cor_avg_RHmin_end - 45)) * (hmax / 3) ** 0.3,
-            2
-        )
+    Kcbmid, Kcbend = Kcb_adj_batch(df, start, end, Kcbmid, Kcbend, Lini, Ldev, Lmid, Lend, wndht, hmax)
+    return float(Kcbmid), float(Kcbend)
+
+
+
+def Kcb_adj_batch(df, start, end, Kcbmid, Kcbend, Lini, Ldev, Lmid, Lend, wndht, hmax):
+    """
+    Vectorized `Kcb_adj` for many seasons, crops and stage splits at once.
+
+    The mid-season and late-season RHmin and 2 m wind means are taken from prefix sums built once over the
+    whole weather record, so each combination costs a few array lookups instead of re-slicing the frame.
+    All arguments except `df` and `wndht` may be scalars or arrays; they are broadcast against each other
+    (for example, one row per year and one column per crop).
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Weather data indexed by '%Y-%j' with columns 'rmin' and 'vs'.
+    start : str or array-like of str
+        Start date(s) (in '%Y-%j' format) of the crop growing period.
+    end : str or array-like of str
+        End date(s) (in '%Y-%j' format) of the crop growing period.
+    Kcbmid, Kcbend : float or array-like
+        Mid-season and end-season crop coefficients.
+    Lini, Ldev, Lmid, Lend : int or array-like
+        Lengths of the crop growth stages (in days).
+    wndht : float
+        Height at which wind speed is measured (in meters).
+    hmax : float or array-like
+        Maximum crop height (in meters).
+
+    Returns:
+    --------
+    tuple of numpy.ndarray
+        Adjusted Kcbmid and Kcbend with the broadcast shape of the inputs.
+
+    Example:
+    --------
+    >>> Kcb_adj_batch(wdata, ['2021-110', '2022-110'], ['2021-240', '2022-240'],
+    ...               np.array([[1.10], [1.10]]), 0.65, 30, 35, 50, 30, 10, [[1.0, 2.0]])
+    """
+    # Prefix sums with counts so that means skip missing values like pandas does
+    rmin = pd.to_numeric(df['rmin'], errors='coerce').to_numpy(dtype=float)
+    u2 = pd.to_numeric(df['vs'], errors='coerce').to_numpy(dtype=float) * (4.87 / math.log(67.8 * wndht - 5.42))
+    sums, counts = {}, {}
+    for name, values in (('rmin', rmin), ('u2', u2)):
+        sums[name] = np.concatenate(([0.], np.cumsum(np.nan_to_num(values))))
+        counts[name] = np.concatenate(([0], np.cumsum(~np.isnan(values))))
+
+    # Positions of the season in the record; like df[start:end], both labels are inclusive
+    index = pd.Index(df.index)
+    first = index.get_indexer(np.atleast_1d(start)).reshape(np.shape(start))
+    last = index.get_indexer(np.atleast_1d(end)).reshape(np.shape(end)) + 1
+    if np.any(first < 0) or np.any(last < 1):
+        raise KeyError('start and end dates must be present in the weather data')
+
+    first, last, Kcbmid, Kcbend, Lini, Ldev, Lmid, hmax = np.broadcast_arrays(
+        first, last, np.asarray(Kcbmid, dtype=float), np.asarray(Kcbend, dtype=float),
+        Lini, Ldev, Lmid, np.asarray(hmax, dtype=float))
+
+    # Stage boundaries, clipped to the season the same way positional slicing does
+    mid_start = np.minimum(first + Lini + Ldev, last)
+    end_start = np.minimum(first + Lini + Ldev + Lmid, last)
+
+    def mean(name, lo, hi):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums[name][hi] - sums[name][lo]) / (counts[name][hi] - counts[name][lo])
+
+    RHmin_mid = np.clip(mean('rmin', mid_start, end_start), 20.0, 80.0)  # Clamp between 20% and 80%
+    wind_mid = np.clip(mean('u2', mid_start, end_start), 1.0, 6.0)  # Clamp between 1.0 and 6.0 m/s
+    RHmin_end = np.clip(mean('rmin', end_start, last), 20.0, 80.0)
+    wind_end = np.clip(mean('u2', end_start, last), 1.0, 6.0)
+
+    # Adjust Kcb only where the unadjusted Kcb is >= 0.45
+    factor = (hmax / 3) ** 0.3
+    Kcbmid = np.where(Kcbmid >= 0.45,
+                      np.round(Kcbmid + (0.04 * (wind_mid - 2) - 0.004 * (RHmin_mid - 45)) * factor, 2), Kcbmid)
+    Kcbend = np.where(Kcbend >= 0.45,
+                      np.round(Kcbend + (0.04 * (wind_end - 2) - 0.004 * (RHmin_end - 45)) * factor, 2), Kcbend)
 
     return Kcbmid, Kcbend
 
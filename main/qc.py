@@ -0,0 +1,207 @@
+import logging
+import numpy as np
+import pandas as pd
+from main.ingest import VALID_RANGES, VALUE_COLUMNS
+from main.schema import compact_weather
+from main.shared_cache import cache
+from main.utils import load_weather_data, weather_version
+
+'''Note: Quality control and gap filling of the daily weather before it goes into pyfao56. gridMET and AgriMet series can contain
+missing days or values (AgriMet has no rmin/rmax, stations drop days), and a single NaN in the inputs turns the rest of the water
+balance into NaN. Every step is vectorized over the whole series:
+1. the series is put on a complete daily index (dropped days become missing),
+2. values outside `VALID_RANGES`, days with tmmx < tmmn and days with rmin > rmax are set to missing,
+3. gaps of up to `MAX_INTERP_DAYS` days are interpolated linearly (not precipitation),
+4. remaining gaps are filled from an alternate source when one is given (gridMET for uploaded station data),
+5. then from the day-of-year climatology of the series, a 31-day moving average, and the nearest value (not precipitation),
+6. precipitation still missing is set to 0 (no rain), flagged `zero_filled` since it is an assumption, not an estimate.
+Each filled or rejected value is flagged by column and step in the report, so the results page can list the flagged days.
+
+The check runs once per weather version and season: `checked_weather` caches its output in the shared cache, keyed on the location,
+the modification time of the weather file and the season, so simulations of the same weather do not validate it again. Only the
+days of the simulated season are checked: a weather file can hold several seasons of the location (fetches are merged, see
+`save_weather_data`), and the days between them are not missing data to fill or report.'''
+
+MAX_INTERP_DAYS = 3
+CLIMATOLOGY_WINDOW = 31
+QC_TTL = 6 * 3600  # As long as the weather files (see `delete_old_files`)
+
+# Flags in the order of the steps (a value gets the flag of the step that filled it)
+FLAGS = ['out_of_range', 'tmax_lt_tmin', 'rmin_gt_rmax', 'interpolated', 'alternate', 'climatology', 'zero_filled', 'missing']
+
+
+def _gap_lengths(missing):
+    '''Length of the run of missing values each missing value belongs to (0 for present values).'''
+    runs = (missing != missing.shift()).cumsum()
+    return missing.groupby(runs).transform('sum').where(missing, 0)
+
+
+def qc_weather(w_data, alternate=None, max_gap=MAX_INTERP_DAYS):
+    '''
+    Checks and gap-fills a daily weather series.
+
+    Parameters:
+    -----------
+    w_data : pd.DataFrame
+        Weather in the layout of the weather store ('Date', 'srad', 'tmmx', 'tmmn', 'vpar', 'tdew', 'rmax', 'rmin', 'vs', 'pr',
+        'ET', 'MorP'), values as numbers or strings.
+    alternate : pd.DataFrame, optional
+        Alternate source with 'Date' and some of the value columns (same units), used for gaps longer than `max_gap`.
+    max_gap : int
+        Longest gap (days) filled by linear interpolation.
+
+    Returns:
+    --------
+    tuple
+        (checked DataFrame in the compact weather schema (see main/schema.py) with a complete daily 'Date', report dict). The
+        report has the number of days, the counts per flag and column, and `flagged_days`: one {'Date', 'flags'} entry per day
+        with a flag.
+    '''
+    df = w_data.copy()
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    df = df.dropna(subset=['Date']).drop_duplicates('Date').set_index('Date').sort_index()
+    if df.empty:
+        raise ValueError('No weather data to check.')
+    df = df.reindex(pd.date_range(df.index[0], df.index[-1], freq='D'))
+
+    values = df[VALUE_COLUMNS].apply(pd.to_numeric, errors='coerce').astype('float64')
+    flags = {flag: pd.DataFrame(False, index=values.index, columns=VALUE_COLUMNS) for flag in FLAGS}
+
+    # Range and consistency checks
+    for col, (low, high) in VALID_RANGES.items():
+        flags['out_of_range'][col] = (values[col] < low) | (values[col] > high)
+    values = values.mask(flags['out_of_range'])
+    bad_t = values['tmmx'] < values['tmmn']
+    flags['tmax_lt_tmin'][['tmmx', 'tmmn']] = np.column_stack([bad_t, bad_t])
+    bad_rh = values['rmin'] > values['rmax']
+    flags['rmin_gt_rmax'][['rmin', 'rmax']] = np.column_stack([bad_rh, bad_rh])
+    values = values.mask(flags['tmax_lt_tmin'] | flags['rmin_gt_rmax'])
+    observed = values.notna()
+
+    # Short gaps: linear interpolation inside the series (precipitation is not interpolated)
+    interp_cols = [col for col in VALUE_COLUMNS if col != 'pr']
+    short = values[interp_cols].isna().apply(_gap_lengths).le(max_gap) & values[interp_cols].isna()
+    interpolated = values[interp_cols].interpolate(limit_area='inside')
+    values[interp_cols] = values[interp_cols].where(~short, interpolated)
+    flags['interpolated'] = values.notna() & ~observed
+
+    # Longer gaps: alternate source
+    before = values.notna()
+    if alternate is not None and not alternate.empty:
+        alt = alternate.assign(Date=pd.to_datetime(alternate['Date'])).drop_duplicates('Date').set_index('Date')
+        alt = alt.reindex(values.index).reindex(columns=VALUE_COLUMNS).apply(pd.to_numeric, errors='coerce')
+        values = values.fillna(alt)
+    flags['alternate'] = values.notna() & ~before
+
+    # Climatology of the series: day-of-year mean, then moving average, then nearest value (not precipitation)
+    before = values.notna()
+    doy = values.index.dayofyear
+    values = values.fillna(values.where(observed).groupby(doy).transform('mean'))
+    values = values.fillna(values.rolling(CLIMATOLOGY_WINDOW, center=True, min_periods=1).mean())
+    values[interp_cols] = values[interp_cols].ffill().bfill()
+    flags['climatology'] = values.notna() & ~before
+
+    # Precipitation without any estimate: no rain
+    before = values.notna()
+    values['pr'] = values['pr'].fillna(0.0)
+    flags['zero_filled'] = values.notna() & ~before
+
+    flags['missing'] = values.isna()
+
+    df[VALUE_COLUMNS] = values
+    df = compact_weather(df.rename_axis('Date').reset_index())
+    return df, qc_report(flags)
+
+
+def qc_report(flags):
+    '''Summary of the QC flags: counts per flag and column, and the list of flagged days.'''
+    counts = {flag: {col: int(n) for col, n in mask.sum().items() if n} for flag, mask in flags.items()}
+    index = flags[FLAGS[0]].index
+    # 'srad:interpolated tmmx:out_of_range ...' for each day
+    labels = np.full(len(index), '', dtype=object)
+    for flag in FLAGS:
+        mask = flags[flag].to_numpy()
+        for j, col in enumerate(VALUE_COLUMNS):
+            labels = np.where(mask[:, j], labels + f' {col}:{flag}', labels)
+    flagged = [{'Date': date.strftime('%Y-%m-%d'), 'flags': text.strip()} for date, text in zip(index, labels) if text]
+    return {
+        'days': len(index),
+        'counts': {flag: cols for flag, cols in counts.items() if cols},
+        'flagged_days': flagged,
+    }
+
+
+def gridmet_alternate(lat, lon, start, end):
+    '''gridMET series of the location between `start` and `end` in pyfao56 units, or None when it cannot be fetched.'''
+    from main.gridMET_fetch import WeatherDataFetcher
+
+    try:
+        fetcher = WeatherDataFetcher(float(lat), float(lon), ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr'], cache=cache)
+        data = fetcher.fetch_data_for_date_range(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+        return WeatherDataFetcher.unit_conversion_pyfao56(data)
+    except Exception as e:
+        logging.error(f"gridMET gap filling unavailable: {str(e)}")
+        return None
+
+
+def needs_alternate(w_data, max_gap=MAX_INTERP_DAYS):
+    '''True when the series has gaps longer than `max_gap` days (or days missing from its range).'''
+    dates = pd.to_datetime(w_data['Date'], errors='coerce').dropna()
+    if dates.empty:
+        return False
+    full = pd.date_range(dates.min(), dates.max(), freq='D')
+    values = (w_data.assign(Date=pd.to_datetime(w_data['Date'], errors='coerce')).dropna(subset=['Date'])
+              .drop_duplicates('Date').set_index('Date').reindex(full)[VALUE_COLUMNS].apply(pd.to_numeric, errors='coerce'))
+    return bool(values.isna().apply(_gap_lengths).gt(max_gap).any().any())
+
+
+def season_days(w_data, start=None, end=None):
+    '''Rows of a weather series between `start` and `end` (inclusive, either can be None).'''
+    dates = pd.to_datetime(w_data['Date'], errors='coerce')
+    keep = pd.Series(True, index=w_data.index)
+    if start:
+        keep &= dates >= pd.to_datetime(start)
+    if end:
+        keep &= dates <= pd.to_datetime(end)
+    return w_data[keep].reset_index(drop=True)
+
+
+def checked_weather(lat, lon, data_source=None, w_data=None, ttl=QC_TTL, start=None, end=None):
+    '''
+    Checked and gap-filled weather of a location, computed once per weather version.
+
+    Parameters:
+    -----------
+    lat, lon : str or float
+        Location of the stored weather data.
+    data_source : str, optional
+        'fetch' (gridMET) or 'upload'. Uploaded data with long gaps is completed from gridMET.
+    w_data : pd.DataFrame, optional
+        Weather given inline (JSON API) instead of the stored file, cached on its content.
+    ttl : float
+        Lifetime of the cached output in seconds.
+    start, end : str, optional
+        Season to check (YYYY-MM-DD, e.g. the planting and maturity dates). Days outside it are left out of the output and the
+        report. Defaults to the whole series.
+
+    Returns:
+    --------
+    tuple
+        (checked DataFrame, report), see `qc_weather`.
+    '''
+    season = ':'.join(pd.to_datetime(day).strftime('%Y-%m-%d') if day else '' for day in (start, end))
+    if w_data is None:
+        key = f'qc:{lat}:{lon}:{weather_version(lat, lon)}:{data_source}:{season}'
+    else:
+        key = f'qc:{lat}:{lon}:inline:{pd.util.hash_pandas_object(w_data.astype(str), index=False).sum()}:{data_source}:{season}'
+
+    def compute():
+        data = w_data if w_data is not None else pd.DataFrame(load_weather_data(lat, lon)['weather_data'])
+        data = season_days(data, start, end)
+        alternate = None
+        if data_source != 'fetch' and needs_alternate(data):
+            dates = pd.to_datetime(data['Date'], errors='coerce')
+            alternate = gridmet_alternate(lat, lon, dates.min(), dates.max())
+        return qc_weather(data, alternate)
+
+    return cache.get_or_compute(key, compute, ttl=ttl, name='weather_qc')
@@ -0,0 +1,370 @@
+import argparse
+import logging
+import os
+import numpy as np
+import pandas as pd
+from main.crop_data import CROP_COEFFICIENTS, CROP_PROPERTIES, CROP_STAGE_LENGTHS, CN2
+from main.gridMET_fetch import GRIDMET_URL, WeatherDataFetcher
+from main.pyfao56_mod import crop_stage, refet_daily
+
+'''Note: Regional mode. The app simulates one field from the nearest gridMET cell; irrigation districts want maps of depletion and
+irrigation demand over every cell of a bounding box. Here the gridMET cube of the bbox is opened lazily (xarray only reads the
+slices that are indexed) and processed tile by tile (`tile` x `tile` cells with all the days of the season), so memory stays
+bounded by one tile whatever the size of the bbox. For each tile, the daily ETo of every cell comes from the vectorized
+`refet_daily`, with the elevation of each cell from the gridMET elevation grid (`elev/metdata_elevationdata.nc` under the gridMET
+root) so that the pressure and clear-sky radiation terms follow the terrain. A single `--elevation` can be forced instead; when the
+elevation grid cannot be opened, `DEFAULT_ELEVATION` is used for every cell and a warning is logged. Then a FAO-56 root-zone water balance runs over all cells at once (one numpy step per day):
+- basal crop coefficient curve of the crop (Kcbini/Kcbmid/Kcbend and stage lengths, adjusted to the season like `crop_stage`),
+- root depth growing with Kcb from Zrini to Zrmax, TAW and RAW with the FAO-56 adjustment of p to ETc,
+- curve number runoff (CN2), water stress coefficient Ks, deep percolation above field capacity,
+- automatic irrigation refilling the root zone when the depletion exceeds `mad` x TAW (mad defaults to p).
+It is a single-layer simplification of what pyfao56 does for one field (no soil evaporation term), meant for maps, not for
+field scheduling.
+
+Output is a NetCDF file (written tile by tile with netCDF4) with either the season summary per cell or daily rasters:
+
+    python -m main.regional --bbox -117.0 43.0 -116.0 44.0 --start 2022-04-20 --end 2022-09-01 --crop potato \\
+        --output regional.nc --mode summary'''
+
+REGIONAL_VARS = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+TILE_CELLS = 32
+ELEVATION_FILE = 'elev/metdata_elevationdata.nc'  # gridMET elevation grid (m), relative to the gridMET root
+DEFAULT_ELEVATION = 800.0
+
+SUMMARY_VARS = {
+    'ETo': ('mm', 'Seasonal reference ET'),
+    'ETc': ('mm', 'Seasonal crop ET without stress'),
+    'ETa': ('mm', 'Seasonal actual crop ET'),
+    'Irrig': ('mm', 'Seasonal irrigation demand'),
+    'Rain': ('mm', 'Seasonal precipitation'),
+    'Runoff': ('mm', 'Seasonal runoff'),
+    'DP': ('mm', 'Seasonal deep percolation'),
+    'Irrig_events': ('1', 'Number of irrigation events'),
+    'Dr_end': ('mm', 'Root zone depletion at the end of the season'),
+    'fDr_max': ('1', 'Maximum fractional root zone depletion (Dr/TAW)'),
+}
+DAILY_VARS = {
+    'Dr': ('mm', 'Root zone depletion'),
+    'fDr': ('1', 'Fractional root zone depletion (Dr/TAW)'),
+    'Ks': ('1', 'Water stress coefficient'),
+    'ETa': ('mm', 'Actual crop ET'),
+    'Irrig': ('mm', 'Irrigation'),
+}
+
+
+def crop_parameters(crop, start, end, stage_length_adjust=True):
+    '''Crop parameters of `crop` from main.crop_data, with the stage lengths adjusted to the season.'''
+    params = {**CROP_COEFFICIENTS[crop], **CROP_PROPERTIES[crop], **CROP_STAGE_LENGTHS[crop], 'CN2': CN2.get(crop) or 76}
+    if stage_length_adjust:
+        params['l_ini'], params['l_dev'], params['l_mid'], params['l_end'] = crop_stage(
+            pd.to_datetime(start).strftime('%Y-%j'), pd.to_datetime(end).strftime('%Y-%j'),
+            params['l_ini'], params['l_dev'], params['l_mid'], params['l_end'])
+    return params
+
+
+def kcb_curve(days, params):
+    '''Daily basal crop coefficient over `days` days after planting (FAO-56 piecewise linear curve).'''
+    t = np.arange(days, dtype=float)
+    l1 = params['l_ini']
+    l2 = l1 + params['l_dev']
+    l3 = l2 + params['l_mid']
+    l4 = l3 + params['l_end']
+    return np.interp(t, [0, l1, l2, l3, l4], [params['kcb_ini'], params['kcb_ini'], params['kcb_mid'], params['kcb_mid'],
+                                              params['kcb_end']])
+
+
+def soil_parameters(soil_data):
+    '''Depth-weighted field capacity, wilting point and initial moisture (fractions) of the session-like `soil_data`.'''
+    layers = soil_data['layers']
+    depths = np.array([float(layer['bottom_depth']) for layer in layers])
+    thickness = np.diff(np.concatenate([[0.0], depths]))
+
+    def mean(key):
+        return float(np.sum(thickness * [float(layer[key]) for layer in layers]) / depths[-1] / 100)
+
+    return mean('field_capacity'), mean('wilting_point'), mean('initial_moisture')
+
+
+def water_balance(eto, rain, kcb, params, fc, wp, theta_ini, mad=None, irrigate=True):
+    '''
+    Vectorized root-zone water balance over cells.
+
+    Parameters:
+    -----------
+    eto, rain : np.ndarray
+        Daily reference ET and precipitation (mm), shape (days, cells).
+    kcb : np.ndarray
+        Daily basal crop coefficient, shape (days,).
+    params : dict
+        Crop parameters (see `crop_parameters`).
+    fc, wp, theta_ini : float
+        Field capacity, wilting point and initial moisture (volumetric fractions).
+    mad : float, optional
+        Management allowed depletion triggering irrigation (fraction of TAW). Defaults to the adjusted p of the day.
+    irrigate : bool
+        Automatic irrigation on or off (rainfed).
+
+    Returns:
+    --------
+    dict
+        Daily arrays (days, cells): ETc, ETa, Ks, Dr, fDr, Irrig, Runoff, DP.
+    '''
+    days, cells = eto.shape
+    kcb_ini, kcb_mid = params['kcb_ini'], params['kcb_mid']
+    zr_ini, zr_max = params['zr_ini'], params['zr_max']
+    cn2 = params['CN2']
+    s_cn = 25400.0 / cn2 - 254.0  # Potential maximum retention (mm)
+
+    # Root depth grows with Kcb during development (as in pyfao56)
+    growth = np.clip((kcb - kcb_ini) / max(kcb_mid - kcb_ini, 1e-9), 0.0, 1.0)
+    growth = np.maximum.accumulate(growth)
+    zr = zr_ini + (zr_max - zr_ini) * growth
+
+    out = {name: np.empty((days, cells), dtype='float32') for name in ('ETc', 'ETa', 'Ks', 'Dr', 'fDr', 'Irrig', 'Runoff', 'DP')}
+    dr = np.full(cells, 1000.0 * max(fc - theta_ini, 0.0) * zr[0])
+    zr_prev = zr[0]
+    for d in range(days):
+        # New soil reached by the roots comes at the initial moisture
+        dr = dr + 1000.0 * max(fc - theta_ini, 0.0) * (zr[d] - zr_prev)
+        zr_prev = zr[d]
+        taw = 1000.0 * (fc - wp) * zr[d]
+
+        etc = kcb[d] * eto[d]
+        p = np.clip(params['p'] + 0.04 * (5.0 - etc), 0.1, 0.8)
+        raw = p * taw
+
+        irrig = np.zeros(cells)
+        if irrigate:
+            threshold = (p if mad is None else mad) * taw
+            irrig = np.where(dr > threshold, dr, 0.0)
+
+        p_eff = np.nan_to_num(rain[d])
+        runoff = np.where(p_eff > 0.2 * s_cn, (p_eff - 0.2 * s_cn) ** 2 / (p_eff + 0.8 * s_cn), 0.0)
+        ks = np.where(dr > raw, np.clip((taw - dr) / ((1.0 - p) * taw), 0.0, 1.0), 1.0)
+        eta = ks * etc
+
+        dr = dr - (p_eff - runoff) - irrig + eta
+        dp = np.maximum(-dr, 0.0)
+        dr = np.clip(dr, 0.0, taw)
+
+        out['ETc'][d], out['ETa'][d], out['Ks'][d] = etc, eta, ks
+        out['Dr'][d], out['fDr'][d], out['Irrig'][d] = dr, dr / taw, irrig
+        out['Runoff'][d], out['DP'][d] = runoff, dp
+    return out
+
+
+class GridmetCube:
+    '''Lazy access to the gridMET files of a bbox and season, read one tile at a time.'''
+
+    def __init__(self, bbox, start, end, base_url=None):
+        """
+        Opens the gridMET files of every variable and year of the season (no data is read yet).
+
+        Args:
+        bbox (tuple): (west, south, east, north) in decimal degrees.
+        start (str): First day of the season (YYYY-MM-DD).
+        end (str): Last day of the season (YYYY-MM-DD).
+        base_url (str): Root of the gridMET files (see `WeatherDataFetcher`). Defaults to `GRIDMET_URL`.
+        """
+        import xarray as xr
+
+        self.start, self.end = pd.to_datetime(start), pd.to_datetime(end)
+        self.dates = pd.date_range(self.start, self.end, freq='D')
+        base_url = base_url or GRIDMET_URL
+        years = range(self.start.year, self.end.year + 1)
+        self.arrays = {var: [WeatherDataFetcher.data_variable(xr.open_dataset(f'{base_url}/{var}/{var}_{year}.nc'))
+                             for year in years]
+                       for var in REGIONAL_VARS}
+
+        first = self.arrays[REGIONAL_VARS[0]][0]
+        lats, lons = first['lat'].to_numpy(), first['lon'].to_numpy()
+        west, south, east, north = bbox
+        lat_idx = np.where((lats >= south) & (lats <= north))[0]
+        lon_idx = np.where((lons >= west) & (lons <= east))[0]
+        if not len(lat_idx) or not len(lon_idx):
+            raise ValueError('The bounding box does not contain any gridMET cell.')
+        self.lat_slice = slice(lat_idx[0], lat_idx[-1] + 1)
+        self.lon_slice = slice(lon_idx[0], lon_idx[-1] + 1)
+        self.lats, self.lons = lats[self.lat_slice], lons[self.lon_slice]
+        self.elevation_url = f'{base_url}/{ELEVATION_FILE}'
+        self._elevation = None
+
+    def elevation(self):
+        '''
+        Elevation of the cells of the bbox (m), read once from the gridMET elevation grid.
+
+        Returns:
+        --------
+        numpy.ndarray
+            float64 array of shape (lats, lons), NaN outside the gridMET mask.
+        '''
+        import xarray as xr
+
+        if self._elevation is None:
+            dataset = xr.open_dataset(self.elevation_url)
+            da = next(da for da in dataset.data_vars.values() if {'lat', 'lon'} <= set(da.dims))
+            da = da.isel({dim: 0 for dim in da.dims if dim not in ('lat', 'lon')})
+            da = da.sel(lat=self.lats, lon=self.lons, method='nearest')
+            self._elevation = da.transpose('lat', 'lon').to_numpy().astype('float64')
+        return self._elevation
+
+    def tiles(self, tile=TILE_CELLS):
+        '''(lat slice, lon slice) of each tile, relative to the bbox.'''
+        for i in range(0, len(self.lats), tile):
+            for j in range(0, len(self.lons), tile):
+                yield slice(i, min(i + tile, len(self.lats))), slice(j, min(j + tile, len(self.lons)))
+
+    def read(self, lat_tile, lon_tile):
+        '''
+        Reads the season of one tile for every variable, in pyfao56 units.
+
+        Returns:
+        --------
+        dict
+            var -> float64 array of shape (days, tile lats, tile lons).
+        '''
+        lat_slice = slice(self.lat_slice.start + lat_tile.start, self.lat_slice.start + lat_tile.stop)
+        lon_slice = slice(self.lon_slice.start + lon_tile.start, self.lon_slice.start + lon_tile.stop)
+        data = {}
+        for var, arrays in self.arrays.items():
+            parts = []
+            for da in arrays:
+                # Only the indexed slice is read from the file (lazy indexing)
+                part = da.isel(lat=lat_slice, lon=lon_slice).sel(day=slice(self.start, self.end))
+                parts.append(part.transpose('day', 'lat', 'lon').to_numpy().astype('float64'))
+            data[var] = np.concatenate(parts, axis=0)
+        data['srad'] = data['srad'] * 0.0864  # W/m2 -> MJ/m2/d
+        data['tmmx'] = data['tmmx'] - 273.15  # K -> C
+        data['tmmn'] = data['tmmn'] - 273.15
+        return data
+
+
+def run_regional(bbox, start, end, crop, soil_data, output, z=None, mode='summary', irrigate=True, mad=None,
+                 base_url=None, tile=TILE_CELLS, wndht=10):
+    '''
+    Runs the regional water balance over every gridMET cell of a bbox and writes it to NetCDF.
+
+    Parameters:
+    -----------
+    bbox : tuple
+        (west, south, east, north) in decimal degrees.
+    start, end : str
+        Planting and maturity dates (YYYY-MM-DD).
+    crop : str
+        Crop name of main.crop_data.
+    soil_data : dict
+        Soil in the layout of the soil page ('layers' with bottom_depth, field_capacity, wilting_point, initial_moisture).
+    output : str
+        Path of the NetCDF file.
+    z : float, optional
+        Elevation used for the ETo of every cell (m). Defaults to the elevation of each cell from the gridMET elevation grid
+        (`DEFAULT_ELEVATION` everywhere when the grid cannot be opened).
+    mode : str
+        'summary' (season totals per cell) or 'daily' (daily rasters).
+    irrigate : bool
+        Automatic irrigation (True) or rainfed (False).
+    mad : float, optional
+        Management allowed depletion, defaults to the crop's adjusted p.
+    tile : int
+        Tile size in cells; memory use is about days x tile^2 x 15 x 8 bytes.
+
+    Returns:
+    --------
+    str
+        `output`.
+    '''
+    import netCDF4
+
+    if mode not in ('summary', 'daily'):
+        raise ValueError("mode must be 'summary' or 'daily'")
+    cube = GridmetCube(bbox, start, end, base_url)
+    params = crop_parameters(crop, start, end)
+    fc, wp, theta_ini = soil_parameters(soil_data)
+    kcb = kcb_curve(len(cube.dates), params)
+    doy = cube.dates.dayofyear.to_numpy(dtype=float)[:, None]
+    elevation = None
+    if z is None:
+        try:
+            elevation = cube.elevation()
+        except Exception as e:
+            logging.warning(f"gridMET elevation grid unavailable ({str(e)}), using {DEFAULT_ELEVATION} m for every cell")
+            z = DEFAULT_ELEVATION
+
+    variables = SUMMARY_VARS if mode == 'summary' else DAILY_VARS
+    tmp_output = output + '.part'
+    with netCDF4.Dataset(tmp_output, 'w') as nc:
+        nc.title = f'FAO-56 regional water balance ({crop}, {start} to {end})'
+        nc.crop, nc.season_start, nc.season_end = crop, str(start), str(end)
+        nc.irrigation = f"auto (mad={'p' if mad is None else mad})" if irrigate else 'rainfed'
+        nc.elevation = 'gridMET elevation of each cell' if elevation is not None else f'{z} m for every cell'
+        dims = ('lat', 'lon')
+        nc.createDimension('lat', len(cube.lats))
+        nc.createDimension('lon', len(cube.lons))
+        nc.createVariable('lat', 'f8', ('lat',))[:] = cube.lats
+        nc.createVariable('lon', 'f8', ('lon',))[:] = cube.lons
+        if mode == 'daily':
+            nc.createDimension('day', len(cube.dates))
+            day = nc.createVariable('day', 'i4', ('day',))
+            day.units = f"days since {cube.dates[0].strftime('%Y-%m-%d')}"
+            day[:] = np.arange(len(cube.dates))
+            dims = ('day',) + dims
+        for name, (units, long_name) in variables.items():
+            var = nc.createVariable(name, 'f4', dims, zlib=True, fill_value=np.float32(np.nan))
+            var.units, var.long_name = units, long_name
+
+        for lat_tile, lon_tile in cube.tiles(tile):
+            data = cube.read(lat_tile, lon_tile)
+            shape = data['srad'].shape
+            flat = {var: values.reshape(shape[0], -1) for var, values in data.items()}
+            lat = np.repeat(cube.lats[lat_tile], shape[2])[None, :]
+            z_cells = elevation[lat_tile, lon_tile].reshape(1, -1) if elevation is not None else z
+            eto, _ = refet_daily(doy, flat['srad'], flat['tmmx'], flat['tmmn'], z_cells, lat, rhmax=flat['rmax'],
+                                 rhmin=flat['rmin'], wndsp=flat['vs'], wndht=wndht)
+            wb = water_balance(eto, flat['pr'], kcb, params, fc, wp, theta_ini, mad=mad, irrigate=irrigate)
+
+            if mode == 'summary':
+                with np.errstate(invalid='ignore'):
+                    fields = {
+                        'ETo': eto.sum(axis=0), 'ETc': wb['ETc'].sum(axis=0), 'ETa': wb['ETa'].sum(axis=0),
+                        'Irrig': wb['Irrig'].sum(axis=0), 'Rain': flat['pr'].sum(axis=0),
+                        'Runoff': wb['Runoff'].sum(axis=0), 'DP': wb['DP'].sum(axis=0),
+                        'Irrig_events': (wb['Irrig'] > 0).sum(axis=0), 'Dr_end': wb['Dr'][-1],
+                        'fDr_max': wb['fDr'].max(axis=0),
+                    }
+                # Cells without data (outside the gridMET mask) stay NaN
+                missing = np.isnan(eto).all(axis=0)
+                for name, values in fields.items():
+                    values = np.where(missing, np.nan, values).astype('float32')
+                    nc[name][lat_tile, lon_tile] = values.reshape(shape[1], shape[2])
+            else:
+                for name in DAILY_VARS:
+                    nc[name][:, lat_tile, lon_tile] = wb[name].reshape(shape)
+    os.replace(tmp_output, output)
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regional FAO-56 water balance over the gridMET cells of a bounding box.')
+    parser.add_argument('--bbox', nargs=4, type=float, required=True, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+    parser.add_argument('--start', required=True, help='Planting date (YYYY-MM-DD).')
+    parser.add_argument('--end', required=True, help='Maturity date (YYYY-MM-DD).')
+    parser.add_argument('--crop', default='potato')
+    parser.add_argument('--field-capacity', type=float, default=30, help='Volumetric %%.')
+    parser.add_argument('--wilting-point', type=float, default=12, help='Volumetric %%.')
+    parser.add_argument('--initial-moisture', type=float, default=25, help='Volumetric %%.')
+    parser.add_argument('--depth', type=float, default=150, help='Soil depth (cm).')
+    parser.add_argument('--elevation', type=float,
+                        help='Elevation used for the ETo of every cell (m). Defaults to the gridMET elevation of each cell.')
+    parser.add_argument('--mode', choices=['summary', 'daily'], default='summary')
+    parser.add_argument('--rainfed', action='store_true', help='No automatic irrigation.')
+    parser.add_argument('--mad', type=float, help='Management allowed depletion (fraction of TAW), defaults to p.')
+    parser.add_argument('--tile', type=int, default=TILE_CELLS, help='Tile size in cells.')
+    parser.add_argument('--base-url', help='Root of the gridMET files, defaults to the gridmet_url setting.')
+    parser.add_argument('--output', required=True, help='NetCDF file to write.')
+    args = parser.parse_args()
+
+    soil = {'layers': [{'bottom_depth': args.depth, 'field_capacity': args.field_capacity,
+                        'wilting_point': args.wilting_point, 'initial_moisture': args.initial_moisture}]}
+    path = run_regional(tuple(args.bbox), args.start, args.end, args.crop, soil, args.output, z=args.elevation,
+                        mode=args.mode, irrigate=not args.rainfed, mad=args.mad, base_url=args.base_url, tile=args.tile)
+    print(f'Written {path}')
@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from main.export import export_frame
+from main.schema import compact_output
+from main.table_store import pack_table, unpack_table
+
+'''Note: Persistent store of the simulation runs. `mdl.odata` and `mdl.swbdata` used to live only in the results cache, which
+expires with the weather files, so comparing a field with its previous seasons meant simulating them again. Every simulation that
+is computed (results page, JSON API, nightly refresh) is recorded here, in a SQLite database (`run_store_path` in the .env file):
+- `runs`: one row per run with the field (its location), crop, season (planting year), dates, a hash of the crop, soil and
+  irrigation parameters, the weather version and forecast issue, and the seasonal water balance (`swbdata`) as columns, indexed by
+  field, crop, season and parameter hash, so queries such as "potato fields with more than 300 mm of irrigation" are plain SQL;
+- `run_daily`: the daily output of the run in compact types (see `compact_output`), packed column by column (`pack_table`),
+  with a `Forecast` column (True for the days simulated from the forecast).
+A run is identified by its field, crop, planting and maturity dates, parameters and kind (observed weather only, or continued by a
+forecast): simulating the same season again (new weather days, new forecast issue) replaces the previous run of that kind, so a
+forecast run never replaces the observed run of the season, while other seasons and scenarios are kept. The water balance of a
+forecast run includes its forecast days. Set `run_store=off` to disable the recording.
+
+    python -m main.run_store find --crop potato --min Irrig=300
+    python -m main.run_store history 43.6089,-116.1941 --crop potato --seasons 3'''
+
+RUN_STORE_PATH = os.getenv('run_store_path', os.path.join('cache', 'run_store.db'))
+RUN_STORE_ENABLED = os.getenv('run_store', 'on').lower() in ('1', 'on', 'true', 'yes')
+
+# Seasonal water balance of pyfao56 (`Model.swbdata`), in mm
+SUMMARY_COLUMNS = ['ETref', 'ETcm', 'ETcb', 'ETmax', 'ETc', 'ETa', 'E', 'T', 'DP', 'Irrig', 'IrrLoss', 'Rain', 'Runoff',
+                   'Dr_ini', 'Dr_end', 'Drmax_ini', 'Drmax_end']
+RUN_COLUMNS = ['run_id', 'field', 'crop', 'season', 'planting_date', 'maturity_date', 'last_day', 'params_hash',
+               'weather_version', 'forecast_issue', 'created']
+
+
+def field_key(lat, lon):
+    '''Key of the field of a location: latitude and longitude rounded to 4 decimals (about 10 m).'''
+    return f'{float(lat):.4f},{float(lon):.4f}'
+
+
+def params_hash(plant_data, soil_data, irri_data):
+    '''Hash (16 hex characters) of the crop, soil and irrigation parameters of a simulation.'''
+    params = json.dumps([plant_data.get('plant_properties'), soil_data, irri_data], sort_keys=True, default=str)
+    return hashlib.sha256(params.encode()).hexdigest()[:16]
+
+
+class RunStore:
+    def __init__(self, path=RUN_STORE_PATH):
+        """
+        Initializes the store. The database is created on first use.
+
+        Args:
+        path (str): Path of the SQLite database.
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        """Returns the connection of the current thread, reconnecting after a fork."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        summary = ', '.join(f'{col} REAL' for col in SUMMARY_COLUMNS)
+        conn.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, field TEXT, crop TEXT, season INTEGER, '
+                     'planting_date TEXT, maturity_date TEXT, last_day TEXT, params_hash TEXT, weather_version TEXT, '
+                     f'forecast_issue TEXT, created REAL, inputs TEXT, {summary})')
+        conn.execute('CREATE TABLE IF NOT EXISTS run_daily (run_id TEXT PRIMARY KEY, data BLOB)')
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_field ON runs (field, crop, season)')
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_crop ON runs (crop, season)')
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_params ON runs (params_hash)')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def record(self, plant_data, weather_data, soil_data, irri_data, odata, swbdata, weather_version=None,
+               forecast_issue=None, forecast_start=None):
+        """
+        Stores a simulation run, replacing the previous run of the same field, crop, season, parameters and kind (with or
+        without forecast).
+
+        Args:
+        plant_data, weather_data, soil_data, irri_data (dict): Inputs of the simulation, as kept in the session.
+        odata (pd.DataFrame): Daily output of the model (`mdl.odata`).
+        swbdata (dict): Seasonal water balance of the model (`mdl.swbdata`).
+        weather_version (str): Version of the weather data (file modification time, or a hash of inline data).
+        forecast_issue (str): Issue time of the forecast used after the last observed day, if any.
+        forecast_start (str): First forecast day (YYYY-MM-DD) of a run with a forecast.
+
+        Returns:
+        str: Id of the run ('run_' followed by 16 hex characters).
+        """
+        field = field_key(weather_data.get('latitude'), weather_data.get('longitude'))
+        crop = plant_data.get('crop')
+        planting = pd.to_datetime(plant_data.get('planting_date'))
+        maturity = pd.to_datetime(plant_data.get('maturity_date'))
+        phash = params_hash(plant_data, soil_data, irri_data)
+        kind = 'observed' if forecast_issue is None else 'forecast'
+        identity = f'{field}:{crop}:{planting.date()}:{maturity.date()}:{phash}:{kind}'
+        run_id = 'run_' + hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+        daily = export_frame(compact_output(odata))
+        days = pd.to_datetime(daily['Year-DOY'], format='%Y-%j')
+        daily['Forecast'] = days >= pd.to_datetime(forecast_start) if forecast_start is not None else False
+        last_day = days.iloc[-1].strftime('%Y-%m-%d') if len(daily) else None
+        inputs = json.dumps({'plant': plant_data, 'weather': weather_data, 'soil': soil_data, 'irrigation': irri_data},
+                            sort_keys=True, default=str)
+        row = [run_id, field, crop, planting.year, planting.strftime('%Y-%m-%d'), maturity.strftime('%Y-%m-%d'), last_day, phash,
+               None if weather_version is None else str(weather_version), forecast_issue, time.time(), inputs]
+        row += [None if swbdata.get(col) is None else float(swbdata[col]) for col in SUMMARY_COLUMNS]
+
+        names = RUN_COLUMNS + ['inputs'] + SUMMARY_COLUMNS
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f'INSERT OR REPLACE INTO runs ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})', row)
+            conn.execute('INSERT OR REPLACE INTO run_daily (run_id, data) VALUES (?, ?)', (run_id, pack_table(daily)))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return run_id
+
+    def find_runs(self, field=None, crop=None, season=None, params_hash=None, min_values=None, max_values=None, limit=None):
+        """
+        Returns the runs matching all the given criteria, latest season first.
+
+        Args:
+        field (str): Field key (see `field_key`).
+        crop (str): Crop name.
+        season (int or list): Season (planting year) or seasons.
+        params_hash (str): Hash of the parameters (see `params_hash`).
+        min_values, max_values (dict): Bounds on seasonal water balance columns (`SUMMARY_COLUMNS`), e.g. {'Irrig': 300}.
+        limit (int): Maximum number of runs.
+
+        Returns:
+        pd.DataFrame: One row per run with `RUN_COLUMNS` and `SUMMARY_COLUMNS`.
+        """
+        clauses, params = [], []
+        for column, value in (('field', field), ('crop', crop), ('params_hash', params_hash)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        if season is not None:
+            seasons = [int(s) for s in (season if isinstance(season, (list, tuple, set)) else [season])]
+            clauses.append(f'season IN ({", ".join("?" * len(seasons))})')
+            params += seasons
+        for bounds, operator in ((min_values, '>='), (max_values, '<=')):
+            for column, value in (bounds or {}).items():
+                if column not in SUMMARY_COLUMNS:
+                    raise ValueError(f'Unknown water balance column: {column}')
+                clauses.append(f'{column} {operator} ?')
+                params.append(float(value))
+
+        query = f'SELECT {", ".join(RUN_COLUMNS + SUMMARY_COLUMNS)} FROM runs'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY season DESC, planting_date DESC, created DESC'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        if not os.path.exists(self.path):
+            return pd.DataFrame(columns=RUN_COLUMNS + SUMMARY_COLUMNS)
+        return pd.read_sql_query(query, self._connect(), params=params)
+
+    def season_history(self, field, crop=None, seasons=3, params_hash=None):
+        """
+        Returns the runs of a field for its latest season and the `seasons` seasons before it (one run per season: the
+        latest recorded, observed runs before forecast runs), latest first.
+
+        Args:
+        field (str): Field key (see `field_key`).
+        crop (str): Only the seasons of this crop.
+        seasons (int): Number of previous seasons.
+        params_hash (str): Only the runs with these parameters.
+
+        Returns:
+        pd.DataFrame: Same columns as `find_runs`.
+        """
+        runs = self.find_runs(field=field, crop=crop, params_hash=params_hash)
+        runs = runs.assign(observed=runs['forecast_issue'].isna())
+        runs = runs.sort_values(['season', 'observed', 'created'], ascending=False).drop_duplicates('season')
+        return runs.drop(columns='observed').head(seasons + 1).reset_index(drop=True)
+
+    def load_daily(self, run_id):
+        """
+        Returns the daily output of a run, in the layout of the results export ('Year-DOY' first, unique columns).
+
+        Raises:
+        KeyError: When the run is not in the store.
+        """
+        row = self._connect().execute('SELECT data FROM run_daily WHERE run_id = ?', (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(run_id)
+        return unpack_table(row[0])
+
+    def daily_history(self, run_ids, columns=('ETa', 'Irrig', 'Rain', 'Dr', 'Forecast')):
+        """
+        Daily outputs of several runs aligned on the days after planting, e.g. to plot a field against its previous seasons.
+
+        Returns:
+        pd.DataFrame: Long table with run_id, season, DAP (day after planting, 1 on the planting day), Year-DOY and `columns`.
+        """
+        frames = []
+        for run_id in run_ids:
+            daily = self.load_daily(run_id)
+            if 'Forecast' not in daily:  # Recorded before the forecast days were marked
+                daily['Forecast'] = False
+            days = pd.to_datetime(daily['Year-DOY'], format='%Y-%j')
+            frame = daily[['Year-DOY', *columns]].copy()
+            frame.insert(0, 'DAP', (days - days.iloc[0]).dt.days.to_numpy() + 1)
+            frame.insert(0, 'season', int(days.iloc[0].year))
+            frame.insert(0, 'run_id', run_id)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['run_id', 'season', 'DAP', 'Year-DOY',
+                                                                                          *columns])
+
+    def remove(self, run_id):
+        """Removes a run. Returns True when it was stored."""
+        conn = self._connect()
+        conn.execute('DELETE FROM run_daily WHERE run_id = ?', (run_id,))
+        return conn.execute('DELETE FROM runs WHERE run_id = ?', (run_id,)).rowcount > 0
+
+
+runs = RunStore()
+
+
+def record_run(plant_data, weather_data, soil_data, irri_data, odata, swbdata, weather_version=None, forecast_issue=None,
+               forecast_start=None):
+    '''Records a computed simulation in the run store (see `RunStore.record`). Failures are logged, never raised to the caller.'''
+    if not RUN_STORE_ENABLED:
+        return None
+    try:
+        return runs.record(plant_data, weather_data, soil_data, irri_data, odata, swbdata, weather_version, forecast_issue,
+                           forecast_start)
+    except Exception as e:
+        logging.error(f"Run not recorded in the run store: {str(e)}")
+        return None
+
+
+def _bounds(values):
+    '''{'Irrig': 300.0} from ['Irrig=300'] (command line).'''
+    return {name: float(value) for name, value in (item.split('=', 1) for item in values or [])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Queries the store of simulation runs.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    find_parser = commands.add_parser('find', help='Runs matching the criteria.')
+    find_parser.add_argument('--field', help='Field key (lat,lon with 4 decimals).')
+    find_parser.add_argument('--crop')
+    find_parser.add_argument('--season', type=int, nargs='*')
+    find_parser.add_argument('--min', nargs='*', metavar='COLUMN=VALUE', help='Lower bounds of water balance columns.')
+    find_parser.add_argument('--max', nargs='*', metavar='COLUMN=VALUE', help='Upper bounds of water balance columns.')
+    find_parser.add_argument('--limit', type=int)
+    history_parser = commands.add_parser('history', help='A field against its previous seasons.')
+    history_parser.add_argument('field', help='Field key (lat,lon with 4 decimals).')
+    history_parser.add_argument('--crop')
+    history_parser.add_argument('--seasons', type=int, default=3)
+    daily_parser = commands.add_parser('daily', help='Daily output of a run as CSV.')
+    daily_parser.add_argument('run_id')
+    args = parser.parse_args()
+
+    pd.set_option('display.width', 200)
+    if args.command == 'find':
+        print(runs.find_runs(field=args.field, crop=args.crop, season=args.season or None, min_values=_bounds(args.min),
+                             max_values=_bounds(args.max), limit=args.limit).to_string(index=False))
+    elif args.command == 'history':
+        print(runs.season_history(field_key(*args.field.split(',')), crop=args.crop, seasons=args.seasons)
+              .to_string(index=False))
+    elif args.command == 'daily':
+        print(runs.load_daily(args.run_id).to_csv(index=False), end='')
@@ -0,0 +1,302 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+
+# The scheduler runs in its own process: load the app's .env settings before the modules that read them at import time
+load_dotenv()
+
+from main.gridMET_fetch import WeatherDataFetcher
+from main.shared_cache import cache
+from main.table_store import restore_table, table_blob
+from main.utils import save_weather_data, weather_records
+
+'''Note: Nightly precomputation of registered fields. A simulation used to run only when a user clicked through the four form
+pages, so every morning the results of the same fields were computed again while growers were waiting. Fields are registered from
+the results page (the session inputs are kept in a SQLite registry, `field_registry_path` in the .env file), and every night at
+`scheduler_time`:
+1. the gridMET weather of all registered fields is fetched once per grid cell for the union of their seasons, and written to the
+   weather store only for the locations whose data changed (new days or revised values), so unchanged fields keep their cached
+   results;
+2. every field is simulated in a process pool (`scheduler_workers`) through the same cached functions as the results page,
+   including the forecast extension, and its download plot is rendered into the plot cache.
+Results are kept for `NIGHTLY_TTL`, and the weather files of registered fields are not deleted after 6 hours, so at peak time the
+results page only reads the caches. Uploaded weather is not refreshed (there is nothing to fetch), and uploaded irrigation tables
+are kept in the registry and put back in the table store under the same reference.
+
+    python -m main.scheduler serve          runs every night at scheduler_time
+    python -m main.scheduler run            refreshes all fields now (e.g. from cron)
+    python -m main.scheduler list'''
+
+REGISTRY_PATH = os.getenv('field_registry_path', os.path.join('cache', 'field_registry.db'))
+SCHEDULER_TIME = os.getenv('scheduler_time', '02:00')
+SCHEDULER_WORKERS = int(os.getenv('scheduler_workers', os.cpu_count() or 1))
+
+NIGHTLY_TTL = 30 * 3600  # Until the next night's refresh, with some margin
+GRIDMET_VARS = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+
+
+class FieldRegistry:
+    def __init__(self, path=REGISTRY_PATH):
+        """
+        Initializes the registry. The database is created on first use.
+
+        Args:
+        path (str): Path of the SQLite database.
+        """
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        """Returns the connection of the current thread, reconnecting after a fork."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS fields (id TEXT PRIMARY KEY, name TEXT, inputs TEXT, irrigation_table BLOB, '
+                     'registered REAL, last_run REAL, last_status TEXT, last_seconds REAL)')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def register(self, plant_data, weather_data, soil_data, irri_data, name=None):
+        """
+        Registers a field (the session inputs) for the nightly refresh. Registering the same inputs again keeps one field.
+
+        Args:
+        plant_data, weather_data, soil_data, irri_data (dict): Inputs as kept in the session.
+        name (str): Optional name shown in the listing.
+
+        Returns:
+        str: Id of the field ('fld_' followed by 16 hex characters).
+        """
+        inputs = json.dumps({'plant': plant_data, 'weather': weather_data, 'soil': soil_data, 'irrigation': irri_data},
+                            sort_keys=True, default=str)
+        field_id = 'fld_' + hashlib.sha256(inputs.encode()).hexdigest()[:16]
+        # Uploaded irrigation tables expire from the table store; the registry keeps its own copy
+        blob = table_blob(irri_data['table_ref']) if irri_data and 'table_ref' in irri_data else None
+        self._connect().execute(
+            'INSERT INTO fields (id, name, inputs, irrigation_table, registered) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET name = excluded.name, irrigation_table = excluded.irrigation_table',
+            (field_id, name or plant_data.get('crop'), inputs, blob, time.time()))
+        return field_id
+
+    def remove(self, field_id):
+        """Removes a field. Returns True when it was registered."""
+        return self._connect().execute('DELETE FROM fields WHERE id = ?', (field_id,)).rowcount > 0
+
+    def fields(self):
+        """
+        Returns the registered fields.
+
+        Returns:
+        list: One dict per field with id, name, plant, weather, soil, irrigation, irrigation_table, registered, last_run,
+            last_status and last_seconds.
+        """
+        rows = self._connect().execute('SELECT id, name, inputs, irrigation_table, registered, last_run, last_status, '
+                                       'last_seconds FROM fields ORDER BY registered').fetchall()
+        fields = []
+        for field_id, name, inputs, blob, registered, last_run, last_status, last_seconds in rows:
+            fields.append({'id': field_id, 'name': name, **json.loads(inputs), 'irrigation_table': blob,
+                           'registered': registered, 'last_run': last_run, 'last_status': last_status,
+                           'last_seconds': last_seconds})
+        return fields
+
+    def record_run(self, field_id, status, seconds):
+        """Stores the outcome of the last refresh of a field."""
+        self._connect().execute('UPDATE fields SET last_run = ?, last_status = ?, last_seconds = ? WHERE id = ?',
+                                (time.time(), status, seconds, field_id))
+
+    def weather_files(self):
+        """Names of the weather store files of the registered fields (kept by `delete_old_files`)."""
+        if not os.path.exists(self.path):
+            return set()
+        rows = self._connect().execute('SELECT inputs FROM fields').fetchall()
+        files = set()
+        for (inputs,) in rows:
+            weather = json.loads(inputs)['weather']
+            files.add(f"weather_{weather.get('latitude')}_{weather.get('longitude')}.json")
+        return files
+
+
+registry = FieldRegistry()
+
+
+def refresh_weather(fields, today=None):
+    '''
+    Fetches the gridMET weather of the fields once per grid cell and stores it for the locations whose data changed.
+
+    Parameters:
+    -----------
+    fields : list
+        Registered fields (see `FieldRegistry.fields`). Fields with uploaded weather or not planted yet are skipped.
+    today : str or pd.Timestamp, optional
+        Day of the refresh. Defaults to the current day.
+
+    Returns:
+    --------
+    dict
+        Counts of grid cells fetched, locations stored, locations unchanged and cells that failed.
+    '''
+    today = pd.Timestamp.now().normalize() if today is None else pd.to_datetime(today)
+    cells = {}  # cell -> {(lat, lon): [start, end]}
+    for field in fields:
+        weather = field['weather']
+        start = pd.to_datetime(field['plant'].get('planting_date'))
+        end = min(pd.to_datetime(field['plant'].get('maturity_date')), today)
+        if weather.get('data_source') != 'fetch' or start > today:
+            continue
+        location = (weather.get('latitude'), weather.get('longitude'))
+        cell = WeatherDataFetcher.snap_to_grid(*location)
+        span = cells.setdefault(cell, {}).setdefault(location, [start, end])
+        span[0], span[1] = min(span[0], start), max(span[1], end)
+
+    stats = {'cells': 0, 'stored': 0, 'unchanged': 0, 'failed': 0}
+    for cell, locations in cells.items():
+        start = min(span[0] for span in locations.values())
+        end = max(span[1] for span in locations.values())
+        lat, lon = next(iter(locations))
+        try:
+            fetcher = WeatherDataFetcher(float(lat), float(lon), GRIDMET_VARS, cache=cache)
+            data = WeatherDataFetcher.unit_conversion_pyfao56(
+                fetcher.fetch_data_for_date_range(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        except Exception as e:
+            logging.error(f"Nightly weather refresh failed for cell {cell}: {str(e)}")
+            stats['failed'] += 1
+            continue
+        stats['cells'] += 1
+
+        dates = pd.to_datetime(data['Date'])
+        for (lat, lon), (loc_start, loc_end) in locations.items():
+            records = weather_records(data[(dates >= loc_start) & (dates <= loc_end)].reset_index(drop=True))
+            # Only changed records change the weather version (and invalidate the cached results of the location)
+            if save_weather_data(lat, lon, records, merge=True):
+                stats['stored'] += 1
+            else:
+                stats['unchanged'] += 1
+    return stats
+
+
+def refresh_field(field):
+    '''
+    Simulates a registered field through the results page's cached functions and renders its download plot.
+
+    Returns:
+    --------
+    tuple
+        (field id, status, seconds)
+    '''
+    from modules.results import cached_forecast_model
+    from main.plot_cache import get_plot
+
+    started = time.perf_counter()
+    try:
+        irri_data = field['irrigation']
+        if field['irrigation_table'] is not None:
+            restore_table(irri_data['table_ref'], field['irrigation_table'])
+        odata, _, _ = cached_forecast_model(field['plant'], field['weather'], field['soil'], irri_data, ttl=NIGHTLY_TTL)
+        get_plot(odata)
+        status = 'ok'
+    except Exception as e:
+        logging.error(f"Nightly refresh failed for field {field['id']}: {str(e)}")
+        status = f'error: {str(e)}'
+    return field['id'], status, time.perf_counter() - started
+
+
+def run_nightly(today=None, workers=SCHEDULER_WORKERS):
+    '''
+    Refreshes the weather of all registered fields, then simulates them in a process pool.
+
+    Parameters:
+    -----------
+    today : str or pd.Timestamp, optional
+        Day of the refresh. Defaults to the current day.
+    workers : int
+        Worker processes, 0 simulates the fields in this process.
+
+    Returns:
+    --------
+    dict
+        Weather refresh counts (see `refresh_weather`), number of fields, failed fields and seconds.
+    '''
+    started = time.perf_counter()
+    today = pd.Timestamp.now().normalize() if today is None else pd.to_datetime(today)
+    fields = registry.fields()
+    weather = refresh_weather(fields, today)
+
+    planted = [field for field in fields if pd.to_datetime(field['plant'].get('planting_date')) <= today]
+    if workers > 0 and len(planted) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outcomes = list(pool.map(refresh_field, planted))
+    else:
+        outcomes = [refresh_field(field) for field in planted]
+
+    failed = 0
+    for field_id, status, seconds in outcomes:
+        registry.record_run(field_id, status, seconds)
+        failed += status != 'ok'
+    summary = {**weather, 'fields': len(planted), 'failed_fields': failed, 'seconds': round(time.perf_counter() - started, 2)}
+    logging.info(f'Nightly refresh: {summary}')
+    return summary
+
+
+def seconds_until(at, now=None):
+    '''Seconds from `now` until the next `at` time of day ('HH:MM').'''
+    now = pd.Timestamp.now() if now is None else pd.Timestamp(now)
+    hour, minute = (int(part) for part in at.split(':'))
+    target = now.normalize() + pd.Timedelta(hours=hour, minutes=minute)
+    if target <= now:
+        target += pd.Timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+def serve(at=SCHEDULER_TIME, workers=SCHEDULER_WORKERS):
+    '''Runs `run_nightly` every day at `at` (local time, 'HH:MM') until interrupted.'''
+    while True:
+        wait = seconds_until(at)
+        logging.info(f'Next nightly refresh in {wait / 3600:.1f} h')
+        time.sleep(wait)
+        try:
+            run_nightly(workers=workers)
+        except Exception as e:
+            logging.error(f"Nightly refresh failed: {str(e)}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    parser = argparse.ArgumentParser(description='Nightly refresh of the registered fields.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='Refresh every night at the scheduled time.')
+    serve_parser.add_argument('--at', default=SCHEDULER_TIME, help='Time of day (HH:MM).')
+    serve_parser.add_argument('--workers', type=int, default=SCHEDULER_WORKERS)
+    run_parser = commands.add_parser('run', help='Refresh all registered fields now.')
+    run_parser.add_argument('--workers', type=int, default=SCHEDULER_WORKERS)
+    commands.add_parser('list', help='List the registered fields.')
+    remove_parser = commands.add_parser('remove', help='Remove a registered field.')
+    remove_parser.add_argument('field_id')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.at, args.workers)
+    elif args.command == 'run':
+        print(json.dumps(run_nightly(workers=args.workers)))
+    elif args.command == 'list':
+        for field in registry.fields():
+            last_run = time.strftime('%Y-%m-%d %H:%M', time.localtime(field['last_run'])) if field['last_run'] else '-'
+            print(f"{field['id']}  {field['name']:<12} {field['plant'].get('planting_date')} to "
+                  f"{field['plant'].get('maturity_date')}  {field['weather'].get('latitude')}, "
+                  f"{field['weather'].get('longitude')}  last run {last_run} {field['last_status'] or ''}")
+    elif args.command == 'remove':
+        print('removed' if registry.remove(args.field_id) else 'not registered')
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+'''Note: Compact in-memory schema of the weather and output frames. The weather came out of the fetchers and the weather files as
+float64 columns plus object columns of empty strings for the values pyfao56 computes itself ('vpar', 'tdew', 'ET') and for
+'MorP', and every step (QC, ETo, `build_model`) coerced the strings again. In the compact schema:
+- 'Date' is datetime64,
+- the value columns are float32, a missing value is NaN (the column's own mask) instead of an empty string, except the ETo and
+  vapor pressure computed by main/eto.py ('ET' and 'vpar' already in float64), which stay float64 so pyfao56 gets them unrounded,
+- 'MorP' is a categorical of 'M' and 'P' (missing: measured).
+The fetchers, the upload ingest, the QC, the ETo and the forecast all return this schema, so the weather held in the shared cache
+and passed between the steps is several times smaller (about 85% less for a gridMET season, see benchmarks/bench_schema.py).
+`to_pyfao56` converts it to the float64 layout of `Weather.wdata` right before the model is built. The weather is stored with 3
+decimals, which float32 keeps exactly: `widen` goes back through the shortest decimal of each float32, so pyfao56 gets 25.123 and
+not 25.12299919, and passes float64 values through unchanged.
+
+The model output (`mdl.odata`) is float64 with Year, DOY, DOW and Date as objects, twice. `compact_output` gives the float32 form
+used to store the runs (see main/run_store.py). Results served to users are not converted: exports print them in full precision.
+
+`memory_report` compares both layouts for one field-season and for a batch of fields.'''
+
+WEATHER_COLUMNS = ['Date', 'srad', 'tmmx', 'tmmn', 'vpar', 'tdew', 'rmax', 'rmin', 'vs', 'pr', 'ET', 'MorP']
+FLOAT_COLUMNS = WEATHER_COLUMNS[1:-1]
+DERIVED_COLUMNS = ['vpar', 'ET']  # Kept in float64 once computed
+MORP_DTYPE = pd.CategoricalDtype(['M', 'P'])
+
+
+def widen(values):
+    '''
+    float64 values of a float32 (or any numeric) column. float32 values go through their shortest decimal representation, so
+    values stored with a few decimals come back exactly (float32 25.123 -> 25.123, not 25.12299919).
+    '''
+    values = np.asarray(values)
+    if values.dtype == np.float32:
+        return values.astype(str).astype('float64')
+    return values.astype('float64')
+
+
+def compact_weather(df):
+    '''
+    Weather frame in the compact schema.
+
+    Parameters:
+    -----------
+    df : pd.DataFrame
+        Weather in the layout of the weather store (see `save_weather_data`), values as numbers, strings or empty strings.
+        Missing value columns are added; other columns are kept as they are.
+
+    Returns:
+    --------
+    pd.DataFrame
+        'Date' as datetime64, `FLOAT_COLUMNS` as float32 (NaN when missing) and 'MorP' as a 'M'/'P' categorical. Float64 values
+        of the `DERIVED_COLUMNS` are kept in float64.
+    '''
+    data = {'Date': pd.to_datetime(df['Date'], errors='coerce')}
+    for col in FLOAT_COLUMNS:
+        values = pd.to_numeric(df[col], errors='coerce') if col in df else pd.Series(np.nan, index=df.index)
+        exact = col in DERIVED_COLUMNS and values.dtype == np.float64 and values.notna().any()
+        data[col] = values if exact else values.astype('float32')
+    data['MorP'] = pd.Categorical(df['MorP'] if 'MorP' in df else [None] * len(df), dtype=MORP_DTYPE)
+    compact = pd.DataFrame(data, index=df.index)
+    extra = [col for col in df.columns if col not in WEATHER_COLUMNS]
+    return pd.concat([compact, df[extra]], axis=1) if extra else compact
+
+
+def to_pyfao56(df):
+    '''
+    Weather in the compact schema (or the store layout) converted to what pyfao56 expects in `Weather.wdata`: float64 values in
+    the order of `WEATHER_COLUMNS`, and 'MorP' as 'M', 'P' or None.
+    '''
+    data = {'Date': pd.to_datetime(df['Date'], errors='coerce')}
+    for col in FLOAT_COLUMNS:
+        data[col] = widen(pd.to_numeric(df[col], errors='coerce'))
+    morp = pd.Series(pd.Categorical(df['MorP'], dtype=MORP_DTYPE), index=df.index).astype(object)
+    data['MorP'] = morp.where(morp.notna(), None)
+    return pd.DataFrame(data, index=df.index)[WEATHER_COLUMNS]
+
+
+def compact_output(odata):
+    '''
+    Model output (`mdl.odata`) in compact types: unique columns, values as float32, Year and DOY as int16, DOW and Date
+    ('Mon', 'MM/DD') as categoricals. The index is kept.
+    '''
+    df = odata.loc[:, ~odata.columns.duplicated()]
+    data = {}
+    for col in df.columns:
+        if col in ('Year', 'DOY'):
+            data[col] = pd.to_numeric(df[col]).astype('int16')
+        elif col in ('DOW', 'Date'):
+            data[col] = df[col].astype('category')
+        else:
+            data[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+    return pd.DataFrame(data, index=df.index)
+
+
+def legacy_weather(df):
+    '''Weather in the layout used before the compact schema: float64 values, empty strings for the placeholders, text dates.'''
+    legacy = to_pyfao56(compact_weather(df))
+    legacy['Date'] = legacy['Date'].dt.strftime('%Y-%m-%d')
+    for col in ['vpar', 'tdew', 'ET']:
+        legacy[col] = legacy[col].astype(object).where(legacy[col].notna(), '')
+    legacy['MorP'] = legacy['MorP'].fillna('')
+    return legacy
+
+
+def memory_report(weather, odata=None, fields=1000):
+    '''
+    Memory of the weather (and output) frames of one field-season in the legacy and compact layouts, and of a batch of `fields`
+    such field-seasons.
+
+    Parameters:
+    -----------
+    weather : pd.DataFrame
+        Weather of one season, any layout accepted by `compact_weather`.
+    odata : pd.DataFrame, optional
+        Model output of the season (`mdl.odata`).
+    fields : int
+        Number of field-seasons of the batch.
+
+    Returns:
+    --------
+    dict
+        Per frame ('weather', 'odata'): legacy and compact bytes per field-season, bytes per batch and the saved fraction.
+    '''
+    frames = {'weather': (legacy_weather(weather), compact_weather(weather))}
+    if odata is not None:
+        frames['odata'] = (odata, compact_output(odata))
+
+    report = {'fields': fields}
+    for name, (legacy, compact) in frames.items():
+        before = int(legacy.memory_usage(deep=True).sum())
+        after = int(compact.memory_usage(deep=True).sum())
+        report[name] = {
+            'days': len(legacy),
+            'legacy_bytes': before,
+            'compact_bytes': after,
+            'legacy_batch_mb': round(before * fields / 1e6, 2),
+            'compact_batch_mb': round(after * fields / 1e6, 2),
+            'saved': round(1 - after / before, 3) if before else 0.0,
+        }
+    return report
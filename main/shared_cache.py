@@ -0,0 +1,202 @@
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from main import metrics
+
+'''Note: The app runs under several worker processes, so anything cached in a process is duplicated and concurrent users of the same
+location each trigger their own THREDDS download. This module provides a local cache shared by all workers on the machine, stored in
+SQLite in WAL mode (readers never block the writer). Values are pickled, so weather frames and simulation results can be stored as is.
+
+`get_or_compute` gives single-flight semantics across threads and processes: the first caller of a key takes a lease in the `locks`
+table and computes the value, every other caller waits for the value to appear instead of computing it again. A lease expires after
+`lock_timeout` seconds so a crashed worker cannot block a key forever.'''
+
+SHARED_CACHE_PATH = os.getenv('shared_cache_path', os.path.join('cache', 'shared_cache.db'))
+
+
+class SharedCache:
+    def __init__(self, path=SHARED_CACHE_PATH, lock_timeout=300, poll_interval=0.1):
+        """
+        Initializes the cache. The database is created on first use.
+
+        Args:
+        path (str): Path of the SQLite database shared by the workers.
+        lock_timeout (float): Lifetime of a computation lease in seconds.
+        poll_interval (float): Seconds between checks while waiting for another worker's computation.
+        """
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.owner = uuid.uuid4().hex
+        self._local = threading.local()
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+    def _connect(self):
+        """Returns the connection of the current thread, reconnecting after a fork."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, created REAL, expires REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value of `key`, or `default` if it is missing or expired.
+        """
+        row = self._connect().execute('SELECT value, expires FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return pickle.loads(row[0])
+
+    def contains(self, key):
+        """
+        Returns whether `key` has a value that has not expired, without loading it.
+        """
+        row = self._connect().execute('SELECT expires FROM entries WHERE key = ?', (key,)).fetchone()
+        return row is not None and (row[0] is None or row[0] >= time.time())
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores `value` under `key`.
+
+        Args:
+        key (str): Cache key.
+        value: Any picklable value.
+        ttl (float): Time to live in seconds. None keeps the value until it is deleted.
+        """
+        now = time.time()
+        self._connect().execute('INSERT OR REPLACE INTO entries (key, value, created, expires) VALUES (?, ?, ?, ?)',
+                                (key, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), now,
+                                 None if ttl is None else now + ttl))
+        if random.random() < 0.01:  # Purge expired entries now and then
+            self.purge_expired()
+
+    def delete(self, key):
+        """Removes `key` from the cache."""
+        self._connect().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def purge_expired(self):
+        """Deletes expired entries and leases."""
+        now = time.time()
+        conn = self._connect()
+        conn.execute('DELETE FROM entries WHERE expires IS NOT NULL AND expires < ?', (now,))
+        conn.execute('DELETE FROM locks WHERE expires < ?', (now,))
+
+    def _acquire(self, key):
+        """Takes the computation lease of `key` if nobody else holds a valid one."""
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM locks WHERE key = ? AND expires < ?', (key, now))
+            acquired = conn.execute('INSERT OR IGNORE INTO locks (key, owner, expires) VALUES (?, ?, ?)',
+                                    (key, self.owner, now + self.lock_timeout)).rowcount == 1
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return acquired
+
+    def _release(self, key):
+        self._connect().execute('DELETE FROM locks WHERE key = ? AND owner = ?', (key, self.owner))
+
+    @contextmanager
+    def _key_lock(self, key):
+        """Holds the lock of `key` among the threads of this worker. It is removed once no thread holds or waits for it."""
+        with self._key_locks_lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1  # Threads holding or waiting for the lock
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._key_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        """
+        Holds the lease of `key` for the duration of a `with` block: a mutex shared by the threads and workers (e.g. around
+        the read-modify-write of a file).
+
+        Args:
+        key (str): Name of the lock.
+        timeout (float): Seconds to wait for the lock before raising TimeoutError. None waits until it is free.
+        """
+        key = 'lock:' + key
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._key_lock(key):
+            while not self._acquire(key):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f'Lock {key} is held by another worker')
+                time.sleep(self.poll_interval)
+            try:
+                yield
+            finally:
+                self._release(key)
+
+    def get_or_compute(self, key, compute, ttl=None, name='shared_cache'):
+        """
+        Returns the cached value of `key`, computing it once across all threads and workers if it is missing.
+
+        Args:
+        key (str): Cache key.
+        compute (callable): Function without arguments returning the value.
+        ttl (float): Time to live of the computed value in seconds.
+        name (str): Cache name reported in the metrics.
+
+        Returns:
+        The cached or computed value.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            metrics.cache_event(name, hit=True)
+            return value
+
+        # Threads of this worker queue on a local lock, workers on the lease in the database
+        with self._key_lock(key):
+            while True:
+                value = self.get(key, missing)
+                if value is not missing:
+                    metrics.cache_event(name, hit=True)
+                    return value
+
+                if self._acquire(key):
+                    try:
+                        # The previous holder may have stored the value just before releasing its lease
+                        value = self.get(key, missing)
+                        if value is not missing:
+                            metrics.cache_event(name, hit=True)
+                            return value
+                        metrics.cache_event(name, hit=False)
+                        value = compute()
+                        self.set(key, value, ttl)
+                        return value
+                    finally:
+                        self._release(key)
+
+                time.sleep(self.poll_interval)
+
+
+# Cache shared by the app modules
+cache = SharedCache()
@@ -0,0 +1,88 @@
+import threading
+from main import metrics
+
+'''Note: In-process coalescing of identical concurrent calls ("single flight"). When a workshop of growers enters the same demo
+coordinates, every POST to the weather page asked THREDDS for the same location and season at the same time. With `SingleFlight`,
+the first caller of a key runs the call and the callers arriving while it is in flight wait for it and get the same result (or the
+same exception) instead of running it again. Nothing is kept once the call has finished: this is not a cache.
+
+Coalescing is per worker process. Across workers, the yearly gridMET downloads are already coalesced by the lease of the shared
+cache (see main/shared_cache.py), so concurrent workers still share one download per year.
+
+The counters of each flight group (calls run, calls coalesced, errors, calls in flight) are kept in `stats()` and exported to
+`/metrics` when the metrics are enabled.'''
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name):
+        """
+        Initializes a group of coalesced calls.
+
+        Args:
+        name (str): Name of the group in the statistics and metrics.
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {'leaders': 0, 'coalesced': 0, 'errors': 0}
+
+    def do(self, key, func):
+        """
+        Runs `func()` unless a call with the same key is in flight, in which case its result is awaited and shared.
+
+        Args:
+        key (hashable): Identity of the call (e.g. location and date window).
+        func (callable): Function without arguments.
+
+        Returns:
+        The result of the call. The same object is returned to every coalesced caller, so it must not be modified in place.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats['leaders'] += 1
+            else:
+                call.waiters += 1
+                self._stats['coalesced'] += 1
+        metrics.flight_event(self.name, 'leader' if leader else 'coalesced')
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self._stats['errors'] += 1
+            metrics.flight_event(self.name, 'error')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """
+        Returns the counters of the group.
+
+        Returns:
+        dict: leaders (calls run), coalesced (calls that waited for a leader), errors (failed leaders) and in_flight (calls
+            running now).
+        """
+        with self._lock:
+            return {**self._stats, 'in_flight': len(self._calls)}
@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+from main.crop_data import CROP_COEFFICIENTS, CROP_STAGE_LENGTHS, CROP_PROPERTIES, CN2
+from main.pyfao56_mod import gdd_daily, refet_daily
+
+'''Note: Planting-date advice means evaluating every possible planting day in a window for every crop. Re-running `gdd`, `crop_stage`
+and a full pyfao56 simulation for each candidate is far too slow, so this module precomputes prefix sums (cumulative arrays with a
+leading zero) of daily GDD, ETo and rain over the whole weather record once. The total of any variable between day i and day j is then
+simply `c[j+1] - c[i]`, which gives the season end, the adjusted stage lengths and the seasonal totals of every candidate in O(1).
+Only the shortlisted dates are sent to a full `fao.Model` run through `simulate_model`.'''
+
+
+def prefix_sum(values):
+    """
+    Cumulative sum with a leading zero, treating NaN as 0.
+
+    Parameters
+    ----------
+    values : array-like
+        Daily values.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of length `len(values) + 1` where `c[j+1] - c[i]` is the sum of `values[i:j+1]`.
+    """
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    return np.concatenate(([0.], np.cumsum(values)))
+
+
+class PlantingSweep:
+    def __init__(self, wdata, z, lat, wndht=10, T_base=10., T_cutoff=30., mthd='corn'):
+        """
+        Precomputes daily GDD, ETo and rain prefix sums over a weather record.
+
+        Args:
+        wdata (pd.DataFrame): Weather data indexed by '%Y-%j' with the gridMET columns ('srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr').
+        z (float): Elevation of the weather site (m).
+        lat (float): Latitude of the weather site.
+        wndht (float): Height of wind measurement (m). 10 m for gridMET.
+        T_base (float): Base temperature for GDD (°C).
+        T_cutoff (float): Cutoff temperature for GDD (°C).
+        mthd (str): GDD method, 'corn' or 'other' (see `pyfao56_mod.gdd`).
+        """
+        self.wdata = wdata
+        self.dates = pd.to_datetime(wdata.index, format='%Y-%j')
+
+        def col(name):
+            return pd.to_numeric(wdata[name], errors='coerce').to_numpy(dtype=float) if name in wdata.columns else None
+
+        daily_gdd = gdd_daily(col('tmmx'), col('tmmn'), T_base, T_cutoff, mthd)
+        daily_eto, _ = refet_daily(self.dates.dayofyear.to_numpy(), col('srad'), col('tmmx'), col('tmmn'), z, lat,
+                                   vapr=col('vpar'), tdew=col('tdew'), rhmax=col('rmax'), rhmin=col('rmin'),
+                                   wndsp=col('vs'), wndht=wndht)
+
+        self.cgdd = prefix_sum(daily_gdd)
+        self.ceto = prefix_sum(daily_eto)
+        self.crain = prefix_sum(col('pr'))
+
+    @classmethod
+    def from_weather_file(cls, lat, lon, z, **kwargs):
+        """
+        Builds a sweep from the weather data stored by `save_weather_data`.
+
+        Args:
+        lat (float): Latitude used when the weather data was saved.
+        lon (float): Longitude used when the weather data was saved.
+        z (float): Elevation of the weather site (m).
+
+        Returns:
+        PlantingSweep: Sweep over the stored weather record.
+        """
+        from main.utils import load_weather_data
+
+        weather_data_dict = load_weather_data(lat, lon)
+        if weather_data_dict is None:
+            raise FileNotFoundError(f'No weather data stored for {lat}, {lon}')
+        w_data = pd.DataFrame(weather_data_dict['weather_data'])
+        w_data.index = pd.to_datetime(w_data.pop('Date')).dt.strftime('%Y-%j')
+        return cls(w_data, z, float(lat), **kwargs)
+
+    def window_sum(self, cum, start, end):
+        """Sum of a daily variable between positions `start` and `end` (inclusive) from its prefix sum."""
+        return cum[end + 1] - cum[start]
+
+    def candidates(self, crop, window_start, window_end, cgdd=None, max_days=None):
+        """
+        Resolves season length, adjusted stage lengths and seasonal totals for every planting day in a window.
+
+        Args:
+        crop (str): Crop name from `crop_data.CROP_STAGE_LENGTHS`.
+        window_start (str): First candidate planting date in 'YYYY-MM-DD' format.
+        window_end (str): Last candidate planting date in 'YYYY-MM-DD' format.
+        cgdd (float): Cumulative GDD to reach maturity. If None, the season length is the sum of the FAO-56 stage lengths.
+        max_days (int): Upper limit of the season length when `cgdd` is used. Defaults to twice the FAO-56 season length.
+
+        Returns:
+        pd.DataFrame: One row per candidate whose season fits in the weather record.
+        """
+        lengths = CROP_STAGE_LENGTHS[crop]
+        if lengths['l_ini'] is None:
+            raise ValueError(f'No stage lengths defined for crop: {crop}')
+        Lini, Ldev, Lmid, Lend = lengths['l_ini'], lengths['l_dev'], lengths['l_mid'], lengths['l_end']
+        crop_fao = Lini + Ldev + Lmid + Lend
+
+        n = len(self.dates)
+        first = self.dates.searchsorted(pd.to_datetime(window_start), side='left')
+        last = self.dates.searchsorted(pd.to_datetime(window_end), side='right')
+        start = np.arange(first, last)
+
+        # Season end: first day reaching the GDD target (same rule as `gdd`) or the FAO-56 season length
+        if cgdd is None:
+            end = start + crop_fao - 1
+        else:
+            max_days = max_days or 2 * crop_fao
+            end = np.searchsorted(self.cgdd, self.cgdd[start] + cgdd, side='left') - 1
+            end = np.minimum(end, start + max_days - 1)
+        valid = end < n
+        start, end = start[valid], end[valid]
+
+        # Adjusted stage lengths, identical to `crop_stage`
+        span = end - start + 1
+        l_ini = ((Lini/crop_fao)*span).astype(int)
+        l_dev = ((Ldev/crop_fao)*span).astype(int)
+        l_mid = ((Lmid/crop_fao)*span).astype(int)
+        l_end = span - l_ini - l_dev - l_mid
+
+        # Stage boundaries (positions of the first day of each stage) and ETo per stage
+        b_dev = start + l_ini
+        b_mid = b_dev + l_dev
+        b_end = b_mid + l_mid
+        eto_ini = self.ceto[b_dev] - self.ceto[start]
+        eto_dev = self.ceto[b_mid] - self.ceto[b_dev]
+        eto_mid = self.ceto[b_end] - self.ceto[b_mid]
+        eto_end = self.ceto[end + 1] - self.ceto[b_end]
+
+        # Basal crop ET estimate from the FAO-56 Kcb curve (linear ramps averaged over dev and late stages)
+        kcb = CROP_COEFFICIENTS[crop]
+        etcb = (kcb['kcb_ini']*eto_ini + (kcb['kcb_ini'] + kcb['kcb_mid'])/2*eto_dev
+                + kcb['kcb_mid']*eto_mid + (kcb['kcb_mid'] + kcb['kcb_end'])/2*eto_end)
+        rain = self.window_sum(self.crain, start, end)
+
+        return pd.DataFrame({
+            'crop': crop,
+            'planting_date': self.dates[start].strftime('%Y-%m-%d'),
+            'maturity_date': self.dates[end].strftime('%Y-%m-%d'),
+            'season_days': span,
+            'l_ini': l_ini, 'l_dev': l_dev, 'l_mid': l_mid, 'l_end': l_end,
+            'GDD': self.window_sum(self.cgdd, start, end),
+            'ETo': eto_ini + eto_dev + eto_mid + eto_end,
+            'Rain': rain,
+            'ETcb_est': etcb,
+            'net_demand': np.maximum(etcb - rain, 0),
+        })
+
+    def sweep(self, window_start, window_end, crops=None, cgdd=None, max_days=None):
+        """
+        Evaluates every planting day in a window for several crops.
+
+        Args:
+        window_start (str): First candidate planting date in 'YYYY-MM-DD' format.
+        window_end (str): Last candidate planting date in 'YYYY-MM-DD' format.
+        crops (list): Crop names. Defaults to every crop in `crop_data.CROP_STAGE_LENGTHS` with stage lengths defined.
+        cgdd (dict): Optional cumulative GDD target per crop.
+        max_days (int): Upper limit of the season length when a GDD target is used.
+
+        Returns:
+        pd.DataFrame: Candidates of all crops.
+        """
+        if crops is None:
+            crops = [crop for crop, lengths in CROP_STAGE_LENGTHS.items() if lengths['l_ini'] is not None]
+        cgdd = cgdd or {}
+        frames = [self.candidates(crop, window_start, window_end, cgdd.get(crop), max_days) for crop in crops]
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def shortlist(candidates, n=5, by='net_demand', ascending=True):
+        """
+        Keeps the `n` best planting dates of each crop.
+
+        Args:
+        candidates (pd.DataFrame): Output of `candidates` or `sweep`.
+        n (int): Number of dates to keep per crop.
+        by (str): Column used to rank the candidates.
+        ascending (bool): Rank from the lowest value when True.
+
+        Returns:
+        pd.DataFrame: Shortlisted candidates.
+        """
+        ranked = candidates.sort_values(['crop', by], ascending=[True, ascending], kind='stable')
+        return ranked.groupby('crop', sort=False).head(n).reset_index(drop=True)
+
+
+def simulate_shortlist(shortlist, plant_data, weather_data, soil_data, irri_data):
+    """
+    Runs the full pyfao56 model only for the shortlisted planting dates.
+
+    Args:
+    shortlist (pd.DataFrame): Output of `PlantingSweep.shortlist`.
+    plant_data (dict): Plant data in the session format. Dates and stage lengths are replaced per candidate.
+    weather_data (dict): Weather metadata in the session format.
+    soil_data (dict): Soil data in the session format.
+    irri_data (dict): Irrigation data in the session format.
+
+    Returns:
+    pd.DataFrame: Shortlist with the seasonal water balance totals (`swbdata`) of each full run.
+    """
+    from modules.results import simulate_model
+
+    rows = []
+    for candidate in shortlist.to_dict(orient='records'):
+        crop = candidate['crop']
+        # Use the user's plant properties for their own crop and the default crop tables for the others
+        if crop == plant_data.get('crop'):
+            properties = plant_data.get('plant_properties', {})
+        else:
+            properties = {**plant_data.get('plant_properties', {}), **CROP_COEFFICIENTS[crop], **CROP_PROPERTIES[crop],
+                          'CN2': CN2[crop]}
+        candidate_plant = {
+            **plant_data,
+            'planting_date': candidate['planting_date'],
+            'maturity_date': candidate['maturity_date'],
+            'crop': crop,
+            'plant_properties': {
+                **properties,
+                **{key: candidate[key] for key in ('l_ini', 'l_dev', 'l_mid', 'l_end')},
+                'stage_length_adjust': 'off',  # Stage lengths are already adjusted by the sweep
+            },
+        }
+        _, swb_cum_data = simulate_model(candidate_plant, weather_data, soil_data, irri_data)
+        rows.append({**candidate, **swb_cum_data})
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import pickle
+import zlib
+import numpy as np
+import pandas as pd
+from main.shared_cache import cache
+
+'''Note: Server-side storage of uploaded tables (irrigation schedules). The Flask session lives in a signed cookie, so a table put
+in the session is sent back with every request and a multi-season schedule soon exceeds the cookie size limit. Uploaded tables are
+stored here instead, in the shared cache database (see `main/shared_cache.py`) so that every worker can read them, and the session
+only keeps a short reference: {'Irrigation_type': 'upload', 'table_ref': ..., 'n_events': ...}.
+
+Tables are stored column by column in compact types: dates as int32 day numbers, numbers as float32 when that is lossless (float64
+otherwise) and text as categorical codes, compressed with zlib. The reference is derived from the content, so uploading the same
+file twice stores it once.'''
+
+TABLE_TTL = float(os.getenv('table_store_hours', 24)) * 3600
+
+
+class TableNotFound(KeyError):
+    '''Raised when a referenced table is no longer in the store (expired or purged).'''
+
+
+def pack_table(df):
+    '''
+    Serializes a DataFrame with compact column types.
+
+    Parameters:
+    -----------
+    df : pd.DataFrame
+        Table with date, numeric or text columns. The index is not stored.
+
+    Returns:
+    --------
+    bytes
+        Compressed representation, see `unpack_table`.
+    '''
+    columns = []
+    for name in df.columns:
+        col = df[name]
+        if pd.api.types.is_datetime64_any_dtype(col):
+            days = col.to_numpy(dtype='datetime64[D]').astype('int64')
+            columns.append((name, 'date', days.astype('int32')))
+        elif pd.api.types.is_bool_dtype(col):
+            columns.append((name, 'bool', col.to_numpy(dtype=bool)))
+        elif pd.api.types.is_numeric_dtype(col):
+            values = col.to_numpy(dtype='float64')
+            single = values.astype('float32')
+            # float32 only when every value survives the round trip exactly
+            lossless = np.array_equal(single.astype('float64'), values, equal_nan=True)
+            columns.append((name, 'number', single if lossless else values))
+        else:
+            codes, categories = pd.factorize(col.where(col.isna(), col.astype(str)), use_na_sentinel=True)
+            columns.append((name, 'text', (codes.astype('int32'), list(categories))))
+    return zlib.compress(pickle.dumps(columns, pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_table(blob):
+    '''Restores a DataFrame serialized by `pack_table` (dates as datetime64, numbers as float64, text as str).'''
+    data = {}
+    for name, kind, values in pickle.loads(zlib.decompress(blob)):
+        if kind == 'date':
+            data[name] = pd.to_datetime(values.astype('int64'), unit='D')
+        elif kind == 'number':
+            data[name] = values.astype('float64')
+        elif kind == 'text':
+            codes, categories = values
+            data[name] = pd.Categorical.from_codes(codes, categories).astype(object)
+        else:
+            data[name] = values
+    return pd.DataFrame(data)
+
+
+def put_table(df):
+    '''
+    Stores a table and returns its reference (for the session).
+
+    Returns:
+    --------
+    str
+        Reference of the table, 'tbl_' followed by 24 hex characters.
+    '''
+    blob = pack_table(df)
+    ref = 'tbl_' + hashlib.sha256(blob).hexdigest()[:24]
+    cache.set('table:' + ref, blob, ttl=TABLE_TTL)
+    return ref
+
+
+def get_table(ref):
+    '''Returns the table stored under `ref`. Raises `TableNotFound` when it has expired.'''
+    return unpack_table(table_blob(ref))
+
+
+def table_blob(ref):
+    '''Stored (packed) form of the table `ref`, to keep it outside the store (see `restore_table`). Raises `TableNotFound`.'''
+    blob = cache.get('table:' + ref)
+    if blob is None:
+        raise TableNotFound(ref)
+    return blob
+
+
+def restore_table(ref, blob):
+    '''Puts a table kept with `table_blob` back in the store under the same reference, for another `TABLE_TTL`.'''
+    cache.set('table:' + ref, blob, ttl=TABLE_TTL)
+
+
+def resolve_irrigation(irri_data):
+    '''
+    Irrigation data with the events of an uploaded table loaded from the store.
+
+    Session data without a `table_ref` (manual or auto irrigation) is returned unchanged.
+
+    Returns:
+    --------
+    dict
+        {'Irrigation_type': ..., 'Irri_data': [{'Date': 'YYYY-MM-DD', 'Amount': .., 'Fraction': ..}, ...]}
+    '''
+    if not irri_data or 'table_ref' not in irri_data:
+        return irri_data
+    events = get_table(irri_data['table_ref'])
+    if 'Date' in events and pd.api.types.is_datetime64_any_dtype(events['Date']):
+        events['Date'] = events['Date'].dt.strftime('%Y-%m-%d')
+    return {'Irrigation_type': irri_data['Irrigation_type'], 'Irri_data': events.to_dict(orient='records')}
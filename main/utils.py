@@ -2,20 +2,34 @@
 # Utility Functions for Flask App - utils.py (Updated)
 # =====================================================
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import io
 import base64
 import json
 import os
+import tempfile
 import time
+from main import metrics
+from main.schema import widen
+from main.shared_cache import cache
 
-plt.rcParams['font.size'] = 16
-plt.rcParams['font.family'] = 'Arial'
+# Note: matplotlib and seaborn are only needed to render the download plot, so they are imported on first use (see `_pyplot`)
+# instead of at import time. This keeps them out of the boot time of every worker.
+
+def _pyplot():
+    '''Imports matplotlib.pyplot on first use, with the server backend and the font settings used by `wb_plot`.'''
+    import matplotlib
+    if matplotlib.get_backend().lower() != 'agg':
+        matplotlib.use('Agg')  # Plots are only rendered to files/bytes on the server
+    import matplotlib.pyplot as plt
+
+    plt.rcParams['font.size'] = 16
+    plt.rcParams['font.family'] = 'Arial'
+    return plt
 
 # Note: The `wb_plot` function is used in the `results.py` file to generate a water balance plot for download and later we are thinking to discard this function and use the `wb_plot_interactive` function instead.
 # This is more reptetative and we can use the `wb_plot_interactive` function to generate the plot and save it as an image. This function also does not updated for depletion plot adjustment.
 
+@metrics.timed('wb_plot')
 def wb_plot(results, save_plot: bool = False, plot_name: str = 'wb_plot.jpeg', print_wb: bool = False):
     """
     Plots and visualizes different water balance components and optionally saves the plot.
@@ -61,6 +75,66 @@ def wb_plot(results, save_plot: bool = False, plot_name: str = 'wb_plot.jpeg', p
         3. The third subplot shows TAW, RAW, soil water depletion, and deep percolation.
     - The function uses a monospaced font for the plot title to ensure proper alignment of the water balance summary.
     """
+    plt = _pyplot()
+    fig = draw_wb_plot(results, print_wb=print_wb)
+
+    # ===============================================
+    # Save the plot if required
+    # ===============================================
+    if save_plot:
+        fig.savefig(plot_name, bbox_inches='tight')
+
+    # # Save the plot as a PNG image and encode it to base64
+    plot_img = base64.b64encode(fig_to_bytes(fig, fmt='png')).decode()
+
+    # plot_html = mpld3.fig_to_html(fig)
+
+    plt.close(fig)
+    # Display the plot
+    return f'data:image/png;base64,{plot_img}'
+
+
+@metrics.timed('wb_plot')
+def render_wb_plot(results, fmt: str = 'png', dpi: int = 250, print_wb: bool = False):
+    '''
+    Renders the water balance plot of `wb_plot` straight to image bytes (no base64 round trip).
+
+    Parameters:
+    -----------
+    results : pandas.DataFrame
+        pyfao56 output data (see `wb_plot`).
+    fmt : str, optional, default: 'png'
+        Image format: 'png', 'svg' or 'webp'.
+    dpi : int, optional, default: 250
+        Resolution of raster formats.
+    print_wb : bool, optional, default: False
+        If True, a summary of the water balance components is displayed as the plot's title.
+
+    Returns:
+    --------
+    bytes
+        The encoded image.
+    '''
+    plt = _pyplot()
+    fig = draw_wb_plot(results, print_wb=print_wb)
+    try:
+        return fig_to_bytes(fig, fmt=fmt, dpi=dpi)
+    finally:
+        plt.close(fig)
+
+
+def fig_to_bytes(fig, fmt: str = 'png', dpi=None):
+    '''Saves a matplotlib figure into memory and returns the encoded bytes.'''
+    img = io.BytesIO()
+    fig.savefig(img, format=fmt, dpi=dpi if dpi is not None else 'figure')
+    return img.getvalue()
+
+
+def draw_wb_plot(results, print_wb: bool = False):
+    '''Draws the three water balance subplots of `wb_plot` and returns the matplotlib figure.'''
+    import seaborn as sns
+    plt = _pyplot()
+
     sns.set_style('ticks')
 
     fig, axes = plt.subplots(3, 1, figsize=(16, 9), dpi=250, sharex=True)
@@ -141,36 +215,45 @@ def wb_plot(results, save_plot: bool = False, plot_name: str = 'wb_plot.jpeg', p
     # Print water balance summary in plot title
     # ===============================================
     if print_wb:
-        plt.suptitle(f'''ETc = {round(results.ETc.sum(), 2)}, ETc adj = {round(results.ETcadj.sum(), 2)}
+        fig.suptitle(f'''ETc = {round(results.ETc.sum(), 2)}, ETc adj = {round(results.ETcadj.sum(), 2)}
 Rain = {round(results.Rain.sum(), 2)}, Irrig. = {round(results.Irrig.sum(), 2)}, Irrig. count = {(results['Irrig'] != 0).sum()}
 Runoff = {round(results.Runoff.sum(), 2)}, Percolation = {round(results.DP.sum(), 2)}''', fontfamily='monospace')
 
-    plt.tight_layout(rect=[0, 0, 1, 0.94])  # Adjust layout to make space for the title and legend
-    # ===============================================
-    # Save the plot if required
-    # ===============================================
-    if save_plot:
-        plt.savefig(plot_name, bbox_inches='tight')
+    fig.tight_layout(rect=[0, 0, 1, 0.94])  # Adjust layout to make space for the title and legend
+    return fig
 
 
-    # # Save the plot as a PNG image and encode it to base64
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plot_img = base64.b64encode(img.getvalue()).decode()
+# Define the directory to store weather data
+DATA_DIR = 'weather_storage'
+os.makedirs(DATA_DIR, exist_ok=True)  # Ensure directory exists
 
-    # plot_html = mpld3.fig_to_html(fig)
+def weather_records(data):
+    '''
+    Records of a weather DataFrame as they are stored in the JSON file: `NaN` as `None` and dates as 'YYYY-MM-DD' strings.
+    float32 columns (compact schema, see main/schema.py) are written with their shortest decimal (25.123, not 25.12299919).
+    '''
+    float32 = data.select_dtypes('float32').columns
+    if len(float32):
+        data = data.assign(**{col: widen(data[col]) for col in float32})
+    data = data.astype(object).where(pd.notna(data), None)  # Convert NaN to None (object columns so that floats can hold None)
+    data = data.to_dict(orient='records')  # Convert DataFrame to list of dictionaries
 
-    plt.close()
-    # Display the plot
-    return f'data:image/png;base64,{plot_img}'
+    # Convert all `Timestamp` values to string ('YYYY-MM-DD')
+    for row in data:
+        if 'Date' in row and isinstance(row['Date'], pd.Timestamp):
+            row['Date'] = row['Date'].strftime('%Y-%m-%d')
+    return data
 
 
-# Define the directory to store weather data
-DATA_DIR = 'weather_storage'
-os.makedirs(DATA_DIR, exist_ok=True)  # Ensure directory exists
+def merge_records(stored, records):
+    '''Weather records of `stored` and `records` by date, `records` winning for the days present in both, in date order.'''
+    merged = {row['Date']: row for row in stored}
+    merged.update((row['Date'], row) for row in records)
+    return [merged[date] for date in sorted(merged)]
 
-def save_weather_data(lat, lon, data):
+
+@metrics.timed('save_weather_data')
+def save_weather_data(lat, lon, data, merge=False):
     '''
     Saves weather data as a JSON file with appropriate formatting and error handling.
 
@@ -183,6 +266,9 @@ def save_weather_data(lat, lon, data):
     data : pandas.DataFrame or list of dict
         Weather data to be saved. If it is a DataFrame, it will be converted 
         to a list of dictionaries. NaN values will be replaced with `None`.
+    merge : bool
+        Merge the records into the stored ones instead of replacing them (the new records win for the days present in
+        both), so that concurrent fetches of different seasons of the same location do not clobber each other.
 
     File Format:
     ------------
@@ -230,10 +316,15 @@ def save_weather_data(lat, lon, data):
 
     Notes:
     ------
-    - This function ensures safe file writing by using a temporary file (`.tmp`) 
-      and then renaming it to avoid partial writes or corruption issues.
+    - This function ensures safe file writing by using a uniquely named temporary file (`.tmp`) 
+      and then renaming it to avoid partial writes or corruption issues. Concurrent writers 
+      (other threads or workers) never share a temporary file.
     - Converts Pandas Timestamp objects to string dates ('YYYY-MM-DD').
     - Converts all `NaN` values from Pandas DataFrames to `None` for JSON compatibility.
+    - The read-merge-write runs under a lock of the location shared by all workers (see `SharedCache.lock`), so concurrent
+      writers are serialized instead of overwriting each other's records.
+    - When the records are the same as the stored ones, only the timestamp is renewed and the file modification time is kept:
+      the weather version (see `weather_version`), and with it every cached result of the location, stays valid.
 
     Error Handling:
     ---------------
@@ -244,7 +335,8 @@ def save_weather_data(lat, lon, data):
 
     Returns:
     --------
-    None
+    bool
+        True when the stored records changed, False when they were already stored.
     '''
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)  # Create directory if it doesn't exist
@@ -253,13 +345,25 @@ def save_weather_data(lat, lon, data):
 
     # Ensure data['weather_data'] is properly formatted
     if isinstance(data, pd.DataFrame):
-        data = data.where(pd.notna(data), None)  # Convert NaN to None
-        data = data.to_dict(orient='records')  # Convert DataFrame to list of dictionaries
+        data = weather_records(data)
 
-        # Convert all `Timestamp` values to string ('YYYY-MM-DD')
-        for row in data:
-            if 'Date' in row and isinstance(row['Date'], pd.Timestamp):
-                row['Date'] = row['Date'].strftime('%Y-%m-%d')
+    with cache.lock(f'weather_file:{lat}:{lon}'):
+        return _write_weather_file(file_path, lat, lon, data, merge)
+
+
+def _write_weather_file(file_path, lat, lon, data, merge):
+    '''Writes the weather file of `save_weather_data` (called under the lock of the location).'''
+    stored, mtime = None, None
+    if os.path.exists(file_path):
+        try:
+            with open(file_path, 'r') as f:
+                stored = json.load(f).get('weather_data')
+            mtime = os.stat(file_path).st_mtime_ns
+        except (OSError, ValueError):
+            stored = None
+    if merge and stored:
+        data = merge_records(stored, data)
+    changed = stored != data
 
     data_json = {}
     data_json['latitude'] = lat
@@ -270,13 +374,20 @@ def save_weather_data(lat, lon, data):
 
     try:
         # **Safe file writing to prevent Windows locking issues**
-        temp_file_path = file_path + '.tmp'
+        # Unique temporary file per writer so that concurrent saves of the same location do not clobber each other
+        fd, temp_file_path = tempfile.mkstemp(dir=DATA_DIR, prefix=f'.weather_{lat}_{lon}.', suffix='.tmp')
 
-        with open(temp_file_path, 'w', encoding='utf-8') as temp_file:
+        with os.fdopen(fd, 'w', encoding='utf-8') as temp_file:
             json.dump(data_json, temp_file, indent=4)
 
+        if metrics.METRICS_ENABLED:
+            metrics.add_bytes('save_weather_data', os.path.getsize(temp_file_path), 'write')
+
         # Overwrite the original file **after writing is completed**
         os.replace(temp_file_path, file_path)
+        if not changed:
+            # Same records: keep the weather version of the cached results
+            os.utime(file_path, ns=(time.time_ns(), mtime))
 
     except (IOError, OSError) as e:
         print(f'File-related error saving weather data: {e}')
@@ -285,9 +396,11 @@ def save_weather_data(lat, lon, data):
         # Explicitly close file handles (if using additional file handling)
         if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
             os.remove(temp_file_path)  # Cleanup if failed
+    return changed
 
 
 
+@metrics.timed('load_weather_data')
 def load_weather_data(lat, lon):
     '''
     Load weather data from a JSON file based on latitude and longitude.
@@ -349,11 +462,28 @@ def load_weather_data(lat, lon):
     '''
     file_path = os.path.join(DATA_DIR, f'weather_{lat}_{lon}.json')
     if os.path.exists(file_path):
+        metrics.cache_event('weather_file', hit=True)
+        if metrics.METRICS_ENABLED:
+            metrics.add_bytes('load_weather_data', os.path.getsize(file_path), 'read')
         with open(file_path, 'r') as f:
             return json.load(f)
+    metrics.cache_event('weather_file', hit=False)
     return None  # If no file exists, return None
 
 
+def weather_version(lat, lon):
+    '''
+    Version of the stored weather data of a location (modification time of its JSON file), or None if there is no file.
+
+    Used to key cached results so that they are recomputed whenever the weather data is saved again.
+    '''
+    file_path = os.path.join(DATA_DIR, f'weather_{lat}_{lon}.json')
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return None
+
+
 # =====================================================
 # Delete Weather Data
 
@@ -363,7 +493,7 @@ def load_weather_data(lat, lon):
 #     if os.path.exists(file_path):
 #         os.remove(file_path)  # Delete file
 
-def delete_old_files():
+def delete_old_files(keep=()):
     '''
     Deletes weather data files older than 6 hours from the `DATA_DIR`, ensuring they are not in use.
 
@@ -373,7 +503,8 @@ def delete_old_files():
 
     Parameters:
     -----------
-    None
+    keep : collection of str, optional
+        File names that are never deleted (weather of the fields registered for the nightly refresh).
 
     File Naming Convention:
     -----------------------
@@ -415,7 +546,7 @@ def delete_old_files():
     six_hours = 6 * 3600  # 6 hours in seconds
 
     for file in os.listdir(DATA_DIR):
-        if file.startswith('weather_'):
+        if file.startswith('weather_') and file not in keep:
             file_path = os.path.join(DATA_DIR, file)
 
             try:
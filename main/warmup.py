@@ -0,0 +1,263 @@
+import argparse
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from dotenv import load_dotenv
+
+# The warm-up runs in its own process: load the app's .env settings before the modules that read them at import time
+load_dotenv()
+
+from main.agrimet_fetch import AGRIMET_PARAMETERS, STATIONS_FILE, fetch_station_year, get_agrimet, station_year_key
+from main.gridMET_fetch import GRIDMET_LAT0, GRIDMET_LON0, GRIDMET_RES, WeatherDataFetcher
+from main.shared_cache import cache
+
+'''Note: Cache warming for popular regions before the season. The first users of a region each waited for THREDDS (or the AgriMet
+service) to send several years of weather, and at the start of the season they all came at once. This command fetches the
+weather of a bounding box or of a list of points ahead of time into the shared cache (see main/shared_cache.py), under the same
+keys as the weather page, the QC gap filling and the scheduler, so their first requests are cache hits:
+- gridMET: the points are snapped to their grid cells (a bbox gives every cell whose center is inside), and each cell is fetched
+  once per year through `WeatherDataFetcher.fetch_yearly_data_cached`;
+- AgriMet: each point is assigned its nearest station within `--buffer-km` (a bbox gives the stations inside it), and each station
+  is fetched once per year through `fetch_station_year`.
+Cells or stations are fetched by `warmup_workers` threads (keep it low, the services are shared); past years already in the cache
+are not fetched again. A progress line with the counts, the bytes read and an ETA is logged every few seconds.
+
+The current year keeps changing, so the pages cache it for 6 hours only. The warm-up fetches it again on every run and keeps it
+for `warmup_ttl` seconds (30 hours by default): run the command every night (e.g. from cron, like `main.scheduler run`) so the
+current year stays warm until the next run.
+
+    python -m main.warmup --bbox -117.0 43.0 -116.0 44.0 --years 2020-2025
+    python -m main.warmup --points 43.6089,-116.1941 42.95,-112.83 --source agrimet'''
+
+WARMUP_WORKERS = int(os.getenv('warmup_workers', 4))
+WARMUP_YEARS = int(os.getenv('warmup_years', 5))  # Default: the current year and the previous ones
+WARMUP_TTL = int(os.getenv('warmup_ttl', 30 * 3600))  # Current year: until the next nightly run, with some margin
+MAX_CELLS = 5000
+PROGRESS_SECONDS = 5
+
+# Same variables, so the same cache keys, as the weather page, the QC gap filling and the scheduler
+GRIDMET_VARS = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+
+
+def parse_years(values):
+    '''Years from items such as '2021' or '2019-2024'. Defaults to the last `WARMUP_YEARS` years.'''
+    if not values:
+        current = pd.Timestamp.now().year
+        return list(range(current - WARMUP_YEARS + 1, current + 1))
+    years = set()
+    for value in values:
+        first, _, last = str(value).partition('-')
+        years.update(range(int(first), int(last or first) + 1))
+    return sorted(years)
+
+
+def cells_in_bbox(bbox, max_cells=MAX_CELLS):
+    '''
+    Centers of the gridMET cells inside a bounding box, in the rounding of `WeatherDataFetcher.snap_to_grid`.
+
+    Parameters:
+    -----------
+    bbox : tuple
+        (west, south, east, north) in decimal degrees.
+    max_cells : int
+        Largest number of cells accepted, a ValueError is raised above it.
+
+    Returns:
+    --------
+    list
+        (lat, lon) of the cells, north to south and west to east.
+    '''
+    west, south, east, north = bbox
+    eps = 1e-9
+    rows = range(math.ceil((GRIDMET_LAT0 - north) / GRIDMET_RES - eps), math.floor((GRIDMET_LAT0 - south) / GRIDMET_RES + eps) + 1)
+    cols = range(math.ceil((west - GRIDMET_LON0) / GRIDMET_RES - eps), math.floor((east - GRIDMET_LON0) / GRIDMET_RES + eps) + 1)
+    if not len(rows) or not len(cols):
+        raise ValueError('The bounding box does not contain any gridMET cell.')
+    if len(rows) * len(cols) > max_cells:
+        raise ValueError(f'The bounding box has {len(rows) * len(cols)} gridMET cells, more than {max_cells}.')
+    return [(round(GRIDMET_LAT0 - row * GRIDMET_RES, 5), round(GRIDMET_LON0 + col * GRIDMET_RES, 5)) for row in rows for col in cols]
+
+
+def snap_points(points):
+    '''gridMET cells of a list of (lat, lon) points, without duplicates and in the order of the points.'''
+    return list(dict.fromkeys(WeatherDataFetcher.snap_to_grid(lat, lon) for lat, lon in points))
+
+
+def stations_for(bbox=None, points=None, buffer_km=50, since=None):
+    '''
+    AgriMet stations to warm: the stations inside a bounding box, or the nearest station of each point within `buffer_km`
+    (installed before `since`, like the weather page). Returns the station ids without duplicates.
+    '''
+    if bbox is not None:
+        west, south, east, north = bbox
+        stations = pd.read_csv(STATIONS_FILE)
+        inside = stations[stations['latitude'].between(south, north) & stations['longitude'].between(west, east)]
+        return list(dict.fromkeys(inside['siteid']))
+
+    siteids = []
+    for lat, lon in points:
+        nearby = get_agrimet(lat, lon, buffer_km, since)
+        if nearby:
+            siteids.append(nearby[0]['siteid'])
+        else:
+            logging.warning(f'No AgriMet station within {buffer_km} km of {lat}, {lon}')
+    return list(dict.fromkeys(siteids))
+
+
+class Progress:
+    '''Thread-safe counts of a warm-up, logged at most every `interval` seconds.'''
+
+    def __init__(self, total, interval=PROGRESS_SECONDS):
+        self.total = total
+        self.interval = interval
+        self.counts = {'done': 0, 'fetched': 0, 'cached': 0, 'failed': 0, 'bytes_read': 0}
+        self.started = time.perf_counter()
+        self._logged = self.started
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+            now = time.perf_counter()
+            if now - self._logged >= self.interval or self.counts['done'] == self.total:
+                self._logged = now
+                logging.info(self.line(now))
+
+    def line(self, now):
+        done, elapsed = self.counts['done'], now - self.started
+        eta = elapsed / done * (self.total - done) if done else float('nan')
+        return (f"Warm-up {done}/{self.total} ({self.counts['fetched']} years fetched, {self.counts['cached']} cached, "
+                f"{self.counts['failed']} failed), {self.counts['bytes_read'] / 1e6:.1f} MB read, {elapsed:.0f} s elapsed, "
+                f"ETA {eta:.0f} s")
+
+    def summary(self):
+        with self._lock:
+            return {**self.counts, 'total': self.total, 'seconds': round(time.perf_counter() - self.started, 2)}
+
+
+def warm_cell(cell, years, progress, base_url=None):
+    '''
+    Fetches the missing past years and the current year of one gridMET cell into the shared cache.
+    '''
+    fetcher = WeatherDataFetcher(cell[0], cell[1], GRIDMET_VARS, base_url=base_url, cache=cache)
+    counts = {'fetched': 0, 'cached': 0, 'failed': 0}
+    current = pd.Timestamp.now().year
+    for year in years:
+        if year < current and cache.contains(fetcher.yearly_cache_key(year)):
+            counts['cached'] += 1
+            continue
+        try:
+            if year >= current:
+                cache.set(fetcher.yearly_cache_key(year), fetcher.fetch_yearly_data(year), ttl=WARMUP_TTL)
+            else:
+                fetcher.fetch_yearly_data_cached(year)
+            counts['fetched'] += 1
+        except Exception as e:
+            logging.error(f"Warm-up failed for cell {cell}, {year}: {str(e)}")
+            counts['failed'] += 1
+    progress.add(done=1, bytes_read=fetcher.stats['bytes_read'], **counts)
+
+
+def warm_station(siteid, years, progress, parameters=AGRIMET_PARAMETERS):
+    '''Fetches the missing past years and the current year of one AgriMet station into the shared cache.'''
+    counts = {'fetched': 0, 'cached': 0, 'failed': 0}
+    current = pd.Timestamp.now().year
+    for year in years:
+        key = station_year_key(siteid, year, parameters)
+        if year < current and cache.contains(key):
+            counts['cached'] += 1
+            continue
+        try:
+            if year >= current:
+                cache.set(key, fetch_station_year(siteid, year, parameters), ttl=WARMUP_TTL)
+            else:
+                fetch_station_year(siteid, year, parameters, cache=cache)
+            counts['fetched'] += 1
+        except Exception as e:
+            logging.error(f"Warm-up failed for station {siteid}, {year}: {str(e)}")
+            counts['failed'] += 1
+    progress.add(done=1, **counts)
+
+
+def warm(bbox=None, points=None, years=None, source='gridmet', workers=WARMUP_WORKERS, buffer_km=50, max_cells=MAX_CELLS, base_url=None):
+    '''
+    Fetches the weather of a bounding box or of a list of points into the shared cache.
+
+    Parameters:
+    -----------
+    bbox : tuple, optional
+        (west, south, east, north) in decimal degrees.
+    points : list, optional
+        (lat, lon) points, used when no bbox is given.
+    years : list, optional
+        Years to fetch. Defaults to the last `WARMUP_YEARS` years (see `parse_years`).
+    source : str
+        'gridmet' or 'agrimet'.
+    workers : int
+        Cells or stations fetched at the same time.
+    buffer_km : float
+        Search radius of the nearest AgriMet station of a point.
+    max_cells : int
+        Largest number of gridMET cells of a bbox.
+    base_url : str, optional
+        Root of the gridMET files. Defaults to the gridmet_url setting.
+
+    Returns:
+    --------
+    dict
+        Targets (cells or stations) done, years fetched, years already cached, failures, bytes read and seconds.
+    '''
+    if bbox is None and not points:
+        raise ValueError('A bounding box or a list of points is required.')
+    years = parse_years(years)
+    if source == 'agrimet':
+        targets = stations_for(bbox, points, buffer_km, since=f'{years[0]}-01-01')
+    else:
+        targets = cells_in_bbox(bbox, max_cells) if bbox is not None else snap_points(points)
+    progress = Progress(len(targets))
+
+    def task(target):
+        if source == 'agrimet':
+            warm_station(target, years, progress)
+        else:
+            warm_cell(target, years, progress, base_url)
+
+    logging.info(f'Warming {len(targets)} {"stations" if source == "agrimet" else "gridMET cells"} for {years[0]}-{years[-1]} '
+                 f'with {workers} workers')
+    if workers > 1 and len(targets) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(task, targets))
+    else:
+        for target in targets:
+            task(target)
+    return progress.summary()
+
+
+def parse_point(value):
+    lat, lon = (float(part) for part in value.split(','))
+    return lat, lon
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    parser = argparse.ArgumentParser(description='Fetch the weather of a region into the shared cache ahead of the season.')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--bbox', nargs=4, type=float, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+    where.add_argument('--points', nargs='+', type=parse_point, metavar='LAT,LON')
+    parser.add_argument('--years', nargs='*', help=f'Years or ranges (e.g. 2019-2024), defaults to the last {WARMUP_YEARS}.')
+    parser.add_argument('--source', choices=['gridmet', 'agrimet'], default='gridmet')
+    parser.add_argument('--workers', type=int, default=WARMUP_WORKERS)
+    parser.add_argument('--buffer-km', type=float, default=50, help='Search radius of the nearest AgriMet station.')
+    parser.add_argument('--max-cells', type=int, default=MAX_CELLS)
+    parser.add_argument('--base-url', help='Root of the gridMET files, defaults to the gridmet_url setting.')
+    args = parser.parse_args()
+
+    print(json.dumps(warm(args.bbox, args.points, args.years, args.source, args.workers, args.buffer_km, args.max_cells,
+                          args.base_url)))
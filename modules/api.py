@@ -0,0 +1,299 @@
+from flask import Blueprint, request, jsonify, Response
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+import logging
+import os
+import threading
+from main.export import iter_export, available_formats, EXPORT_FORMATS
+from main.schema import compact_weather
+
+'''Note: Stateless JSON API for programmatic clients. The form pages keep all inputs in the Flask session across four requests,
+which is fine in a browser but not for scripts driving many fields. Here a complete field specification (or a list of them) is sent
+in one POST request and the daily results come back in a compact columnar encoding. The session and the templates are not used
+at all (see `initialize_session` in app.py), so nothing is stored in the cookie.
+
+A field specification uses the same dictionaries as the session (see the form modules):
+
+    {
+        "id": "field-1",                                   (optional, echoed back)
+        "plant": {...plant_data...},                        planting_date, maturity_date, crop, plant_properties
+        "weather": {"latitude": .., "longitude": .., "elevation": ..,
+                    "data": {"Date": [...], "srad": [...], ...}},   (optional inline weather, records or columns)
+        "soil": {...soil_data...},                          layers, tew_depth, rew
+        "irrigation": {...irrigation_data...}               Irrigation_type and Irri_data
+    }
+
+Without inline weather data, the stored weather file of the location is used, and gridMET data is fetched for the season when
+there is none. Fields are simulated in the request thread by default, or in a process pool of `api_workers` processes (.env
+file). Every web worker has its own pool, so keep it small. The pool processes are started by a forkserver, not forked from the
+web worker, which already runs the plot-cache thread and holds SQLite connections (locks held at fork time would deadlock them).
+`/simulate` returns JSON, `/export` streams the results of all fields as one CSV, csv.gz, Parquet or Arrow file. Invalid field
+specifications are answered with 400, failed weather fetches with 502 and other simulation failures with 500.'''
+
+api_blueprint = Blueprint('api', __name__)
+
+API_WORKERS = int(os.getenv('api_workers', 0))
+API_MAX_FIELDS = int(os.getenv('api_max_fields', 100))
+
+# Weather columns required in inline data; the others are optional placeholders for pyfao56
+WEATHER_COLUMNS = ['Date', 'srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+WEATHER_OPTIONAL = ['vpar', 'tdew', 'ET', 'MorP']
+AUTO_TRIGGERS = ('root_depletion', 'et_replacement')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class WeatherUnavailable(Exception):
+    '''Raised when the gridMET weather of a field cannot be fetched (upstream failure, not an invalid request).'''
+
+
+def get_pool():
+    '''Process pool of the API, created on first use so that workers which never serve the API do not start one.'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=API_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+        return _pool
+
+
+@api_blueprint.route('/simulate', methods=['POST'])
+def simulate():
+    '''
+    Simulates one field or a list of fields.
+
+    The body is a field specification, a list of them, or {"fields": [...]}. The optional query argument `columns`
+    (comma separated) restricts the returned daily columns, e.g. `?columns=ETc,ETa,Dr,Irrig`.
+    '''
+    fields, single, error = read_fields()
+    if error:
+        return error
+
+    columns = request.args.get('columns')
+    columns = [col.strip() for col in columns.split(',') if col.strip()] if columns else None
+
+    if API_WORKERS > 0:
+        results = list(get_pool().map(run_field, fields, [columns] * len(fields)))
+    else:
+        results = [run_field(field, columns) for field in fields]
+
+    if single:
+        result = results[0]
+        return jsonify(result), result.get('status', 200)
+    return jsonify({'results': results})
+
+
+@api_blueprint.route('/export', methods=['POST'])
+def export():
+    '''
+    Simulates one field or a list of fields (same body as `/simulate`) and streams the daily results of all fields as one file
+    with a `field` column. `?format=` is csv (default), csv.gz, parquet or arrow.
+
+    Fields are checked before anything is sent (400 with the errors of the invalid fields). They are then simulated a pool-full
+    at a time while the file is being written, so a large batch is never held in memory at once. A field whose simulation fails
+    at that point is left out of the file and logged.
+    '''
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in available_formats():
+        return jsonify({'error': f'Unsupported export format: {fmt}'}), 400
+
+    fields, _, error = read_fields()
+    if error:
+        return error
+    errors = []
+    for i, field in enumerate(fields):
+        try:
+            parse_field(field)
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append({'id': field_id(field, i), 'error': str(e)})
+    if errors:
+        return jsonify({'errors': errors}), 400
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    return Response(iter_export(simulated_fields(fields), fmt), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=simulation_results.{extension}'})
+
+
+def read_fields():
+    '''
+    Field specifications of the JSON body: one field, a list of them or {"fields": [...]}.
+
+    Returns:
+    --------
+    tuple
+        (fields, single, error), error being a response to return when the body is invalid.
+    '''
+    body = request.get_json(silent=True)
+    if body is None:
+        return None, False, (jsonify({'error': 'Request body must be JSON.'}), 400)
+
+    single = isinstance(body, dict) and 'fields' not in body
+    fields = [body] if single else body.get('fields') if isinstance(body, dict) else body
+    if not isinstance(fields, list) or not fields:
+        return None, single, (jsonify({'error': 'Expected a field specification or a non-empty list of them.'}), 400)
+    if len(fields) > API_MAX_FIELDS:
+        return None, single, (jsonify({'error': f'At most {API_MAX_FIELDS} fields per request.'}), 413)
+    return fields, single, None
+
+
+def field_id(field, position):
+    '''Id of a field: its `id`, or its position in the request.'''
+    return field.get('id', position) if isinstance(field, dict) else position
+
+
+def simulated_fields(fields):
+    '''Generator of (field id, odata) simulating the fields a pool-full at a time.'''
+    window = max(API_WORKERS, 1)
+    for start in range(0, len(fields), window):
+        batch = fields[start:start + window]
+        outputs = get_pool().map(export_field, batch) if API_WORKERS > 0 else map(export_field, batch)
+        for i, odata in enumerate(outputs):
+            if odata is not None:
+                yield field_id(batch[i], start + i), odata
+
+
+def simulate_field(field):
+    '''
+    Simulates one field specification, fetching gridMET data first when needed.
+
+    Returns:
+    --------
+    tuple
+        (odata, swbdata) of the model.
+    '''
+    from modules.results import cached_simulate_model
+
+    plant_data, weather_data, soil_data, irri_data, w_data = parse_field(field)
+    if w_data is None:
+        try:
+            ensure_weather(weather_data['latitude'], weather_data['longitude'], plant_data['planting_date'],
+                           plant_data['maturity_date'])
+        except Exception as e:
+            raise WeatherUnavailable(str(e)) from e
+    return cached_simulate_model(plant_data, weather_data, soil_data, irri_data, w_data=w_data)
+
+
+def export_field(field):
+    '''Daily output of one field for `/export` (runs in the pool workers), None when it cannot be simulated.'''
+    try:
+        return simulate_field(field)[0]
+    except Exception as e:
+        logging.error(f"API export error for field {field.get('id')}: {str(e)}")
+        return None
+
+
+def run_field(field, columns=None):
+    '''
+    Validates and simulates one field specification (runs in the pool workers).
+
+    Returns:
+    --------
+    dict
+        The columnar results of the field, or {'id': .., 'error': message, 'status': HTTP status} when it cannot be simulated:
+        400 for an invalid specification, 502 when its weather cannot be fetched, 500 for other failures.
+    '''
+    identifier = field.get('id') if isinstance(field, dict) else None
+    try:
+        odata, swbdata = simulate_field(field)
+        return {'id': identifier, **columnar(odata, columns), 'summary': swbdata}
+    except WeatherUnavailable as e:
+        logging.error(f"API weather fetch error: {str(e)}")
+        return {'id': identifier, 'error': 'Weather data could not be fetched.', 'status': 502}
+    except (KeyError, TypeError, ValueError) as e:
+        return {'id': identifier, 'error': str(e), 'status': 400}
+    except Exception as e:
+        logging.error(f"API simulation error: {str(e)}")
+        return {'id': identifier, 'error': 'Simulation failed.', 'status': 500}
+
+
+def parse_field(field):
+    '''
+    Checks a field specification and converts it to the arguments of `simulate_model`.
+
+    Returns:
+    --------
+    tuple
+        (plant_data, weather_data, soil_data, irri_data, w_data), w_data being None when no inline weather data is given.
+    '''
+    if not isinstance(field, dict):
+        raise ValueError('A field specification must be an object.')
+    missing = [key for key in ('plant', 'weather', 'soil', 'irrigation') if not field.get(key)]
+    if missing:
+        raise ValueError(f"Missing sections: {', '.join(missing)}")
+
+    plant_data, soil_data, irri_data = field['plant'], field['soil'], field['irrigation']
+    weather = dict(field['weather'])
+    inline = weather.pop('data', None)
+    for key in ('latitude', 'longitude', 'elevation'):
+        if weather.get(key) in (None, ''):
+            raise ValueError(f'Missing weather {key}.')
+    for key in ('planting_date', 'maturity_date', 'plant_properties'):
+        if not plant_data.get(key):
+            raise ValueError(f'Missing plant {key}.')
+    if not soil_data.get('layers'):
+        raise ValueError('Missing soil layers.')
+    if irri_data.get('Irrigation_type') not in ('manual', 'upload', 'auto'):
+        raise ValueError('Irrigation_type must be manual, upload or auto.')
+    if irri_data['Irrigation_type'] == 'auto' and (irri_data.get('Irri_data') or {}).get('trigger') not in AUTO_TRIGGERS:
+        raise ValueError(f"Irrigation trigger must be {' or '.join(AUTO_TRIGGERS)}.")
+
+    weather_data = {key: str(weather[key]) for key in ('latitude', 'longitude', 'elevation')}
+    if inline is not None:
+        weather_data['data_source'] = 'upload'
+        return plant_data, weather_data, soil_data, irri_data, inline_weather(inline)
+
+    weather_data['data_source'] = 'fetch'
+    return plant_data, weather_data, soil_data, irri_data, None
+
+
+def inline_weather(data):
+    '''Inline weather data (records or columns) in the layout of the weather JSON files.'''
+    w_data = pd.DataFrame(data)
+    missing = [col for col in WEATHER_COLUMNS if col not in w_data.columns]
+    if missing:
+        raise ValueError(f"Missing weather columns: {', '.join(missing)}")
+    # Compact weather schema (see main/schema.py): missing optional columns are NaN, MorP a categorical
+    return compact_weather(w_data.reindex(columns=WEATHER_COLUMNS + WEATHER_OPTIONAL))
+
+
+def ensure_weather(lat, lon, planting_date, maturity_date):
+    '''Fetches and stores gridMET data for the season unless the location already has stored weather data covering it.'''
+    from main.utils import load_weather_data, save_weather_data
+    from modules.weather import fetch_weather_data
+
+    stored = load_weather_data(lat, lon)
+    if stored:
+        dates = pd.to_datetime([row['Date'] for row in stored['weather_data']])
+        if len(dates) and dates.min() <= pd.to_datetime(planting_date) and dates.max() >= pd.to_datetime(maturity_date):
+            return
+    save_weather_data(lat, lon, fetch_weather_data(lat, lon, planting_date, maturity_date), merge=True)
+
+
+def columnar(odata, columns=None):
+    '''
+    Compact columnar encoding of the daily model output.
+
+    Dates are given once as the first day and the number of days, and each numeric column as a list of values
+    (NaN as null). pyfao56 repeats some date columns in `odata`; only the first occurrence of a column is kept.
+
+    Returns:
+    --------
+    dict
+        {'start': 'YYYY-MM-DD', 'days': n, 'columns': {name: [values]}}
+    '''
+    odata = odata.loc[:, ~odata.columns.duplicated()].select_dtypes('number')
+    if columns is not None:
+        unknown = [col for col in columns if col not in odata.columns]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+        odata = odata[columns]
+
+    start = pd.to_datetime(odata.index[0], format='%Y-%j').strftime('%Y-%m-%d') if len(odata) else None
+    values = odata.to_numpy(dtype=float)
+    encoded = {}
+    for i, col in enumerate(odata.columns):
+        column = values[:, i]
+        encoded[col] = np.where(np.isnan(column), None, column).tolist()
+    return {'start': start, 'days': len(odata), 'columns': encoded}
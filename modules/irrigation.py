@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, request, session, redirect, url_for, flash
 import pandas as pd
 from datetime import datetime
+from main.table_store import put_table
 
 irrigation_blueprint = Blueprint('irrigation', __name__, template_folder='../templates')
 
@@ -34,11 +35,13 @@ def index():
                     flash(f"File missing required columns: {required_columns}", "danger")
                     return redirect(url_for('irrigation.index'))
 
-                # Save validated data to session
-                irrigation_data = irrigation_data.dropna()
+                # Save validated data to the server-side table store, the session only keeps its reference
+                irrigation_data = irrigation_data[required_columns].dropna()
+                irrigation_data['Date'] = pd.to_datetime(irrigation_data['Date'])
                 session['irrigation_data'] = {
                     'Irrigation_type': irrigation_type,
-                    'Irri_data': irrigation_data.to_dict(orient='records')
+                    'table_ref': put_table(irrigation_data),
+                    'n_events': len(irrigation_data)
                 }
 
                 flash("Irrigation data uploaded successfully!", "success")
@@ -1,16 +1,66 @@
-from flask import Blueprint, render_template, session, send_file, redirect, url_for, flash
+from flask import Blueprint, render_template, session, send_file, redirect, url_for, flash, request, jsonify, Response
 import pandas as pd
-import io
-import pyfao56 as fao
-import pyfao56.custom as custom
-import pyfao56.tools as tools
-from main.utils import *
-from main.pyfao56_mod import *
-from main.grhs import *
+import os
+import importlib.metadata
+import importlib.util
+import hashlib
+import json
+from main.utils import weather_version
+from main.shared_cache import cache
+from main.table_store import resolve_irrigation, TableNotFound
+from main.qc import checked_weather
+from main.eto import add_eto, weather_with_eto
+from main.schema import to_pyfao56
+from main.forecast import load_forecast, latest_issue, extend_weather, forecast_tail, checkpoint, resume
+from main.scheduler import registry
+from main.run_store import runs, record_run, field_key
+from main.pyfao56_mod import crop_stage
+from main.grhs import wb_plot_payload
+from main.plot_cache import submit_plot, get_plot, PLOT_FORMATS, DEFAULT_DPI
+from main.export import iter_export, available_formats, EXPORT_FORMATS
+from main.http_cache import conditional, send_static, STATIC_MAX_AGE
+from main import metrics
+
+# Note: pyfao56 (and through the plots, matplotlib/seaborn/plotly) are imported on first use in the functions that need them,
+# so that booting a worker does not pay for them. The plotly.js bundle path is located without importing plotly.
 
 results_blueprint = Blueprint('results', __name__, template_folder='../templates')
 
+
+class InvalidInputs(ValueError):
+    '''Raised by `build_model` when the inputs cannot be simulated (e.g. an unknown auto irrigation trigger).'''
+
+
+@results_blueprint.errorhandler(TableNotFound)
+def table_not_found(error):
+    ''' The uploaded irrigation table referenced by the session has expired from the table store '''
+    flash("The uploaded irrigation file has expired. Please upload it again.", "danger")
+    return redirect(url_for('irrigation.index'))
+
+
+@results_blueprint.errorhandler(InvalidInputs)
+def invalid_inputs(error):
+    ''' The session's inputs cannot be simulated '''
+    flash(f"{error}. Please check your inputs.", "danger")
+    return redirect(url_for('irrigation.index'))
+
+
+def results_etag():
+    '''ETag parts of the result views: the hash of the session's inputs and weather version, and the latest forecast issue.
+    None (no validation) while inputs are missing or messages are waiting to be flashed.'''
+    plant_data = session.get('plant_data', {})
+    weather_data = session.get('weather_data', {})
+    soil_data = session.get('soil_data', {})
+    irri_data = session.get('irrigation_data', {})
+    if not plant_data or not weather_data or not soil_data or '_flashes' in session:
+        return None
+    if weather_version(weather_data.get('latitude'), weather_data.get('longitude')) is None:
+        return None
+    return results_key(plant_data, weather_data, soil_data, irri_data), str(latest_issue())
+
+
 @results_blueprint.route('/')
+@conditional(results_etag)
 def index():
     # Aggregate all data from the session
     plant_data = session.get('plant_data', {})
@@ -23,15 +73,28 @@ def index():
         return redirect(url_for('plant.index'))
 
     # Process water balance sums for table on result page
-    simulation_results, swb_cum_data = simulate_model(plant_data, weather_data, soil_data, irri_data)
+    # Days after the last observed weather day are simulated with the latest forecast, when there is one
+    simulation_results, swb_cum_data, forecast = cached_forecast_model(plant_data, weather_data, soil_data, irri_data)
     swb_cum_table = pd.DataFrame([swb_cum_data]).round(2).to_html(classes='table table-striped', index=False,
                                                                   border=0)
-    plot_html = wb_plot_interactive(simulation_results)
+    # The plot is rendered client-side from a compact JSON payload instead of embedding the full Plotly HTML (and plotly.js) in the page
+    plot_payload = wb_plot_payload(simulation_results)
+
+    # Days of the weather data flagged or filled by the quality control (already cached by the simulation)
+    _, weather_qc = checked_weather(float(weather_data.get('latitude')), float(weather_data.get('longitude')),
+                                    weather_data.get('data_source'), **season(plant_data))
+
+    # Start rendering the downloadable plot in the background so the download is served from the cache
+    submit_plot(simulation_results)
 
     return render_template(
         'results.html',
         swb_cum_table=swb_cum_table,
-        plot_html=plot_html,
+        plot_payload=plot_payload,
+        plotly_version=PLOTLY_VERSION,
+        export_formats=available_formats(),
+        weather_qc=weather_qc,
+        forecast=forecast,
         plant_data=plant_data,
         weather_data=weather_data,
         soil_data=soil_data,
@@ -39,55 +102,246 @@ def index():
     )
 
 
+@results_blueprint.route('/plot_data')
+@conditional(results_etag)
+def plot_data():
+    '''Columnar JSON payload of the water balance plot. Long series are downsampled to `max_points` (LTTB).'''
+    plant_data = session.get('plant_data', {})
+    weather_data = session.get('weather_data', {})
+    soil_data = session.get('soil_data', {})
+    irri_data = session.get('irrigation_data', {})
+
+    if not plant_data or not weather_data or not soil_data:
+        return jsonify({'error': 'Incomplete input data. Please complete all sections.'}), 400
+
+    max_points = request.args.get('max_points', 1000, type=int)
+    simulation_results, _, _ = cached_forecast_model(plant_data, weather_data, soil_data, irri_data)
+    return jsonify(wb_plot_payload(simulation_results, max_points=max(max_points, 3)))
+
+
+@results_blueprint.route('/register', methods=['POST'])
+def register_field():
+    ''' Registers the session's field for the nightly refresh, so its results are ready in the morning (see main/scheduler.py) '''
+    plant_data = session.get('plant_data', {})
+    weather_data = session.get('weather_data', {})
+    soil_data = session.get('soil_data', {})
+    irri_data = session.get('irrigation_data', {})
+    if not plant_data or not weather_data or not soil_data:
+        flash("Incomplete input data. Please complete all sections.", "danger")
+        return redirect(url_for('plant.index'))
+
+    field_id = registry.register(plant_data, weather_data, soil_data, irri_data, name=request.form.get('name') or None)
+    flash(f"Field registered for the nightly refresh ({field_id}).", "success")
+    return redirect(url_for('results.index'))
+
+
+@results_blueprint.route('/history')
+def history():
+    '''Seasonal water balance of the session's field for its recorded seasons (`?seasons=`, default the last three before the
+    current one), from the run store. `?daily=1` adds the daily outputs aligned on the days after planting.'''
+    plant_data = session.get('plant_data', {})
+    weather_data = session.get('weather_data', {})
+    if not plant_data or not weather_data:
+        return jsonify({'error': 'Incomplete input data. Please complete all sections.'}), 400
+
+    field = field_key(weather_data.get('latitude'), weather_data.get('longitude'))
+    seasons = runs.season_history(field, crop=plant_data.get('crop'), seasons=request.args.get('seasons', 3, type=int))
+    payload = {'field': field, 'crop': plant_data.get('crop'),
+               'seasons': json.loads(seasons.to_json(orient='records'))}
+    if request.args.get('daily', type=int):
+        daily = runs.daily_history(seasons['run_id'])
+        payload['daily'] = json.loads(daily.to_json(orient='split', index=False))
+    return jsonify(payload)
+
+
+@results_blueprint.route('/weather_qc')
+def weather_qc():
+    '''Quality control report of the session's weather data: counts per flag and the flagged days.'''
+    weather_data = session.get('weather_data', {})
+    if not weather_data:
+        return jsonify({'error': 'No weather data. Please complete the weather section.'}), 400
+    _, report = checked_weather(float(weather_data.get('latitude')), float(weather_data.get('longitude')),
+                                weather_data.get('data_source'), **season(session.get('plant_data', {})))
+    return jsonify(report)
+
+
+# plotly.js is served from the installed plotly package, compressed and with long-lived caching so that browsers download it once
+PLOTLY_JS = os.path.join(importlib.util.find_spec('plotly').submodule_search_locations[0], 'package_data', 'plotly.min.js')
+PLOTLY_VERSION = importlib.metadata.version('plotly')
+
+@results_blueprint.route('/plotly.min.js')
+def plotly_js():
+    return send_static(PLOTLY_JS, mimetype='application/javascript', max_age=STATIC_MAX_AGE)
+
+
 @results_blueprint.route('/download_csv')
+@conditional(results_etag)
 def download_csv():
-    df, _ = simulate_model(
+    ''' Downloads the daily results, streamed in chunks. `?format=` is csv (default), csv.gz, parquet or arrow '''
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in available_formats():
+        return f"Unsupported results format: {fmt}", 400
+
+    df, _, _ = cached_forecast_model(
         session.get('plant_data', {}),
         session.get('weather_data', {}),
         session.get('soil_data', {}),
         session.get('irrigation_data', {})
     )
 
-    # Convert DataFrame to CSV
-    csv_file = io.StringIO()
-    df.to_csv(csv_file, index=False)
-    csv_file.seek(0)
-
-    return send_file(
-        io.BytesIO(csv_file.getvalue().encode()),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name='simulation_results.csv'
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    return Response(
+        iter_export([(None, df)], fmt),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=simulation_results.{extension}'}
     )
 
 
 @results_blueprint.route('/download_plot')
+@conditional(results_etag)
 def download_plot():
-    df,_ = simulate_model(
+    fmt = request.args.get('format', 'png').lower()
+    dpi = request.args.get('dpi', DEFAULT_DPI, type=int)
+    if fmt not in PLOT_FORMATS:
+        return f"Unsupported plot format: {fmt}", 400
+
+    df, _, _ = cached_forecast_model(
         session.get('plant_data', {}),
         session.get('weather_data', {}),
         session.get('soil_data', {}),
         session.get('irrigation_data', {})
     )
-    plot_img = wb_plot(df)
 
-    # Ensure the base64 string is valid and remove the prefix
-    if plot_img.startswith("data:image/png;base64,"):
-        img_data = base64.b64decode(plot_img.split(",")[1])
-    else:
-        return "Invalid plot data", 400
+    # Rendered by the background renderer (or served straight from the plot cache when it was rendered before)
+    plot_path = get_plot(df, fmt=fmt, dpi=dpi)
 
-    # Return the decoded image as a downloadable file
     return send_file(
-        io.BytesIO(img_data),
-        mimetype='image/png',
+        os.path.abspath(plot_path),
+        mimetype=PLOT_FORMATS[fmt],
         as_attachment=True,
-        download_name='simulation_plot.png'
+        download_name=f'simulation_plot.{fmt}'
     )
 
 
-def simulate_model(plant_data, weather_data, soil_data, irri_data):
-    '''This is the heart of the simulation. It takes in the input data and runs the FAO56 model to simulate the water balance.'''
+# Cached results live as long as the weather files (see `delete_old_files`)
+RESULTS_TTL = 6 * 3600
+
+def season(plant_data):
+    '''Season of the plant inputs (planting to maturity date, YYYY-MM-DD) as `start` and `end` for the weather QC and ETo.'''
+    dates = {'start': plant_data.get('planting_date'), 'end': plant_data.get('maturity_date')}
+    return {name: pd.to_datetime(day).strftime('%Y-%m-%d') if day else None for name, day in dates.items()}
+
+
+def results_key(plant_data, weather_data, soil_data, irri_data, w_data=None):
+    '''Hash of the simulation inputs and of the version of the weather data.'''
+    if w_data is None:
+        version = weather_version(weather_data.get('latitude'), weather_data.get('longitude'))
+    else:
+        version = hashlib.sha256(w_data.to_json().encode()).hexdigest()
+    inputs = json.dumps([plant_data, weather_data, soil_data, irri_data, version], sort_keys=True, default=str)
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+def cached_simulate_model(plant_data, weather_data, soil_data, irri_data, w_data=None, ttl=RESULTS_TTL):
+    '''Returns the output of `simulate_model` from the shared cache when the same inputs were already simulated with the same weather data.'''
+    key = 'results:' + results_key(plant_data, weather_data, soil_data, irri_data, w_data)
+
+    def compute():
+        odata, swbdata = simulate_model(plant_data, weather_data, soil_data, irri_data, w_data)
+        # Kept in the run store for the history of the field (see main/run_store.py)
+        version = weather_version(weather_data.get('latitude'), weather_data.get('longitude')) if w_data is None else 'inline'
+        record_run(plant_data, weather_data, soil_data, irri_data, odata, swbdata, version)
+        return odata, swbdata
+
+    return cache.get_or_compute(key, compute, ttl=ttl, name='results_cache')
+
+
+def cached_forecast_model(plant_data, weather_data, soil_data, irri_data, ttl=RESULTS_TTL):
+    '''
+    Simulation of the session's inputs through the latest forecast (see main/forecast.py).
+
+    When the season goes past the last observed weather day and a forecast is available, the forecast days are simulated from
+    the model state of the last observed day. The observed run and its state are cached per weather version, the forecast days
+    per forecast issue, for `ttl` seconds (the nightly scheduler keeps them until the next night). The output has a `Forecast`
+    column (True for the forecast days).
+
+    Returns:
+    --------
+    tuple
+        (odata, swbdata, forecast info dict with 'issue' and 'start', or None without forecast days)
+    '''
+    lat, lon = float(weather_data.get('latitude')), float(weather_data.get('longitude'))
+    w_data = weather_with_eto(lat, lon, float(weather_data.get('elevation')), weather_data.get('data_source'), wndht=10,
+                              ttl=ttl, **season(plant_data))
+    last_observed = pd.to_datetime(w_data['Date']).max()
+    issue, forecast = (None, None)
+    if pd.to_datetime(plant_data.get('maturity_date')) > last_observed:
+        issue, forecast = load_forecast(lat, lon)
+
+    key = results_key(plant_data, weather_data, soil_data, irri_data)
+    # Without forecast days continuing the observed weather (e.g. a gap between them), only the observed days are simulated
+    if forecast is None or forecast_tail(w_data, forecast).empty:
+        odata, swbdata = cached_simulate_model(plant_data, weather_data, soil_data, irri_data, ttl=ttl)
+        return odata.assign(Forecast=False), swbdata, None
+
+    version = weather_version(weather_data.get('latitude'), weather_data.get('longitude'))
+    forecast_start = (last_observed + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def observed_run():
+        odata, swbdata, state = simulate_observed(plant_data, weather_data, soil_data, irri_data)
+        # The observed days alone are kept in the run store next to the forecast run (see main/run_store.py)
+        record_run(plant_data, weather_data, soil_data, irri_data, odata, swbdata, version)
+        return odata, swbdata, state
+
+    def simulate_forecast():
+        mdl = build_model(plant_data, weather_data, soil_data, irri_data, forecast=forecast)
+        if pd.to_datetime(plant_data.get('planting_date')) <= last_observed:
+            observed, _, state = cache.get_or_compute('observed:' + key, observed_run, ttl=ttl, name='results_cache')
+            resume(mdl, state, observed)
+        mdl.run()
+        record_run(plant_data, weather_data, soil_data, irri_data, mdl.odata, mdl.swbdata, version, issue.isoformat(),
+                   forecast_start)
+        return mdl.odata, mdl.swbdata
+
+    odata, swbdata = cache.get_or_compute(f'forecast_results:{key}:{issue.isoformat()}', simulate_forecast,
+                                          ttl=ttl, name='results_cache')
+    days = pd.to_datetime(odata.index, format='%Y-%j')
+    return odata.assign(Forecast=days > last_observed), swbdata, {
+        'issue': issue.strftime('%Y-%m-%d %H:%M UTC'),
+        'start': forecast_start,
+    }
+
+
+def simulate_observed(plant_data, weather_data, soil_data, irri_data):
+    '''`simulate_model` up to the last observed weather day, with the model state of that day for `resume`.'''
+    mdl = build_model(plant_data, weather_data, soil_data, irri_data)
+    state = checkpoint(mdl, mdl.endDate.strftime('%Y-%j'))
+    mdl.run()
+    return mdl.odata, mdl.swbdata, state
+
+
+@metrics.timed('simulate_model')
+def simulate_model(plant_data, weather_data, soil_data, irri_data, w_data=None):
+    '''This is the heart of the simulation. It takes in the input data and runs the FAO56 model to simulate the water balance.
+
+    `w_data` optionally gives the weather records (DataFrame in the layout of the weather JSON files, see `save_weather_data`)
+    instead of the stored weather data of the location. It is used by the JSON API for inline weather data.'''
+    mdl = build_model(plant_data, weather_data, soil_data, irri_data, w_data)
+    mdl.run()
+    #print(mdl.odata.iloc[:,:5].head(5))
+    return mdl.odata, mdl.swbdata
+
+
+def build_model(plant_data, weather_data, soil_data, irri_data, w_data=None, forecast=None):
+    '''Builds the pyfao56 model of the inputs (see `simulate_model`) without running it. The season is simulated up to the
+    last weather day when the weather ends before the maturity date.
+
+    `forecast` optionally gives forecast weather (see `load_forecast`) appended after the last observed weather day.'''
+    import pyfao56 as fao
+    import pyfao56.custom as custom
+
+    # Uploaded irrigation tables are kept in the table store, the session only has their reference
+    irri_data = resolve_irrigation(irri_data)
 
     planting_date = plant_data.get('planting_date', []) # Get the planting date from the plant data
     maturity_date = plant_data.get('maturity_date', []) # Get the maturity date from the plant data
@@ -112,33 +366,19 @@ def simulate_model(plant_data, weather_data, soil_data, irri_data):
     lat = float(weather_data.get('latitude')) # Get the latitude from the weather data
     lon = float(weather_data.get('longitude')) # Get the longitude from the weather data
 
-    # Load weather data
-    weather_data_dict = load_weather_data(lat, lon) # Load the weather data using the latitude and longitude
-    w_data = pd.DataFrame(weather_data_dict['weather_data']) # Convert the weather data to a DataFrame
-    w_order  = ['Date','srad','tmmx','tmmn','vpar','tdew','rmax','rmin','vs','pr','ET','MorP'] # Define the order of the columns in the weather data. This order is needed in pyfao56.
-
-    # Handle data type conversion
-    def convert_column_types(df):
-        # Columns to convert to float
-        float_columns = ['srad', 'tmmx', 'tmmn', 'vpar', 'tdew', 'rmax', 'rmin', 'vs', 'pr', 'ET']
-        
-        # Convert float columns
-        for col in float_columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')  # Convert to float, set invalid values to NaN
-        
-        # Convert 'Date' to datetime
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')  # Convert invalid dates to NaT
-        
-        # Ensure 'MorP' is string
-        df['MorP'] = df['MorP'].astype(str).replace({'': None})  # Replace empty strings with None. This is needed for pyfao56 but not necessary for our purposes.
-
-        return df
-
-    # Apply conversion
-    w_data = convert_column_types(w_data)
-
-    # Reorder the columns
-    w_data = w_data[w_order]
+    # Load weather data, checked and gap-filled once per weather version (see main/qc.py), with the daily ETo and vapor pressure
+    # computed once for all crops and scenarios of the location (see main/eto.py). pyfao56 uses them instead of recomputing ETo.
+    w_data = weather_with_eto(lat, lon, float(weather_data.get('elevation')), weather_data.get('data_source'), w_data,
+                              wndht=10, **season(plant_data))
+    if forecast is not None:
+        # Forecast days (MorP = 'P') after the last observed day, with their ETo
+        w_data = extend_weather(w_data, add_eto(forecast, float(weather_data.get('elevation')), lat, wndht=10))
+    # The stage lengths still follow the maturity date, only the simulated days stop at the last weather day
+    last_day = pd.to_datetime(w_data['Date']).max()
+    run_end = min(pd.to_datetime(maturity_date), last_day).strftime('%Y-%j')
+    # Convert the compact weather schema (float32 values, NaN for missing, categorical MorP, see main/schema.py) to the float64
+    # columns pyfao56 expects, in the order of `Weather.wdata`. MorP is 'M', 'P' or None.
+    w_data = to_pyfao56(w_data)
 
     # Note: The aforementioned weather handling is for gridMET or uploaded weather data where vpar and tdew are not available. In case of Agrimet data, 
     # we have tdew but not rmin and rmax for now. We can run our simulation either with vpar or tdew or rmin and rmax. However, for Kcb adjustments,
@@ -227,7 +467,7 @@ def simulate_model(plant_data, weather_data, soil_data, irri_data):
             airr = fao.AutoIrrigate() # Create an instance of the AutoIrrigate class from pyfao56
             airr.addset(auto_start, auto_end, dsli=et_days, ietrd=et_days, ettyp=et_type, fpday=0, imax=et_up,fw=frac)
         else:
-            return "Invalid irrigation trigger", 400
+            raise InvalidInputs(f"Invalid irrigation trigger: {trigger}")
         
     # This is to adjust the crop stage length based on the planting date and maturity date. For instance, if user defined planting and maturity dates whose total crop span is different compared to the default stage lengths
     # then we need to adjust the stage lengths accordingly. This is explained in pyfao56_mod.py file.
@@ -250,11 +490,9 @@ def simulate_model(plant_data, weather_data, soil_data, irri_data):
     cons_p = not plant_properties.get('p_value_adjust', 'off') == 'on'
 
     if irri_data['Irrigation_type'] == 'manual' or irri_data['Irrigation_type'] == 'upload':
-        mdl = fao.Model(start,end, par, wth, irr, sol=sol, roff=roff, cons_p= cons_p, K_adj=K_adj)
+        mdl = fao.Model(start,run_end, par, wth, irr, sol=sol, roff=roff, cons_p= cons_p, K_adj=K_adj)
     else:
-        mdl = fao.Model(start,end, par, wth, sol=sol,roff=roff, autoirr = airr, cons_p= cons_p, K_adj=K_adj)
+        mdl = fao.Model(start,run_end, par, wth, sol=sol,roff=roff, autoirr = airr, cons_p= cons_p, K_adj=K_adj)
 
-    mdl.run()
-    #print(mdl.odata.iloc[:,:5].head(5))
-    return mdl.odata, mdl.swbdata
+    return mdl
 
@@ -1,12 +1,18 @@
 from flask import Blueprint, render_template, request, session, redirect, url_for, flash
-import pandas as pd
 from main.gridMET_fetch import WeatherDataFetcher
 from datetime import datetime
 import logging
 from main.utils import save_weather_data
+from main import metrics
+from main.shared_cache import cache
+from main.single_flight import SingleFlight
+from main.ingest import ingest_weather, report_summary, IngestError
 
 weather_blueprint = Blueprint('weather', __name__, template_folder='../templates')
 
+# Identical fetches in flight at the same time (same location and season) share one download, see main/single_flight.py
+weather_fetches = SingleFlight('fetch_weather_data')
+
 @weather_blueprint.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -37,33 +43,11 @@ def index():
                 return redirect(url_for('weather.index'))
 
             try:
-                # Validate and read file
-                if file.filename.endswith('.csv'):
-                    data = pd.read_csv(file)
-                elif file.filename.endswith('.xlsx'):
-                    data = pd.read_excel(file)
-                else:
-                    flash("Invalid file format. Please upload a CSV or Excel file.", "danger")
-                    return redirect(url_for('weather.index'))
-
-                # validation for column names
-                required_columns = ['Date', 'srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
-                missing_columns = [col for col in required_columns if col not in data.columns]
-
-                if missing_columns:
-                    flash(f"Missing required columns: {', '.join(missing_columns)}", "danger")
-                    return redirect(url_for('weather.index'))
-
-                # Convert Date column to string to ensure compatibility
-                data.columns = required_columns
-                data.insert(4, 'vpar', '')
-                data.insert(5, 'tdew', '')
-                data.insert(10, 'ET', '')
-                data.insert(11, 'MorP', '')
-                data['Date'] = pd.to_datetime(data['Date']).dt.strftime('%Y-%m-%d')
-
-                # Save data to JSON file
-                save_weather_data(lat, lon, data)
+                # Read in chunks, type and check the file, then write it to the weather store (see main/ingest.py)
+                report = ingest_weather(file, file.filename, lat, lon, planting_date, maturity_date)
+                issues = report_summary(report)
+                if issues:
+                    flash(f"Weather file checked: {issues}.", "warning")
 
                 # Save metadata in session
                 session['weather_data'] = {
@@ -76,6 +60,10 @@ def index():
                 flash("Weather parameters saved successfully!", "success")
                 return redirect(url_for('soil.index'))
 
+            except IngestError as e:
+                flash(str(e), "danger")
+                return redirect(url_for('weather.index'))
+
             except Exception as e:
                 logging.error(f"File processing error: {str(e)}")
                 flash("Something went wrong while processing the file.", "danger")
@@ -88,8 +76,8 @@ def index():
                 # Fetch weather data from API
                 data = fetch_weather_data(lat, lon, planting_date, maturity_date)
 
-                # Convert DataFrame to JSON and save
-                save_weather_data(lat, lon, data)
+                # Convert DataFrame to JSON and save, merged with the seasons already stored for the location
+                save_weather_data(lat, lon, data, merge=True)
 
                 # Save metadata in session
                 session['weather_data'] = {
@@ -112,10 +100,16 @@ def index():
     return render_template('weather.html')
 
 
+@metrics.timed('fetch_weather_data')
 def fetch_weather_data(lat, lon, planting_date, maturity_date):
-    """ Fetches weather data from gridMET """
-    varname = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
-    wth_data = WeatherDataFetcher(lat, lon, varname).fetch_data_for_date_range(planting_date, maturity_date)
-    data = WeatherDataFetcher.unit_conversion_pyfao56(wth_data)
-
-    return data
\ No newline at end of file
+    """ Fetches weather data from gridMET. Concurrent calls for the same location and dates share one fetch. """
+    def fetch():
+        varname = ['srad', 'tmmx', 'tmmn', 'rmax', 'rmin', 'vs', 'pr']
+        # Yearly gridMET data is shared by all workers, so users in the same grid cell trigger a single download
+        wth_data = WeatherDataFetcher(float(lat), float(lon), varname, cache=cache).fetch_data_for_date_range(planting_date, maturity_date)
+        if metrics.METRICS_ENABLED:
+            metrics.add_bytes('fetch_weather_data', wth_data.memory_usage(deep=True).sum(), 'read')
+        return WeatherDataFetcher.unit_conversion_pyfao56(wth_data)
+
+    key = (float(lat), float(lon), str(planting_date), str(maturity_date))
+    return weather_fetches.do(key, fetch).copy()  # Each caller gets its own copy of the shared result
\ No newline at end of file
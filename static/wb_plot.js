@@ -0,0 +1,60 @@
+// Client-side rendering of the water balance plot from the compact payload built by `wb_plot_payload` (main/grhs.py).
+// The layout mirrors `wb_plot_interactive`: ETc/ETa/Ks on top, rain/irrigation/runoff in the middle and TAW/RAW/Dr/DP at the bottom.
+function wbPlot(elementId, payload) {
+    const index = payload.index;
+
+    // Series refer to positions in the shared day index; `i` is omitted when the series covers every day
+    function xy(series) {
+        return {
+            x: series.i ? series.i.map(k => index[k]) : index,
+            y: series.y,
+        };
+    }
+    function line(series, name, color, extra) {
+        return Object.assign({type: 'scatter', mode: 'lines', name: name, line: {color: color}}, xy(series), extra || {});
+    }
+    function bar(series, name, color, extra) {
+        return Object.assign({type: 'bar', name: name, marker: {color: color}}, xy(series), extra || {});
+    }
+
+    const lines = payload.lines;
+    const bars = payload.bars;
+    const traces = [
+        // First subplot (Ks, ETc, and adjusted ETc)
+        line(lines.ETc, 'ETc', 'coral', {xaxis: 'x', yaxis: 'y'}),
+        line(lines.ETa, 'ETc adj', 'olive', {xaxis: 'x', yaxis: 'y'}),
+        line(lines.Ks, 'Ks', 'green', {xaxis: 'x', yaxis: 'y2', line: {color: 'green', dash: 'dot'}}),
+        // Second subplot (Rainfall, Irrigation, and Runoff)
+        bar(bars.Rain, 'Rainfall', 'dodgerblue', {xaxis: 'x2', yaxis: 'y3', marker: {color: 'dodgerblue', opacity: 0.6}}),
+        bar(bars.Irrig, 'Irrigation', 'green', {xaxis: 'x2', yaxis: 'y3', marker: {color: 'green', opacity: 0.6}}),
+        bar(bars.Runoff, 'Runoff', 'yellow', {xaxis: 'x2', yaxis: 'y4'}),
+        // Third subplot (TAW, RAW, soil depletion, and percolation)
+        line(lines.TAW, 'TAW', 'blue', {xaxis: 'x3', yaxis: 'y5'}),
+        line(lines.RAW, 'RAW', 'darkslategrey', {xaxis: 'x3', yaxis: 'y5'}),
+        line(lines.Dr, 'Dr', 'red', {xaxis: 'x3', yaxis: 'y5', opacity: 0.7}),
+        bar(bars.DP, 'Percolation', 'goldenrod', {xaxis: 'x3', yaxis: 'y5'}),
+    ];
+
+    // Day of year labels on roughly 20 evenly spaced ticks instead of one tick per day
+    const step = Math.max(1, Math.ceil(index.length / 20));
+    const tickvals = index.filter((_, k) => k % step === 0);
+    const category = {type: 'category', categoryorder: 'array', categoryarray: index};
+
+    const layout = {
+        height: 800,
+        title: {text: 'Water Balance Components'},
+        legend: {title: {text: 'Components'}},
+        plot_bgcolor: 'white',
+        xaxis: Object.assign({anchor: 'y', domain: [0, 0.94], matches: 'x3', showticklabels: false}, category),
+        xaxis2: Object.assign({anchor: 'y3', domain: [0, 0.94], matches: 'x3', showticklabels: false}, category),
+        xaxis3: Object.assign({anchor: 'y5', domain: [0, 0.94], title: {text: 'Day of Year (DOY)'},
+                               tickvals: tickvals, ticktext: tickvals.map(day => day.split('-')[1])}, category),
+        yaxis: {domain: [0.73, 1.0], title: {text: 'ETc & ETc adj. (mm)'}},
+        yaxis2: {overlaying: 'y', side: 'right', anchor: 'x', title: {text: 'Ks'}},
+        yaxis3: {domain: [0.37, 0.63], title: {text: 'Rainfall & Irrigation (mm)'}},
+        yaxis4: {overlaying: 'y3', side: 'right', anchor: 'x2', title: {text: 'Runoff (mm)'}},
+        yaxis5: {domain: [0.0, 0.27], autorange: 'reversed', title: {text: 'TAW, RAW, Dr & DP (mm)'}},
+    };
+
+    Plotly.newPlot(elementId, traces, layout, {responsive: true});
+}